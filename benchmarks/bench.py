@@ -0,0 +1,262 @@
+# throughput benchmarks for build, install, mklocal and loopback send/recv.
+#
+# every stage runs the real command line in a child process against synthetic mods and a fake
+# paradox documents dir, so the numbers include startup and peak rss is the child's own.
+#
+#   python -m benchmarks.bench --scale 0.01 --threads 1,2,4 -o bench.json
+#   python -m benchmarks.bench --scale 0.01 --compare bench.json
+import argparse
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from benchmarks import synthetic
+
+REPO_ROOT = pathlib.Path(__file__).resolve().parent.parent
+STAGES = ['build', 'install', 'mklocal', 'transfer']
+GAME = 'stellaris'
+
+
+class Bench:
+
+    def __init__(self, work_dir: pathlib.Path, scale=1.0, extra_args=()):
+        self.work_dir = work_dir
+        self.scale = scale
+        self.extra_args = list(extra_args)
+        self.results = []
+
+    def env(self, home: pathlib.Path):
+        env = dict(os.environ, HOME=str(home), USERPROFILE=str(home))
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [str(REPO_ROOT), env.get('PYTHONPATH')]))
+        return env
+
+    def command(self, *args, threads=None):
+        threads = ['-t', str(threads)] if threads else []
+        return [sys.executable, '-m', 'pdxModTool', *threads, *self.extra_args, *args]
+
+    @staticmethod
+    def spawn(cmd, env):
+        # progress bars go to stderr; a file instead of a pipe so a chatty child never blocks
+        log = tempfile.TemporaryFile()
+        proc = subprocess.Popen(cmd, env=env, stdout=subprocess.DEVNULL, stderr=log)
+        proc.log = log
+        return proc
+
+    @staticmethod
+    def wait(proc):
+        # wait4 hands back the rusage of exactly this child; ru_maxrss is KiB on linux, bytes on macos
+        if hasattr(os, 'wait4'):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = (status >> 8) if os.WIFEXITED(status) else -1
+            peak_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        else:
+            proc.wait()
+            peak_rss = None
+
+        if proc.returncode:
+            proc.log.seek(0)
+            raise RuntimeError(f'{" ".join(proc.args)} failed ({proc.returncode}):\n'
+                               f'{proc.log.read()[-2000:].decode(errors="replace")}')
+        proc.log.close()
+        return peak_rss
+
+    def run(self, cmd, env):
+        start = time.perf_counter()
+        peak_rss = self.wait(self.spawn(cmd, env))
+        return time.perf_counter() - start, peak_rss
+
+    def record(self, stage, shape, threads, files, size, elapsed, peak_rss, **extra):
+        result = {
+            'stage': stage, 'shape': shape, 'threads': threads,
+            'files': files, 'bytes': size, 'seconds': round(elapsed, 4),
+            'mb_per_s': round(size / elapsed / 1e6, 2) if elapsed else None,
+            'files_per_s': round(files / elapsed, 1) if elapsed else None,
+            'peak_rss': peak_rss, **extra
+        }
+        logging.info(f'{stage:>8} {shape:>8} t={threads or "-":<2} {result["seconds"]:>8.2f}s '
+                     f'{result["mb_per_s"] or 0:>9.1f} MB/s {result["files_per_s"] or 0:>10.1f} files/s '
+                     f'rss {(peak_rss or 0) / 2 ** 20:>7.1f} MiB')
+        self.results.append(result)
+        return result
+
+    def home(self, name):
+        home = self.work_dir / 'homes' / name
+        shutil.rmtree(home, ignore_errors=True)
+        return home, synthetic.make_docs_dir(home, GAME)
+
+    # stages
+
+    def build(self, shape, tree, files, size, threads):
+        out_dir = self.work_dir / 'out' / shape
+        shutil.rmtree(out_dir, ignore_errors=True)
+        out_dir.mkdir(parents=True)
+        elapsed, peak_rss = self.run(self.command('build', '-p', str(tree), '-o', str(out_dir), threads=threads),
+                                     self.env(self.work_dir))
+        self.record('build', shape, threads, files, size, elapsed, peak_rss)
+
+    def install(self, shape, tree, files, size, threads):
+        home, _ = self.home(f'install_{shape}')
+        elapsed, peak_rss = self.run(self.command('install', GAME, '-p', str(tree), threads=threads), self.env(home))
+        self.record('install', shape, threads, files, size, elapsed, peak_rss)
+
+    def mklocal(self, shape, bin_path, files, size, threads):
+        home, game_dir = self.home(f'mklocal_{shape}')
+        synthetic.set_enabled_mods(game_dir, [synthetic.add_workshop_mod(game_dir, bin_path, shape)])
+        elapsed, peak_rss = self.run(self.command('mklocal', GAME, threads=threads), self.env(home))
+        self.record('mklocal', shape, threads, files, size, elapsed, peak_rss,
+                    bin_bytes=bin_path.stat().st_size)
+
+    def transfer(self, shape, tree, files, size):
+        # install on a sending home, then time one client pulling it over loopback
+        send_home, send_dir = self.home(f'send_{shape}')
+        self.run(self.command('install', GAME, '-p', str(tree)), self.env(send_home))
+        synthetic.set_enabled_mods(send_dir, [f'mod/{p.name}' for p in (send_dir / 'mod').glob('*.mod')])
+        sent_bytes = sum(p.stat().st_size for p in (send_dir / 'mod').iterdir())
+        recv_home, recv_dir = self.home(f'recv_{shape}')
+
+        port = free_port()
+        server = self.spawn(self.command('send', GAME, '-i', '127.0.0.1', '-p', str(port), '--persist'),
+                            self.env(send_home))
+        try:
+            wait_for_port(port)
+            start = time.perf_counter()
+            first_file = {}
+            done = threading.Event()
+            watcher = threading.Thread(target=watch_first_file, args=(recv_dir / 'mod', start, first_file, done))
+            watcher.start()
+            client = self.spawn(self.command('recv', '127.0.0.1', '-p', str(port)), self.env(recv_home))
+            try:
+                recv_rss = self.wait(client)
+            finally:
+                done.set()
+                watcher.join()
+            elapsed = time.perf_counter() - start
+        finally:
+            # the server exits cleanly on KeyboardInterrupt
+            server.send_signal(signal.SIGINT)
+            send_rss = self.wait(server)
+
+        self.record('transfer', shape, None, files, sent_bytes, elapsed, recv_rss, send_peak_rss=send_rss,
+                    first_file_seconds=first_file.get('seconds'))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def watch_first_file(directory: pathlib.Path, start, result, done):
+    # time until the client has started writing its first file, the latency a user sees
+    while not done.is_set():
+        if any(directory.iterdir()):
+            result['seconds'] = round(time.perf_counter() - start, 4)
+            return
+        time.sleep(0.005)
+
+
+def wait_for_port(port, timeout=10.0):
+    # a persisting server shrugs off the probe connection like any other dropped client
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket() as sock:
+            if sock.connect_ex(('127.0.0.1', port)) == 0:
+                return
+        time.sleep(0.05)
+    raise TimeoutError(f'server did not listen on {port}')
+
+
+def compare(results, baseline):
+    # MB/s of this run against a previous json report, matched on stage, shape and threads
+    def key(result):
+        return result['stage'], result['shape'], result['threads']
+
+    previous = {key(result): result for result in baseline['results']}
+    for result in results:
+        if (old := previous.get(key(result))) and old['mb_per_s'] and result['mb_per_s']:
+            change = (result['mb_per_s'] / old['mb_per_s'] - 1) * 100
+            logging.info(f'{result["stage"]:>8} {result["shape"]:>8} t={result["threads"] or "-":<2} '
+                         f'{old["mb_per_s"]:>9.1f} -> {result["mb_per_s"]:>9.1f} MB/s ({change:+.1f}%)')
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='benchmarks.bench', description='benchmark pdxModTool throughput')
+    parser.add_argument('--shapes', default=','.join(synthetic.SHAPES),
+                        help=f'comma separated mod shapes. default: {",".join(synthetic.SHAPES)}.')
+    parser.add_argument('--stages', default=','.join(STAGES), help=f'comma separated stages. default: all.')
+    parser.add_argument('--threads', default='1,2,4,8', help='comma separated --threads values. default: 1,2,4,8.')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='scale file counts and sizes of the shapes, e.g. 0.01 for a quick run. default: 1.')
+    parser.add_argument('--work', type=pathlib.Path, help='work directory. default: a temporary directory.')
+    parser.add_argument('--keep', action='store_true', help='keep the work directory afterwards.')
+    parser.add_argument('-o', '--output', type=pathlib.Path, help='write the json report here. default: stdout.')
+    parser.add_argument('--compare', type=pathlib.Path, help='json report of a previous run to compare with.')
+    parser.add_argument('--args', default='', help='extra arguments passed to every pdxModTool call.')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stderr)
+
+    shapes = args.shapes.split(',')
+    stages = args.stages.split(',')
+    threads = [int(t) for t in args.threads.split(',')]
+    work_dir = args.work if args.work else pathlib.Path(tempfile.mkdtemp(prefix='pdx_bench_'))
+    bench = Bench(work_dir, args.scale, args.args.split())
+
+    try:
+        for shape in shapes:
+            tree = work_dir / 'trees' / shape
+            start = time.perf_counter()
+            if tree.exists():
+                files, size = synthetic.tree_stats(tree)
+            else:
+                files, size = synthetic.make_mod_tree(tree, shape, args.scale)
+            logging.info(f'{shape}: {files} files, {size / 2 ** 20:.1f} MiB '
+                         f'(ready in {time.perf_counter() - start:.1f}s)')
+
+            bin_path = None
+            if 'mklocal' in stages:
+                bin_path = work_dir / 'workshop' / shape / f'{shape}.bin'
+                if not bin_path.exists():
+                    synthetic.make_workshop_bin(tree, bin_path)
+
+            for t in threads:
+                if 'build' in stages:
+                    bench.build(shape, tree, files, size, t)
+                if 'install' in stages:
+                    bench.install(shape, tree, files, size, t)
+                if 'mklocal' in stages:
+                    bench.mklocal(shape, bin_path, files, size, t)
+            if 'transfer' in stages:
+                bench.transfer(shape, tree, files, size)
+    finally:
+        if not (args.keep or args.work):
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+        'scale': args.scale, 'args': args.args, 'results': bench.results
+    }
+    if args.compare:
+        with args.compare.open('r') as json_file:
+            compare(bench.results, json.load(json_file))
+
+    if args.output:
+        with args.output.open('w') as json_file:
+            json.dump(report, json_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
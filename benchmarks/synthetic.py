@@ -0,0 +1,113 @@
+import json
+import os
+import pathlib
+import struct
+import zipfile
+
+from pdxModTool import game_options
+
+MiB = 1024 ** 2
+GiB = 1024 ** 3
+
+# shape: (script files, script size, textures, texture size)
+# scale multiplies the counts and sizes, so the same shapes can be run quickly or at full size
+SHAPES = {
+    'scripts': (50_000, 2 * 1024, 0, 0),
+    'textures': (10, 2 * 1024, 3, 2 * GiB),
+    'mixed': (5_000, 4 * 1024, 200, 4 * MiB),
+}
+
+SCRIPT_LINE = 'pdx_bench_{group}_{index} = {{ modifier = {{ value = {index} factor = 0.{group} }} }}\n'
+
+
+def scaled(value, scale, minimum):
+    return max(minimum, int(value * scale)) if value else 0
+
+
+def write_script(path: pathlib.Path, index, size):
+    # clausewitz-like text: compresses the way real script files do
+    line = SCRIPT_LINE.format(group=index % 97, index=index)
+    path.write_text(line * max(1, size // len(line)))
+
+
+def write_texture(path: pathlib.Path, size):
+    # a random block with a running counter stamped in, so neither compression nor
+    # deduplication can shortcut the data
+    block = bytearray(os.urandom(min(size, 4 * MiB)))
+    with path.open('wb') as file:
+        written = 0
+        counter = 0
+        while written < size:
+            struct.pack_into('!Q', block, 0, counter)
+            chunk = memoryview(block)[:min(len(block), size - written)]
+            file.write(chunk)
+            written += len(chunk)
+            counter += 1
+
+
+def descriptor(name):
+    return f'name="{name}"\ntags={{\n\t"Gameplay"\n}}\nsupported_version="3.*"\n'
+
+
+def make_mod_tree(root: pathlib.Path, shape, scale=1.0):
+    # returns (file count, total bytes) of the generated tree
+    scripts, script_size, textures, texture_size = SHAPES[shape]
+    scripts = scaled(scripts, scale, 1)
+    textures = scaled(textures, scale, 1)
+    texture_size = scaled(texture_size, scale, 4096)
+
+    root.mkdir(parents=True, exist_ok=True)
+    (root / 'descriptor.mod').write_text(descriptor(f'bench {shape}'))
+
+    for index in range(scripts):
+        # spread the scripts over folders the way common/, events/, localisation/ are
+        folder = root / ('common', 'events', 'localisation', 'interface')[index % 4] / f'group_{index // 1000}'
+        folder.mkdir(parents=True, exist_ok=True)
+        write_script(folder / f'bench_{index}.txt', index, script_size)
+
+    if textures:
+        (root / 'gfx').mkdir(exist_ok=True)
+    for index in range(textures):
+        write_texture(root / 'gfx' / f'texture_{index}.dds', texture_size)
+
+    return tree_stats(root)
+
+
+def tree_stats(root: pathlib.Path):
+    count = size = 0
+    for path in root.rglob('*'):
+        if path.is_file():
+            count += 1
+            size += path.stat().st_size
+    return count, size
+
+
+def make_workshop_bin(tree: pathlib.Path, bin_path: pathlib.Path):
+    # steam workshop mods ship as a plain zip named <id>.bin with the descriptor inside
+    bin_path.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(bin_path, 'w', zipfile.ZIP_DEFLATED, compresslevel=1) as bin_file:
+        for path in sorted(tree.rglob('*')):
+            if path.is_file():
+                bin_file.write(path, path.relative_to(tree).as_posix())
+    return bin_path
+
+
+def make_docs_dir(home: pathlib.Path, game='stellaris'):
+    # the layout get_doc_dir() expects under $HOME, with an empty dlc_load.json
+    game_dir = home / 'Documents' / 'Paradox Interactive' / game_options.GAME_DIRECTORIES[game]
+    (game_dir / 'mod').mkdir(parents=True, exist_ok=True)
+    set_enabled_mods(game_dir, [])
+    return game_dir
+
+
+def set_enabled_mods(game_dir: pathlib.Path, desc_paths):
+    with (game_dir / 'dlc_load.json').open('w') as json_file:
+        json.dump({'enabled_mods': list(desc_paths), 'disabled_dlcs': []}, json_file)
+
+
+def add_workshop_mod(game_dir: pathlib.Path, bin_path: pathlib.Path, workshop_id):
+    # what the paradox launcher writes for a subscribed mod: a ugc descriptor pointing outside mod/
+    desc_path = game_dir / 'mod' / f'ugc_{workshop_id}.mod'
+    desc_path.write_text(f'name="workshop {workshop_id}"\narchive="{bin_path.as_posix()}"\n')
+    return f'mod/{desc_path.name}'
+
@@ -5,86 +5,148 @@ import subprocess
 import sys
 
 from pdxModTool.cli import parser, parser_build, parser_install, parser_send, parser_recv, parser_update, \
-    parser_mkLocal, parser_open
+    parser_mkLocal, parser_open, parser_list, parser_watch
+from pdxModTool import config, metrics
+from pdxModTool.batch import BatchBuilder
+from pdxModTool.cache import ArtifactCache
 from pdxModTool.client import Client
+from pdxModTool.compression import COMPRESSION
+from pdxModTool.handler import PathHandler
 from pdxModTool.pdxmod import PDXMod
 from pdxModTool.server import Server
-from pdxModTool.util import get_mod_dir, get_enabled_mod_paths, update_dlc_load
+from pdxModTool.swarm import Swarm, SwarmClient
+from pdxModTool.registry import ModRegistry, get_enabled_mod_paths
+from pdxModTool.scanner import ModIgnore, scan_tree
+from pdxModTool.util import get_game_dir, get_mod_dir, update_dlc_load
 from pdxModTool.version import VERSION_NAME, CURRENT_VERSION
+from pdxModTool.watcher import watch
 
 
 def build(args):
     output_dir = args.output if args.output else args.path
     try:
-        with PDXMod(args.path, max_threads=args.threads) as mod:
-            mod.build(output_dir, desc=args.descriptor)
+        with PDXMod(args.path, max_threads=args.threads, memory_budget=args.memory) as mod:
+            mod.build(output_dir, desc=args.descriptor, incremental=args.incremental, in_place=args.in_place,
+                      compression=COMPRESSION.get(args.compression), level=args.level)
     except FileNotFoundError as e:
         logging.error(f'{e}: mod source not found: {args.path}')
+    except PermissionError as e:
+        logging.error(f'{e}: could not build {args.path}')
 
 
 def install(args):
     output_dir = get_mod_dir(args.game)
     path = pathlib.Path(args.path)
-
-    def build_mod(mod_path):
-        with PDXMod(mod_path, max_threads=args.threads) as mod:
-            mod.build(output_dir, desc=True, backup=args.backup)
+    build_args = dict(desc=True, backup=args.backup, incremental=args.incremental, in_place=args.in_place,
+                      compression=COMPRESSION.get(args.compression), level=args.level)
 
     if path.is_dir() and not (path / "descriptor.mod").exists():
-        for path in path.iterdir():
-            if path.suffix == ".zip":
-                build_mod(path)
+        batch = BatchBuilder(max_threads=args.threads, memory_budget=args.memory, jobs=args.jobs)
+        batch.build(sorted(p for p in path.iterdir() if p.suffix == ".zip"), output_dir, **build_args)
     else:
-        build_mod(path)
+        with PDXMod(path, max_threads=args.threads, memory_budget=args.memory) as mod:
+            mod.build(output_dir, **build_args)
+
+
+def watch_mod(args):
+    output_dir = get_mod_dir(args.game)
+    build_args = dict(compression=COMPRESSION.get(args.compression), level=args.level)
+
+    if not args.path.is_dir():
+        logging.error(f'watch needs a mod source folder: {args.path}')
+        return
+    with PDXMod(args.path, max_threads=args.threads, memory_budget=args.memory) as mod:
+        mod.build(output_dir, desc=True, in_place=True, **build_args)
+        watch(mod, output_dir, poll=args.poll, interval=args.interval, **build_args)
 
 
 def send(args):
-    server = Server(args.game, args.ip, args.port)
+    registry = ModRegistry.load(args.game)
+    server = Server(args.game, args.ip, args.port, persist=args.persist, sync=args.sync, registry=registry,
+                    session=args.session, window=args.window, streams=args.streams, compress=args.compress)
 
-    for path in get_enabled_mod_paths(args.game):
-        if args.only:
-            if args.only == path.stem:
-                server.files.append(path)
-            else:
+    for desc_path, mod_path, _ in registry.enabled():
+        for path in (desc_path, mod_path):
+            if args.only and args.only != path.stem:
                 continue
-        else:
             server.files.append(path)
 
     logging.info(f'preparing {len(server.files)} to send')
+    if args.swarm:
+        server.swarm = Swarm(args.game, server.files)
     server.start()
 
 
 def recv(args):
-    client = Client()
-    client.connect(args.server_ip, args.port)
+    if args.swarm:
+        return recv_swarm(args)
+    client = Client(args.streams)
+    try:
+        client.connect(args.server_ip, args.port, retries=args.retries)
+    except ConnectionError as e:
+        # dlc_load is left alone rather than pointed at what only partly arrived
+        logging.error(e)
+        sys.exit(1)
     if args.dlc_load:
         update_dlc_load(client.game, client.desc_paths)
 
 
+def recv_swarm(args):
+    client = SwarmClient()
+    try:
+        client.fetch(args.server_ip, args.port)
+    except ConnectionError as e:
+        logging.error(e)
+        sys.exit(1)
+    if args.dlc_load:
+        update_dlc_load(client.game, client.desc_paths)
+    if args.seed:
+        server = Server(client.game, port=args.seed_port, persist=True)
+        server.files = client.paths
+        # descriptors were rewritten for this machine and no longer match the chunk map, only the
+        # origin serves them to swarm clients
+        archives = [path for path in client.paths if path.suffix != '.mod']
+        server.swarm = Swarm(client.game, archives, client.chunk_map)
+        client.seed(server)
+
+
+def folder_size(path):
+    return sum(src.stat.st_size for src in scan_tree(path, ModIgnore.load(path, PathHandler.IGNORE)))
+
+
+def list_mods(args):
+    registry = ModRegistry.load(args.game)
+    for desc_path, mod_path, record in registry.enabled():
+        if not record['mod']:
+            size = 'missing'
+        elif mod_path.is_dir():
+            # a folder's own size says nothing about what is in it
+            size = f'{registry.content_size(record, folder_size) / 1024 ** 2:.1f} MiB'
+        else:
+            size = f'{record["mod"][0] / 1024 ** 2:.1f} MiB'
+        print(f'{record["name"]:<40} {size:>12}  {mod_path}')
+    registry.save()
+
+
 def update(args):
     uri = f'https://github.com/arashm35/pdxModTool{args.branch}#egg=pdxModTool'
     subprocess.run([sys.executable, '-m', 'pip', 'install', '-U', '--user', '-e', f'git+{uri}'])
 
 
 def mk_local(args):
-    mods = get_enabled_mod_paths(args.game, ordered=True)
-    mods = list(filter(lambda x: x[1].parent.name != 'mod', mods))
-    end_descriptors = list(filter(lambda x: x.suffix == '.mod', get_enabled_mod_paths(args.game)))
-    end_descriptors = list(filter(lambda x: x not in [m[0] for m in mods], end_descriptors))
+    mod_dir = get_mod_dir(args.game)
+    enabled = get_enabled_mod_paths(args.game, ordered=True)
+    mods = list(filter(lambda x: x[1].parent.name != 'mod', enabled))
     logging.info(f'making local copies for {len(mods)} mods')
-    for desc_path, src_path in mods:
-        src_path: pathlib.Path
-        desc_path: pathlib.Path
-        logging.debug(f'making local of {src_path}, {desc_path}')
-
-        try:
-            with PDXMod(src_path, max_threads=args.threads) as mod:
-                mod.build(get_mod_dir(args.game), desc=True, backup=args.backup)
-                desc_path = get_mod_dir(args.game) / f'{mod.name}.mod'
-                end_descriptors.append(desc_path)
-        except FileNotFoundError:
-            logging.error(f'Could not make copy of {src_path}')
 
+    cache = None if args.no_cache else ArtifactCache.load(get_game_dir(args.game) / config.CACHE_DIR, args.cache_size)
+    batch = BatchBuilder(max_threads=args.threads, memory_budget=args.memory, jobs=args.jobs, cache=cache)
+    names = batch.build([src_path for _, src_path in mods], mod_dir, desc=True, backup=args.backup,
+                        compression=COMPRESSION.get(args.compression), level=args.level)
+
+    # keep the load order of dlc_load; mods that failed to build keep their original descriptor
+    local_descriptors = {desc_path: mod_dir / f'{name}.mod' for (desc_path, _), name in zip(mods, names) if name}
+    end_descriptors = [local_descriptors.get(desc_path, desc_path) for desc_path, _ in enabled]
     end_descriptors = list(f'{desc.parent.name}/{desc.name}' for desc in end_descriptors)
     if args.dlc_load:
         update_dlc_load(args.game, end_descriptors)
@@ -104,6 +166,8 @@ def main():
     parser_update.set_defaults(func=update)
     parser_mkLocal.set_defaults(func=mk_local)
     parser_open.set_defaults(func=openGamePath)
+    parser_list.set_defaults(func=list_mods)
+    parser_watch.set_defaults(func=watch_mod)
 
     args = parser.parse_args()
 
@@ -121,7 +185,12 @@ def main():
     #     return
 
     try:
-        args.func(args)
+        if args.profile or args.metrics_json or args.cprofile:
+            command = args.func.__name__
+            metrics.run(args.func, args, command, show=args.profile, json_path=args.metrics_json,
+                        profile_path=args.cprofile)
+        else:
+            args.func(args)
     except KeyboardInterrupt:
         logging.warning(f'KeyboardInterrupt')
         quit()
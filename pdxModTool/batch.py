@@ -0,0 +1,84 @@
+import logging
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
+
+from tqdm import tqdm
+
+from pdxModTool import config
+from pdxModTool.pdxmod import PDXMod
+
+
+class SharedProgress:
+    # one progress bar fed by the writers of every mod being built
+
+    def __init__(self, desc):
+        self._progress = tqdm(total=0, desc=desc, unit='B', unit_scale=True, unit_divisor=1024,
+                              mininterval=config.PROGRESS_INTERVAL)
+        self._lock = threading.Lock()
+
+    def add_total(self, size):
+        with self._lock:
+            self._progress.total += size
+            self._progress.refresh()
+
+    def update(self, n):
+        with self._lock:
+            self._progress.update(n)
+
+    def close(self):
+        self._progress.close()
+
+
+class BatchBuilder:
+    # builds several mods at once. the thread and memory budgets are shared out between the mods
+    # in flight, so the batch as a whole stays within what a single build would use
+
+    def __init__(self, max_threads=None, memory_budget=None, jobs=None, cache=None):
+        self.jobs = jobs if jobs else config.BATCH_JOBS
+        self.cache = cache
+        max_threads = max_threads if max_threads else 4
+        memory_budget = memory_budget if memory_budget else config.MEMORY_BUDGET
+
+        self.threads_per_mod = max(1, max_threads // self.jobs)
+        self.memory_per_mod = max(config.CHUNK_SIZE, memory_budget // self.jobs)
+        self.errors = {}
+
+    def build(self, paths, mod_dir, **build_args):
+        # returns the built mod names in the order of paths, None where a build failed
+        paths = list(paths)
+        self.errors = {}
+        progress = SharedProgress(f'building {len(paths)} mods')
+        try:
+            with ThreadPoolExecutor(max_workers=min(self.jobs, len(paths)) or 1) as e:
+                futures = [e.submit(self.build_mod, path, mod_dir, progress, **build_args) for path in paths]
+                names = []
+                for path, future in zip(paths, futures):
+                    try:
+                        names.append(future.result())
+                    except Exception as error:
+                        self.errors[path] = error
+                        names.append(None)
+        finally:
+            progress.close()
+            if self.cache:
+                self.cache.save()
+
+        for path, error in self.errors.items():
+            logging.error(f'could not build {path}: {type(error).__name__}: {error}')
+        logging.info(f'built {len(paths) - len(self.errors)} of {len(paths)} mods')
+        return names
+
+    def build_mod(self, path, mod_dir, progress, **build_args):
+        key = None
+        if self.cache:
+            key = self.cache.source_key(path, compression=build_args.get('compression'),
+                                        level=build_args.get('level'), desc=build_args.get('desc'))
+            if name := self.cache.restore(key, mod_dir):
+                return name
+
+        with PDXMod(path, max_threads=self.threads_per_mod, memory_budget=self.memory_per_mod) as mod:
+            progress.add_total(mod.handler.size)
+            mod.build(mod_dir, progress=progress, **build_args)
+        if key:
+            self.cache.store(key, mod.name, mod_dir)
+        return mod.name
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+import threading
+import time
+
+from pdxModTool import config
+from pdxModTool.handler import PathHandler
+from pdxModTool.registry import stat_key
+from pdxModTool.scanner import ModIgnore, scan_tree
+
+
+class ArtifactCache:
+    # the zip and descriptor mklocal made from a workshop mod, filed under a key of the source's
+    # identity. artifacts are hard links to the built zips where the filesystem allows, so the
+    # cache costs no extra space until a mod is rebuilt or deleted. least recently used artifacts
+    # are evicted once they add up to more than limit bytes
+    VERSION = 1
+
+    def __init__(self, root: pathlib.Path, limit=None):
+        self.root = root
+        self.index_path = root / 'index.json'
+        self.limit = limit if limit else config.CACHE_SIZE
+        self.entries = {}
+
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.root})'
+
+    @classmethod
+    def load(cls, root: pathlib.Path, limit=None):
+        cache = cls(root, limit)
+        if not cache.index_path.exists():
+            return cache
+
+        try:
+            with cache.index_path.open('r') as index_file:
+                data = json.load(index_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'{e}: starting over with an empty artifact cache {cache.root}')
+            return cache
+
+        if data.get('version') == cls.VERSION:
+            cache.entries = data['entries']
+        return cache
+
+    def save(self):
+        with self._lock:
+            self._evict()
+            if not self._dirty:
+                return
+            self.root.mkdir(parents=True, exist_ok=True)
+            temp_path = self.index_path.with_name(f'{self.index_path.name}{config.TEMP_SUFFIX}')
+            with temp_path.open('w') as index_file:
+                json.dump({'version': self.VERSION, 'entries': self.entries}, index_file)
+            os.replace(temp_path, self.index_path)
+            self._dirty = False
+
+    @staticmethod
+    def source_key(src_path: pathlib.Path, **options):
+        # path, size and mtime, plus a fast hash: the head and tail of an archive (the tail holds
+        # its central directory), or every file's name, size and mtime for a folder
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(json.dumps([str(src_path), sorted(options.items())], default=str).encode())
+        if src_path.is_dir():
+            for src in scan_tree(src_path, ModIgnore.load(src_path, PathHandler.IGNORE)):
+                digest.update(f'{src.arcname}\0{src.stat.st_size}\0{src.stat.st_mtime_ns}\n'.encode())
+        else:
+            stat = src_path.stat()
+            digest.update(f'{stat.st_size}\0{stat.st_mtime_ns}'.encode())
+            with src_path.open('rb') as src_file:
+                digest.update(src_file.read(config.CACHE_SAMPLE))
+                src_file.seek(max(0, stat.st_size - config.CACHE_SAMPLE))
+                digest.update(src_file.read(config.CACHE_SAMPLE))
+        return digest.hexdigest()
+
+    def artifact_path(self, key):
+        return self.root / f'{key}.zip'
+
+    def restore(self, key, mod_dir: pathlib.Path):
+        # name of the mod if key's artifact is (now) in mod_dir, None when it has to be built
+        with self._lock:
+            if not (entry := self.entries.get(key)):
+                return None
+            zip_path = mod_dir / f'{entry["name"]}.zip'
+            artifact = self.artifact_path(key)
+
+            if stat_key(zip_path) == entry['zip']:
+                logging.info(f'{entry["name"]} is up to date')
+            elif stat_key(artifact) == entry['artifact']:
+                logging.info(f'restoring {entry["name"]} from cache')
+                self._place(artifact, zip_path)
+                entry['zip'] = stat_key(zip_path)
+            else:
+                logging.debug(f'cached {entry["name"]} is gone, rebuilding it')
+                self._drop(key)
+                return None
+
+            if entry['descriptor'] is not None:
+                desc_path = mod_dir / f'{entry["name"]}.mod'
+                if not desc_path.exists() or desc_path.read_text(encoding='utf-8', errors='surrogateescape') \
+                        != entry['descriptor']:
+                    desc_path.write_text(entry['descriptor'], encoding='utf-8', errors='surrogateescape')
+            entry['used'] = time.time()
+            self._dirty = True
+            return entry['name']
+
+    def store(self, key, name, mod_dir: pathlib.Path):
+        zip_path = mod_dir / f'{name}.zip'
+        desc_path = mod_dir / f'{name}.mod'
+        if not zip_path.exists():
+            return
+
+        with self._lock:
+            self.root.mkdir(parents=True, exist_ok=True)
+            artifact = self.artifact_path(key)
+            self._place(zip_path, artifact)
+            self.entries[key] = {
+                'name': name,
+                'zip': stat_key(zip_path),
+                'artifact': stat_key(artifact),
+                'descriptor': desc_path.read_text(encoding='utf-8', errors='surrogateescape')
+                if desc_path.exists() else None,
+                'used': time.time(),
+            }
+            self._dirty = True
+
+    @staticmethod
+    def _place(src: pathlib.Path, dest: pathlib.Path):
+        # hard link where possible, copy otherwise; either way dest appears whole or not at all
+        temp_path = dest.with_name(f'{dest.name}{config.TEMP_SUFFIX}')
+        temp_path.unlink(missing_ok=True)
+        try:
+            os.link(src, temp_path)
+        except OSError:
+            shutil.copy2(src, temp_path)
+        os.replace(temp_path, dest)
+
+    def _drop(self, key):
+        self.entries.pop(key, None)
+        self.artifact_path(key).unlink(missing_ok=True)
+        self._dirty = True
+
+    def _evict(self):
+        size = sum(entry['artifact'][0] for entry in self.entries.values() if entry['artifact'])
+        for key, entry in sorted(self.entries.items(), key=lambda item: item[1]['used']):
+            if size <= self.limit:
+                break
+            logging.debug(f'evicting {entry["name"]} from cache')
+            size -= entry['artifact'][0] if entry['artifact'] else 0
+            self._drop(key)
@@ -1,7 +1,16 @@
 import argparse
 import pathlib
 
-from pdxModTool import game_options
+from pdxModTool import config, game_options
+from pdxModTool.compression import COMPRESSION
+
+
+def memory_budget(value):
+    # anything below one chunk leaves the pipeline nothing to read into
+    budget = int(value)
+    if budget < config.CHUNK_SIZE:
+        raise argparse.ArgumentTypeError(f'memory budget must be at least {config.CHUNK_SIZE} bytes')
+    return budget
 
 parser = argparse.ArgumentParser(
     prog='pdxModTool',
@@ -18,16 +27,29 @@ parser_recv = subparsers.add_parser('recv', help='receive mods from server.')
 parser_update = subparsers.add_parser('update', help='update to latest version of pdxModTool from github.')
 parser_mkLocal = subparsers.add_parser('mklocal', help='make local copies of steamWS mods.')
 parser_open = subparsers.add_parser('open', help='open mod directory of game.')
+parser_list = subparsers.add_parser('list', help='list enabled mods of game.')
+parser_watch = subparsers.add_parser('watch', help='install mod and keep it updated as its files change.')
 
 # open arguments
 parser_open.add_argument('game', metavar='game', choices=game_options.CLI_CHOICES, action='store',
                          help='pdx game to open mod folder of.')
 
+# list arguments
+parser_list.add_argument('game', metavar='game', choices=game_options.CLI_CHOICES, action='store',
+                         help='pdx game to list enabled mods of.')
+
 # version argument for main parser
 parser.add_argument('-v', '--version', action='store_true', help='show version.')
 parser.add_argument('-debug', action='store_true', help='enable debug mode.')
 parser.add_argument('-t', '--threads', metavar='thread_count', action='store', type= int,
                     help='set number of max threads. default: 2.')
+parser.add_argument('-m', '--memory', metavar='bytes', action='store', type=memory_budget,
+                    help='set memory budget of a build in bytes. default: 67108864.')
+parser.add_argument('--profile', action='store_true', help='print time spent per stage when done.')
+parser.add_argument('--metrics-json', metavar='path', action='store', type=pathlib.Path,
+                    help='write time spent per stage and counters as json when done.')
+parser.add_argument('--cprofile', metavar='path', action='store', type=pathlib.Path,
+                    help='run under cProfile and write its stats to path, merged over all threads.')
 
 # build arguments
 parser_build.add_argument('-p', '--path', action='store', default=pathlib.Path().cwd(), type=pathlib.Path,
@@ -38,6 +60,15 @@ parser_build.add_argument('-o', '--output', metavar='', action='store', type=pat
 
 parser_build.add_argument('-d', '--descriptor', action='store_true', help='build with exterior descriptor file.')
 
+parser_build.add_argument('--incremental', action='store_true',
+                          help='reuse unchanged entries of the previous build archive.')
+parser_build.add_argument('--in-place', action='store_true',
+                          help='update the previous build archive in place, writing only what changed.')
+
+parser_build.add_argument('-c', '--compression', choices=COMPRESSION, action='store',
+                          help='compress archive entries, auto to choose per entry. default: store.')
+parser_build.add_argument('--level', action='store', type=int, help='set compression level.')
+
 # install arguments
 parser_install.add_argument('-p', '--path', action='store', default=pathlib.Path().cwd(), type=pathlib.Path,
                             help='path of mod root folder.', )
@@ -47,6 +78,33 @@ parser_install.add_argument('game', metavar='game', choices=game_options.CLI_CHO
 
 parser_install.add_argument('-b', '--backup', action='store_true', help='set flag for backup.')
 
+parser_install.add_argument('--incremental', action='store_true',
+                            help='reuse unchanged entries of the installed archive.')
+parser_install.add_argument('--in-place', action='store_true',
+                            help='update the installed archive in place, writing only what changed.')
+
+parser_install.add_argument('-c', '--compression', choices=COMPRESSION, action='store',
+                            help='compress archive entries, auto to choose per entry. default: store.')
+parser_install.add_argument('--level', action='store', type=int, help='set compression level.')
+
+parser_install.add_argument('-j', '--jobs', metavar='', action='store', type=int,
+                            help='set number of mods built at once when installing a folder. default: 4.')
+
+# watch arguments
+parser_watch.add_argument('-p', '--path', action='store', default=pathlib.Path().cwd(), type=pathlib.Path,
+                          help='path of mod root folder.', )
+
+parser_watch.add_argument('game', metavar='game', choices=game_options.CLI_CHOICES, action='store',
+                          help='set pdx game title to install mod for.')
+
+parser_watch.add_argument('-c', '--compression', choices=COMPRESSION, action='store',
+                          help='compress archive entries, auto to choose per entry. default: store.')
+parser_watch.add_argument('--level', action='store', type=int, help='set compression level.')
+
+parser_watch.add_argument('--poll', action='store_true', help='poll for changes instead of using inotify.')
+parser_watch.add_argument('--interval', metavar='seconds', action='store', type=float,
+                          help='set seconds between polls. default: 1.0.')
+
 # send arguments
 parser_send.add_argument('game', metavar='game', choices=game_options.CLI_CHOICES, action='store',
                          help='set pdx game title to send mods for.')
@@ -56,10 +114,36 @@ parser_send.add_argument('-p', '--port', metavar='', action='store', type=int, h
 
 parser_send.add_argument('--only', action='store', type=str, help='send only specified mod.')
 
+parser_send.add_argument('--persist', action='store_true', help='keep serving clients until stopped.')
+
+parser_send.add_argument('--sync', action='store_true', help='only send what clients are missing.')
+
+parser_send.add_argument('--session', metavar='clients', action='store', type=int,
+                         help='wait for this many clients, then send to all of them at once.')
+parser_send.add_argument('--window', metavar='seconds', action='store', type=float,
+                         help='with --session, start after this many seconds with whoever has joined.')
+
+parser_send.add_argument('--streams', metavar='', action='store', type=int,
+                         help='set most connections a client may receive over at once. default=4, 1 turns it off.')
+
+parser_send.add_argument('--compress', metavar='codec', nargs='?', const='zlib', choices=['zlib', 'lzma'],
+                         help='compress files that shrink well on the way, with zlib or lzma. default codec=zlib.')
+
+parser_send.add_argument('--swarm', action='store_true',
+                         help='let swarm clients fetch chunks from each other as well as from this server.')
+
 # recv arguments
 parser_recv.add_argument('server_ip', metavar='server_ip', action='store', help='set target server ip. ')
 parser_recv.add_argument('-p', '--port', metavar='', action='store', type=int, help='set server port. default=65432.')
 parser_recv.add_argument('--dlc_load', action='store_true', help="update dlc_load.")
+parser_recv.add_argument('--streams', metavar='', action='store', type=int,
+                         help='set number of connections to receive over at once. default=1.')
+parser_recv.add_argument('--swarm', action='store_true', help='fetch chunks from the server and its peers at once.')
+parser_recv.add_argument('--seed', action='store_true', help='with --swarm, keep serving the mods to other clients.')
+parser_recv.add_argument('--seed-port', metavar='', action='store', type=int, default=0,
+                         help='set port to seed on. default: any free port.')
+parser_recv.add_argument('-r', '--retries', metavar='', action='store', type=int, default=0,
+                         help='reconnect and resume this many times when the connection drops. default=0.')
 
 # update arguments
 parser_update.add_argument('-branch', metavar='branch', action='store', default='', type=str, required=False,
@@ -71,3 +155,15 @@ parser_mkLocal.add_argument('game', metavar='game', choices=game_options.CLI_CHO
 parser_mkLocal.add_argument('-b', '--backup', action='store_true', help='set flag for backup.')
 
 parser_mkLocal.add_argument('--dlc_load', action='store_true', help='enabled local mods after creation.')
+
+parser_mkLocal.add_argument('-c', '--compression', choices=COMPRESSION, action='store',
+                            help='compress archive entries, auto to choose per entry. '
+                                 'default: keep workshop compression.')
+parser_mkLocal.add_argument('--level', action='store', type=int, help='set compression level.')
+
+parser_mkLocal.add_argument('-j', '--jobs', metavar='', action='store', type=int,
+                            help='set number of mods built at once. default: 4.')
+
+parser_mkLocal.add_argument('--no-cache', action='store_true', help='rebuild every mod, ignoring the local cache.')
+parser_mkLocal.add_argument('--cache-size', metavar='bytes', action='store', type=int,
+                            help='set size limit of the local cache in bytes. default: 8589934592.')
@@ -1,77 +1,314 @@
 import logging
+import os
 import pathlib
 import socket
+import threading
+import time
 
 from tqdm import tqdm
 
-from pdxModTool import config
-from pdxModTool.util import get_mod_dir, make_backup, update_desc_archive_path
+from pdxModTool import config, metrics
+from pdxModTool.newzipfile import ZipFile
+from pdxModTool.protocol import connect_channel, join_transfer, Channel, FrameChannel, ProtocolError, PAYLOAD, END, \
+    PLAN, RANGE, load_json
+from pdxModTool.receiver import ReceiveEngine
+from pdxModTool.resume import PartialFile, ChecksumError, partial_states, checksum
+from pdxModTool.sync import local_manifest, encode, decode, entry_key, planned_info, local_info, remote_size, \
+    SAME, FILE, DELTA, LOCAL
+from pdxModTool.util import get_mod_dir, make_backup, update_desc_archive_path, write_at
 
 
 class Client:
 
-    def __init__(self):
+    def __init__(self, streams=None):
         self._local_socket = None
+        self._rtt = None
+        self._receiver = None
         self.game = None
         self.desc_paths = []
+        # connections to ask the server to spread the transfer over, only if asked for
+        self.streams = streams if streams else 1
+        # files finished in this session, offered as fully resumed when reconnecting
+        self._completed = {}
 
-    def connect(self, server_ip, port=None):
+    def connect(self, server_ip, port=None, retries=0):
         if not port:
             port = config.default_port
 
-        logging.info(f'connecting to server at {server_ip}:{port}')
-        self._local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        try:
-            self._local_socket.connect((server_ip, port))
+        for attempt in range(retries + 1):
+            if attempt:
+                logging.info(f'reconnecting in {config.RETRY_DELAY}s ({attempt}/{retries})')
+                time.sleep(config.RETRY_DELAY)
 
-        except ConnectionRefusedError:
-            logging.info(f'No connection could be made to {server_ip}, {port}')
-            return
+            logging.info(f'connecting to server at {server_ip}:{port}')
+            self._local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            start = time.perf_counter()
+            try:
+                self._local_socket.connect((server_ip, port))
+                self._rtt = time.perf_counter() - start
+            except ConnectionRefusedError:
+                logging.info(f'No connection could be made to {server_ip}, {port}')
+                continue
+
+            try:
+                self.__make_connection()
+                return
+            except (ConnectionError, ChecksumError) as e:
+                logging.error(f'{e}: transfer interrupted')
+            finally:
+                self._local_socket.close()
 
-        self.__make_connection()
+        raise ConnectionError(f'could not receive from {server_ip}:{port} in {retries + 1} attempts')
 
     def __make_connection(self):
-        header = self.get_header().strip()
-        logging.debug(f'received header: {header.strip()}')
-        count, self.game = header.split(config.SEPARATOR)
+        channel = connect_channel(self._local_socket, self.streams, self._rtt)
+        logging.debug(f'protocol v{channel.version}, game {channel.game}, {channel.count} files')
+        self.game = channel.game
+        self._receiver = ReceiveEngine(self._local_socket)
+
+        if channel.sync:
+            with metrics.timer('recv.manifest'):
+                manifest = encode(local_manifest(get_mod_dir(self.game)))
+            logging.debug(f'sending manifest of {len(manifest)} bytes')
+            channel.send_manifest(manifest)
+        if channel.resume:
+            partials = partial_states(get_mod_dir(self.game))
+            logging.debug(f'resumable files: {list(partials)}')
+            channel.send_partials({**partials, **self._completed})
+
+        if channel.token:
+            self.__receive_streams(channel)
+        else:
+            while announcement := channel.next_file():
+                self.__receive_file(channel, *announcement)
 
-        for i in range(int(count)):
-            self.__receive_file()
+        channel.close()
+
+    def __receive_streams(self, channel: FrameChannel):
+        # the server announces every file up front, then sends ranges of them over all connections at
+        # once. each range is written where it belongs, and every file is verified once complete
+        streams = [channel]
+        try:
+            for _ in range(channel.streams - 1):
+                sock = socket.create_connection(self._local_socket.getpeername())
+                streams.append(join_transfer(sock, channel.token))
+        except OSError as e:
+            logging.warning(f'{e}: receiving over {len(streams)} connections')
+        logging.debug(f'receiving over {len(streams)} connections')
+
+        _, _, _, size = channel.recv_frame(PLAN)
+        entries = load_json(channel.recv_exact(size), list)
+        mod_dir = get_mod_dir(self.game)
+        files = {}
+        errors = []
+        try:
+            for entry in entries:
+                if entry['kind'] == FILE:
+                    files[entry['name']] = self.__open_part(mod_dir / entry['name'], entry)
 
-        self._local_socket.close()
+            total = sum(entry['size'] - entry.get('offset', 0) for entry in entries if entry['kind'] == FILE)
+            progress = tqdm(total=total, desc='Receiving', unit='B', unit_scale=True, unit_divisor=1024,
+                            mininterval=config.PROGRESS_INTERVAL)
+            workers = [threading.Thread(target=self.__receive_ranges, args=(stream, streams, files, progress, errors),
+                                        daemon=True) for stream in streams]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            progress.close()
+        finally:
+            for file in files.values():
+                file.close()
+            for stream in streams[1:]:
+                stream.close()
+        if errors:
+            raise errors[0]
 
-    def __receive_file(self):
-        name_header = self.get_header()
-        size_header = self.get_header()
-        logging.debug(f'received file header: {name_header.strip(), size_header.strip()}')
+        for entry in entries:
+            path = mod_dir / entry['name']
+            metrics.count('recv.files')
+            if entry['kind'] == FILE:
+                self.__complete_part(path, entry)
+            elif entry['kind'] == SAME:
+                self.__finish_part(path, entry)
+            else:
+                raise ProtocolError(f'unknown file kind {entry["kind"]} for {path.name}')
+            if path.suffix == '.mod':
+                if f'mod/{path.name}' not in self.desc_paths:
+                    self.desc_paths.append(f'mod/{path.name}')
+                update_desc_archive_path(path)
+
+    @staticmethod
+    def __open_part(path: pathlib.Path, entry):
+        # ranges land anywhere in the file, so the resume state keeps vouching only for the prefix
+        # it was saved with. the server sends everything after that prefix
+        partial = PartialFile(path)
+        offset = entry.get('offset', 0)
+        if offset:
+            state = partial.load()
+            if not state or state['offset'] != offset:
+                raise ProtocolError(f'server resumed {path.name} at {offset}, no matching partial download')
+            logging.info(f'resuming {path.name} at {offset} of {entry["size"]} bytes')
+        else:
+            partial.start(entry['id'], entry['size'])
+        part_file = partial.part_path.open('r+b' if offset else 'wb')
+        part_file.truncate(entry['size'])
+        return part_file
+
+    def __receive_ranges(self, stream: FrameChannel, streams, files, progress, errors):
+        # deltas are only ever announced on the first connection
+        try:
+            while True:
+                frame_type, _, meta, size = stream.recv_frame()
+                if frame_type == END:
+                    return
+                if frame_type == PAYLOAD and stream is streams[0]:
+                    self.__receive_file(stream, meta.pop('name'), meta.pop('kind'), meta.pop('size', size), meta)
+                    continue
+                if frame_type != RANGE or meta.get('name') not in files:
+                    raise ProtocolError(f'unexpected frame {frame_type} {meta}')
+
+                file, offset = files[meta['name']], meta['offset']
+                if meta.get('codec'):
+                    chunks = stream.recv_blocks(meta['codec'], meta['size'])
+                else:
+                    chunks = stream.recv_chunks(size)
+                for chunk in chunks:
+                    write_at(file, chunk, offset)
+                    offset += len(chunk)
+                    progress.update(len(chunk))
+                metrics.count('recv.ranges')
+        except (OSError, ProtocolError, ChecksumError) as e:
+            if stream is not streams[0]:
+                # the server sends this connection's unfinished range again over one of the others
+                logging.warning(f'{e}: dropping a connection, receiving over the rest')
+                stream.close()
+                return
+            errors.append(e)
+            # the server would otherwise wait on the other connections for ranges nobody reads
+            for other in streams:
+                try:
+                    other.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def __complete_part(self, path: pathlib.Path, entry):
+        partial = PartialFile(path)
+        with metrics.timer('recv.verify'):
+            crc = checksum(partial.part_path)
+        if crc != entry['crc32']:
+            partial.discard()
+            raise ChecksumError(f'{path.name} failed verification, it will be downloaded again')
 
-        path: pathlib.Path = get_mod_dir(self.game) / name_header.strip()
         if path.exists():
             make_backup(path)
+        partial.complete()
+        self._completed[path.name] = {'id': entry['id'], 'offset': entry['size'], 'crc32': crc}
 
-        logging.debug(f'download file to {path}')
+    def __finish_part(self, path: pathlib.Path, meta):
+        # the server vouches for a partial download by its id and crc once all of it arrived. one
+        # that was never moved into place, the connection lost right before, is finished here
+        partial = PartialFile(path)
+        state = partial.load()
+        if not state or 'id' not in meta or state['offset'] != state['size'] \
+                or (state['id'], state['crc32']) != (meta['id'], meta['crc32']):
+            logging.info(f'{path.name} is up to date')
+            return
 
-        progress = tqdm(range(int(size_header)), f"Receiving {name_header}", unit="B", unit_scale=True,
-                        unit_divisor=1024)
-        size = int(size_header)
-        size_received = 0
-
-        with path.open('wb') as inFile:
-            for _ in progress:
-                buffer_size = config.BUFFER_SIZE if config.BUFFER_SIZE < size - size_received else size - size_received
-                # if size_received == size:
-                #     break
-                bytes_read = self._local_socket.recv(buffer_size)
-                if not bytes_read:
-                    break
-                size_received += len(bytes_read)
-
-                inFile.write(bytes_read)
-                progress.update(len(bytes_read))
+        with metrics.timer('recv.verify'):
+            crc = checksum(partial.part_path)
+        if crc != meta['crc32']:
+            partial.discard()
+            raise ChecksumError(f'{path.name} failed verification, it will be downloaded again')
+        if path.exists():
+            make_backup(path)
+        partial.complete()
+        self._completed[path.name] = {'id': meta['id'], 'offset': state['size'], 'crc32': crc}
+        logging.info(f'{path.name} was complete, moved into place')
+
+    def __receive_file(self, channel: Channel, name, kind, size, meta):
+        logging.debug(f'received file header: {name, kind, size, meta}')
+        metrics.count('recv.files')
+
+        path: pathlib.Path = get_mod_dir(self.game) / name
+        if kind == SAME:
+            self.__finish_part(path, meta)
+        elif kind == FILE and channel.resume:
+            self.__receive_resumable(channel, path, size, meta)
+        elif kind == FILE:
+            if path.exists():
+                make_backup(path)
+            self.__receive_body(channel, path, size, meta.get('codec'))
+        elif kind == DELTA:
+            self.__patch_archive(channel, path, decode(channel.recv_exact(size)))
+        else:
+            raise ProtocolError(f'unknown file kind {kind} for {name}')
 
         if path.suffix == '.mod':
-            self.desc_paths.append(f'mod/{path.name}')
+            if f'mod/{path.name}' not in self.desc_paths:
+                self.desc_paths.append(f'mod/{path.name}')
             update_desc_archive_path(path)
 
-    def get_header(self):
-        return self._local_socket.recv(config.HEADER_SIZE).decode()
+    def __receive_body(self, channel: Channel, path: pathlib.Path, size, codec=None):
+        logging.debug(f'download file to {path}')
+
+        progress = tqdm(total=size, desc=f"Receiving {path.name}", unit="B", unit_scale=True, unit_divisor=1024,
+                        mininterval=config.PROGRESS_INTERVAL)
+        self._receiver.receive(path, size, progress, channel=channel, codec=codec)
+        progress.close()
+
+    def __receive_resumable(self, channel: Channel, path: pathlib.Path, size, meta):
+        partial = PartialFile(path)
+        offset = meta.get('offset', 0)
+        if offset:
+            state = partial.load()
+            if not state or state['offset'] != offset:
+                raise ProtocolError(f'server resumed {path.name} at {offset}, no matching partial download')
+            crc = state['crc32']
+            logging.info(f'resuming {path.name} at {offset} of {size} bytes')
+        else:
+            partial.start(meta['id'], size)
+            crc = 0
+
+        progress = tqdm(total=size, initial=offset, desc=f"Receiving {path.name}", unit="B", unit_scale=True,
+                        unit_divisor=1024, mininterval=config.PROGRESS_INTERVAL)
+        crc = self._receiver.receive(partial.part_path, size - offset, progress, offset, crc, partial.checkpoint,
+                                     channel, meta.get('codec'))
+        progress.close()
+
+        if crc != meta['crc32']:
+            partial.discard()
+            raise ChecksumError(f'{path.name} failed verification, it will be downloaded again')
+
+        if path.exists():
+            make_backup(path)
+        partial.complete()
+        self._completed[path.name] = {'id': meta['id'], 'offset': size, 'crc32': crc}
+
+    def __patch_archive(self, channel: Channel, path: pathlib.Path, plan):
+        logging.debug(f'patching {path} with {len(plan)} entries')
+        temp_path = path.with_name(f'{path.name}{config.TEMP_SUFFIX}')
+
+        progress = tqdm(total=remote_size(plan), desc=f"Patching {path.name}", unit="B", unit_scale=True,
+                        unit_divisor=1024)
+        with ZipFile(path, 'r') as local, ZipFile(temp_path, 'w') as patched:
+            local_infos = {entry_key(info): info for info in local.infolist()}
+            for entry in plan:
+                info, source = planned_info(entry)
+                if source == LOCAL:
+                    local_zip_info = local_infos[entry_key(info)]
+                    with local.open_raw(local_zip_info) as raw:
+                        patched.write_raw(local_info(local_zip_info, info.filename),
+                                          iter(lambda: raw.read(config.CHUNK_SIZE), b''))
+                else:
+                    patched.write_raw(info, self.__progress(channel.recv_chunks(info.compress_size), progress))
+        progress.close()
+
+        make_backup(path)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def __progress(chunks, progress):
+        for chunk in chunks:
+            yield chunk
+            progress.update(len(chunk))
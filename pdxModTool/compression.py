@@ -0,0 +1,52 @@
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA, _get_compressor
+
+COMPRESSION = {
+    'store': ZIP_STORED,
+    'deflate': ZIP_DEFLATED,
+    'bzip2': ZIP_BZIP2,
+    'lzma': ZIP_LZMA,
+    # chosen per entry by a CompressionPolicy
+    'auto': 'auto',
+}
+AUTO = COMPRESSION['auto']
+LZMA_EOS_FLAG = 0x02
+
+# archives opened by a worker process, kept for the lifetime of the pool
+_archives = {}
+
+
+def read_source(source):
+    kind, path, *member = source
+    if kind == 'zip':
+        if path not in _archives:
+            _archives[path] = ZipFile(path, 'r')
+        return _archives[path].read(member[0])
+
+    with open(path, 'rb') as src:
+        return src.read()
+
+
+def compress(data, compress_type, level=None):
+    compressor = _get_compressor(compress_type, level)
+    if compressor is None:
+        return data
+    return compressor.compress(data) + compressor.flush()
+
+
+def compress_source(source, compress_type, level=None):
+    data = read_source(source)
+    return compress(data, compress_type, level), zlib.crc32(data), len(data)
+
+
+def compressed_info(zip_info, compress_type, payload, crc, file_size):
+    info = ZipInfo(zip_info.filename, zip_info.date_time)
+    info.external_attr = zip_info.external_attr
+    info.extract_version = zip_info.extract_version
+    info.compress_type = compress_type
+    if compress_type == ZIP_LZMA:
+        info.flag_bits |= LZMA_EOS_FLAG
+    info.CRC = crc
+    info.compress_size = len(payload)
+    info.file_size = file_size
+    return info
@@ -3,3 +3,58 @@ HEADER_SIZE = 64
 SEPARATOR = '<SEPARATOR>'
 localHost = '0.0.0.0'
 default_port = 65432
+MANIFEST_SUFFIX = '.manifest'
+TEMP_SUFFIX = '.tmp'
+IGNORE_FILE = '.modignore'
+POLICY_FILE = '.modcompress'
+POLICY_SUFFIX = '.policy'
+REGISTRY_FILE = 'pdxModTool.registry.json'
+CACHE_DIR = 'pdxModTool.cache'
+CACHE_SIZE = 8 * 1024 ** 3
+CACHE_SAMPLE = 64 * 1024
+MMAP_READS = True
+MMAP_THRESHOLD = 256 * 1024
+CHUNK_SIZE = 1024 * 1024
+MEMORY_BUDGET = 64 * 1024 * 1024
+POLICY_SAMPLE = 128 * 1024
+POLICY_STORE_RATIO = 0.9
+POLICY_FAST_RATIO = 0.6
+POLICY_CACHE_SIZE = 100000
+WRITEV_SIZE = 1024 * 1024
+WRITEV_PARTS = 512
+WATCH_INTERVAL = 1.0
+WATCH_DEBOUNCE = 0.2
+COMPACT_RATIO = 0.25
+COMPACT_MIN = 16 * 1024 * 1024
+SENDFILE_SIZE = 16 * 1024 * 1024
+ACCEPT_TIMEOUT = 0.5
+SESSION_QUEUE = 16
+SESSION_BACKLOG = 64
+SESSION_LAG = 1.0
+SESSION_STALL = 10.0
+SWARM_CHUNK = 4 * 1024 * 1024
+SWARM_SOURCES = 4
+SWARM_TIMEOUT = 30.0
+TRANSFER_STREAMS = 4
+STREAM_RANGE = 8 * 1024 * 1024
+WIRE_BLOCK = 1024 * 1024
+WIRE_WORKERS = 4
+WIRE_SAMPLE = 64 * 1024
+WIRE_SAMPLES = 4
+WIRE_RATIO = 0.9
+WIRE_ZLIB_LEVEL = 1
+WIRE_LZMA_PRESET = 0
+RECV_BUFFER_SIZE = 1024 * 1024
+HANDSHAKE_TIMEOUT = 1.0
+LEGACY_WAIT = 0.5
+LEGACY_MIN = 0.05
+LEGACY_RTTS = 4
+RECV_BUFFER_MAX = 8 * 1024 * 1024
+RECV_BUFFERS = 4
+RECV_FILL_TIME = 0.05
+PROGRESS_INTERVAL = 0.5
+PARTIAL_SUFFIX = '.part'
+RESUME_SUFFIX = '.resume'
+RESUME_CHECKPOINT = 64 * 1024 * 1024
+RETRY_DELAY = 3.0
+BATCH_JOBS = 4
@@ -0,0 +1,270 @@
+import os
+import pathlib
+import re
+from functools import lru_cache
+
+# paradox script as used by .mod descriptors: key = value pairs, { } blocks holding pairs or bare
+# values, quoted strings and # comments. a string ends at its line at the latest, so a missing
+# quote or a path ending in a backslash costs one value, not the rest of the file. every token
+# keeps the whitespace and comments in front of it, so a parsed descriptor dumps back to exactly
+# the text it came from, and an edit only touches the tokens it changes.
+
+ENCODING = 'utf-8'
+ERRORS = 'surrogateescape'
+
+TOKEN = re.compile(r'''
+    (?P<trivia>(?:[\s\ufeff]+|\#[^\n]*)*)
+    (?:
+        (?P<string>"(?:[^"\\\n]|\\[^\n]?)*"?)
+      | (?P<op>[{}]|[<>!?]?=|[<>])
+      | (?P<word>[^\s\ufeff=<>!?{}"\#]+)
+    )?
+''', re.VERBOSE)
+
+OPERATORS = {'=', '<', '>', '<=', '>=', '!=', '?='}
+
+
+class DescriptorError(ValueError):
+
+    def __init__(self, message, line=None):
+        super(DescriptorError, self).__init__(f'line {line}: {message}' if line else message)
+        self.message = message
+        self.line = line
+
+
+class Token:
+    __slots__ = ('kind', 'text', 'trivia')
+
+    def __init__(self, kind, text, trivia=''):
+        self.kind = kind
+        self.text = text
+        self.trivia = trivia
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.kind}, {self.text!r})'
+
+    @property
+    def value(self):
+        if self.kind == 'string':
+            # a string missing its closing quote ran to the end of its line
+            body = self.text[1:-1] if len(self.text) > 1 and self.text.endswith('"') else self.text[1:]
+            return body.replace('\\"', '"').replace('\\\\', '\\')
+        return self.text
+
+    def dump(self):
+        return f'{self.trivia}{self.text}'
+
+
+def quote(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{value}"'
+
+
+def tokenize(text):
+    # yields tokens lazily; whatever follows the last token is returned as the generator's value
+    pos = 0
+    end = len(text)
+    while pos < end:
+        match = TOKEN.match(text, pos)
+        kind = match.lastgroup if match.lastgroup != 'trivia' else None
+        if kind is None:
+            if match.end() < end:
+                raise DescriptorError(f'unexpected {text[match.end()]!r}', text.count('\n', 0, match.end()) + 1)
+            return match.group('trivia')
+        yield Token(kind, match.group(kind), match.group('trivia'))
+        pos = match.end()
+    return ''
+
+
+class Tokens:
+    # tokenize(text), counting how far it got so an error can name its line
+
+    def __init__(self, text):
+        self.text = text
+        self.offset = 0
+        self._tokens = tokenize(text)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        token = next(self._tokens)
+        self.offset += len(token.trivia) + len(token.text)
+        return token
+
+    @property
+    def line(self):
+        return self.text.count('\n', 0, self.offset) + 1
+
+
+class Pair:
+    __slots__ = ('key', 'op', 'value')
+
+    def __init__(self, key: Token, op: Token, value):
+        self.key = key
+        self.op = op
+        self.value = value
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.key.value} {self.op.text} {self.value!r})'
+
+    def dump(self):
+        return f'{self.key.dump()}{self.op.dump()}{self.value.dump()}'
+
+
+class Block:
+    # the items of a file or of a { } block: Pairs and bare value Tokens, in order
+
+    def __init__(self, items=None, open_token=None, close_token=None):
+        self.items = items if items is not None else []
+        self.open_token = open_token
+        self.close_token = close_token
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.items!r})'
+
+    def dump(self):
+        text = ''.join(item.dump() for item in self.items)
+        if self.open_token:
+            return f'{self.open_token.dump()}{text}{self.close_token.dump()}'
+        return text
+
+    def pairs(self, key=None):
+        return [item for item in self.items if isinstance(item, Pair) and (key is None or item.key.value == key)]
+
+    def keys(self):
+        return list(dict.fromkeys(pair.key.value for pair in self.pairs()))
+
+    def values(self):
+        return [item.value for item in self.items if isinstance(item, Token)]
+
+    def get(self, key, default=None):
+        # the python value of the first pair with key: a str, or a Block for { } values
+        pairs = self.pairs(key)
+        return to_python(pairs[0].value) if pairs else default
+
+    def get_all(self, key):
+        # keys like tags or dependencies may legally appear more than once
+        return [to_python(pair.value) for pair in self.pairs(key)]
+
+    def set(self, key, value):
+        # replaces the value of the first pair with key, or appends a new pair on its own line
+        new_value = Token('string', quote(value))
+        if pairs := self.pairs(key):
+            new_value.trivia = pairs[0].value.trivia if isinstance(pairs[0].value, Token) else ''
+            pairs[0].value = new_value
+            return
+        trivia = '\n' if self.items or self.open_token else ''
+        self.items.append(Pair(Token('word', key, trivia), Token('op', '='), new_value))
+
+    def remove(self, key):
+        # drops every pair with key. the next item takes over the whitespace and comments that led
+        # the dropped pair, so the surrounding layout stays as it was
+        for pair in self.pairs(key):
+            index = self.items.index(pair)
+            del self.items[index]
+            if index < len(self.items):
+                following = self.items[index]
+                (following.key if isinstance(following, Pair) else following).trivia = pair.key.trivia
+
+
+class Descriptor(Block):
+
+    def __init__(self, items=None, trailing=''):
+        super(Descriptor, self).__init__(items)
+        self.trailing = trailing
+
+    def dump(self):
+        return f'{super(Descriptor, self).dump()}{self.trailing}'
+
+    def copy(self):
+        return parse(self.dump())
+
+    @property
+    def name(self):
+        return self.get('name')
+
+
+def to_python(value):
+    return value.value if isinstance(value, Token) else value
+
+
+def parse(text):
+    tokens = Tokens(text)
+    try:
+        items, trailing = parse_items(tokens, None)
+    except DescriptorError as e:
+        if e.line:
+            raise
+        raise DescriptorError(e.message, tokens.line) from None
+    return Descriptor(items, trailing)
+
+
+def parse_items(tokens, open_token):
+    # reads items until the matching close brace, or the end of the text at the top level
+    items = []
+    pending = None
+    while True:
+        try:
+            token = next(tokens)
+        except StopIteration as stop:
+            if open_token is not None:
+                raise DescriptorError('unclosed { block')
+            if pending:
+                items.append(pending)
+            return items, stop.value or ''
+
+        if token.kind == 'op' and token.text == '}':
+            if open_token is None:
+                raise DescriptorError('unexpected }')
+            if pending:
+                items.append(pending)
+            return items, token
+
+        if token.kind == 'op' and token.text in OPERATORS:
+            if not pending or not isinstance(pending, Token):
+                raise DescriptorError(f'{token.text} without a key')
+            value = next(tokens, None)
+            if value is None:
+                raise DescriptorError(f'{pending.text} {token.text} without a value')
+            if value.kind == 'op' and value.text == '{':
+                block_items, close_token = parse_items(tokens, value)
+                value = Block(block_items, value, close_token)
+            elif value.kind == 'op':
+                raise DescriptorError(f'unexpected {value.text} after {pending.text} {token.text}')
+            items.append(Pair(pending, token, value))
+            pending = None
+            continue
+
+        if pending:
+            items.append(pending)
+            pending = None
+        if token.kind == 'op' and token.text == '{':
+            block_items, close_token = parse_items(tokens, token)
+            items.append(Block(block_items, token, close_token))
+        else:
+            pending = token
+
+
+@lru_cache(maxsize=4096)
+def _load(path, mtime_ns, size):
+    with open(path, 'r', encoding=ENCODING, errors=ERRORS, newline='') as desc_file:
+        return parse(desc_file.read())
+
+
+def load(path: pathlib.Path):
+    # parsed descriptor of path, shared between callers for as long as the file is unchanged.
+    # copy() it before editing
+    stat = os.stat(path)
+    return _load(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+def loads(data):
+    if isinstance(data, bytes):
+        data = data.decode(ENCODING, ERRORS)
+    return parse(data)
+
+
+def save(descriptor: Descriptor, path: pathlib.Path):
+    with open(path, 'w', encoding=ENCODING, errors=ERRORS, newline='') as desc_file:
+        desc_file.write(descriptor.dump())
@@ -1,35 +1,45 @@
 import logging
+import os
 import pathlib
-import re
 import threading
 from concurrent.futures.thread import ThreadPoolExecutor
-from queue import Queue
-from zipfile import ZipInfo, ZIP_STORED
+from functools import partial
+from zipfile import ZIP_STORED, BadZipFile, is_zipfile
 
 from tqdm import tqdm
 
+from pdxModTool import config, descriptor, metrics
+from pdxModTool.compression import AUTO
+from pdxModTool.manifest import Manifest
+from pdxModTool.mapped import open_source
 from pdxModTool.newzipfile import ZipFile
+from pdxModTool.pipeline import StreamPipeline, Entry
+from pdxModTool.policy import CompressionPolicy
+from pdxModTool.scanner import RESCAN, ModIgnore, scan_tree
+from pdxModTool.util import unshare
 
 
 class BaseHandler:
+    RAW_COPY = False
 
-    def __init__(self, path, max_workers=None):
+    def __init__(self, path, max_workers=None, memory_budget=None):
         if not path.exists():
             raise FileNotFoundError
 
         self.path = path
         self.size = None
 
-        self.queue = Queue(maxsize=20)
         self.max_workers = max_workers if max_workers else 4
-        self.threads = []
+        self.memory_budget = memory_budget
+        # (compression, level) by arcname, while building with AUTO compression
+        self.decisions = {}
+        self._compactions = []
 
     def __repr__(self):
         return f'{type(self).__name__}({self.path})'
 
     def get_name(self, desc):
-        if match := re.search(r'name="(.*)"', desc):
-            name = match.group(1)
+        if isinstance(name := desc.get('name'), str):
             name = name.lower().replace(' - ', '_')
             name = name.replace(' ', '_')
             name = "".join(c for c in name if c.isalnum() or c in ['.', '_']).rstrip()
@@ -37,39 +47,205 @@ class BaseHandler:
         logging.error(f'name not found in {self.path}')
         raise LookupError
 
-    def build(self, path):
-
+    def build(self, path, incremental=False, in_place=False, compression=None, level=None, progress=None):
+        with archive_lock(path):
+            policy = self.decide_compression(path, level) if compression == AUTO else None
+            try:
+                if in_place and self.build_in_place(path, compression, level, progress):
+                    return
+                self._build(path, incremental or in_place, compression, level, progress)
+            finally:
+                self.decisions = {}
+                if policy:
+                    policy.save()
+
+    def decide_compression(self, path, level=None):
+        policy = CompressionPolicy.load(path, self.path if self.path.is_dir() else None, level)
+        infos = list(self.infolist)
+        with metrics.timer('build.policy'), ThreadPoolExecutor(max_workers=self.max_workers) as e:
+            decisions = e.map(lambda info: policy.decide(info, self.get_signature(info), partial(self._open, info)),
+                              infos)
+            self.decisions = {info.filename: decision for info, decision in zip(infos, decisions)}
+        stored = sum(compression == ZIP_STORED for compression, _ in self.decisions.values())
+        logging.debug(f'{policy}: {len(infos) - stored} entries to compress, {stored} to store')
+        return policy
+
+    def build_in_place(self, path, compression=None, level=None, progress=None):
+        # updates the archive at path where it is: changed entries are appended, entries of removed files
+        # dropped, and the central directory rewritten to match, so a small change costs small writes.
+        # False when there is no archive or manifest to update
+        manifest = Manifest.load(path)
+        if not manifest.entries:
+            return False
         try:
-            write_lock = threading.Lock()
+            unshare(path, keep=True)
+            zipFile = self.open_in_place(path, manifest)
+        except (FileNotFoundError, BadZipFile) as e:
+            logging.debug(f'{e}: rebuilding {path}')
+            return False
+        own_progress = progress is None
 
-            with ZipFile(path, 'w') as zipFile:
-                progress = tqdm(f'packing "{path.name}"', total=self.size, unit='B', unit_scale=True,
-                                unit_divisor=1024)
-                with ThreadPoolExecutor(max_workers=self.max_workers) as e:
+        try:
+            with zipFile:
+                signatures = {}
+                entries = []
+                with metrics.timer('build.plan'):
                     for zipInfo in self.infolist:
-                        self.threads.append(e.submit(self.write, write_lock, zipFile, progress))
-                        self.threads.append(e.submit(self.read, zipInfo))
+                        signature = signatures[zipInfo.filename] = self.get_signature(zipInfo)
+                        previous_info = zipFile.NameToInfo.get(zipInfo.filename)
+                        if manifest.is_unchanged(zipInfo, signature, previous_info) \
+                                and previous_info.compress_type == self.get_compress_type(zipInfo, compression):
+                            continue
+                        entries.append(self.get_entry(zipInfo, compression))
+                    stale = [name for name in zipFile.NameToInfo if name not in signatures]
+                metrics.count('build.files', len(entries))
+                if not entries and not stale:
+                    logging.info(f'{path.name} is up to date')
+                    return True
+
+                zipFile.discard(stale + [entry.zip_info.filename for entry in entries])
+                if own_progress:
+                    progress = tqdm(f'updating "{path.name}"', total=sum(e.zip_info.file_size for e in entries),
+                                    unit='B', unit_scale=True, unit_divisor=1024)
+                pipeline = StreamPipeline(self.max_workers, self.memory_budget, compression, level)
+                with metrics.timer('build.pipeline'):
+                    pipeline.run(zipFile, entries, progress)
+
+                # the central directory lists entries in source order, wherever their bytes are
+                order = {name: index for index, name in enumerate(signatures)}
+                zipFile.filelist.sort(key=lambda info: order[info.filename])
+                dead = zipFile.start_dir - zipFile.live_size()
+                with metrics.timer('build.end_record'):
+                    zipFile.close()
+
+            logging.info(f'{path.name}: {len(entries)} entries written, {len(stale)} removed, '
+                         f'{dead / 1024 ** 2:.1f} MiB dead space')
+            manifest.entries = {}
+            for zipInfo in zipFile.filelist:
+                manifest.add(zipInfo.filename, signatures[zipInfo.filename], zipInfo.CRC)
+            manifest.size = path.stat().st_size
+            manifest.save()
+
+            if dead > config.COMPACT_MIN and dead > config.COMPACT_RATIO * manifest.size:
+                # the archive is only ever replaced whole, so a compaction cut short leaves it as it was
+                compaction = threading.Thread(target=compact_archive, args=(path,), name=f'compact {path.name}',
+                                              daemon=True)
+                compaction.start()
+                self._compactions.append(compaction)
+        except (FileNotFoundError, PermissionError) as e:
+            logging.error(f'{e}: could not update {path}')
+            raise
+        finally:
+            if own_progress and progress is not None:
+                progress.close()
+        return True
+
+    @staticmethod
+    def open_in_place(path, manifest):
+        # an update that never got to write its central directory is rolled back to the archive
+        # the manifest was saved for. append mode would otherwise start a new archive after the broken one
+        if not is_zipfile(path):
+            if not manifest.size or path.stat().st_size <= manifest.size:
+                raise BadZipFile(f'{path} is not a valid zip')
+            logging.warning(f'{path.name}: rolling back an interrupted update')
+            os.truncate(path, manifest.size)
+        return ZipFile(path, 'a', durable=True)
+
+    def wait_compactions(self):
+        for compaction in self._compactions:
+            if compaction.is_alive():
+                logging.info(f'waiting for {compaction.name} to finish')
+                compaction.join()
+        self._compactions = []
+
+    def _build(self, path, incremental=False, compression=None, level=None, progress=None):
+        manifest = Manifest.load(path) if incremental else None
+        previous = self.open_previous(path) if incremental else None
+        out_path = path.with_name(f'{path.name}{config.TEMP_SUFFIX}') if previous else path
+        own_progress = progress is None
+        if out_path == path:
+            unshare(path)
 
-                while True:
-                    if all(t.done for t in self.threads):
-                        break
+        try:
+            signatures = {}
+
+            with ZipFile(out_path, 'w') as zipFile:
+                if own_progress:
+                    progress = tqdm(f'packing "{path.name}"', total=self.size, unit='B', unit_scale=True,
+                                    unit_divisor=1024)
+                entries = []
+                with metrics.timer('build.plan'):
+                    for zipInfo in self.infolist:
+                        if manifest is not None:
+                            signature = signatures[zipInfo.filename] = self.get_signature(zipInfo)
+                            previous_info = previous.NameToInfo.get(zipInfo.filename) if previous else None
+                            if manifest.is_unchanged(zipInfo, signature, previous_info) \
+                                    and previous_info.compress_type == self.get_compress_type(zipInfo, compression):
+                                entries.append(Entry(previous_info, partial(previous.open_raw, previous_info),
+                                                     raw=True))
+                                continue
+                        entries.append(self.get_entry(zipInfo, compression))
+                metrics.count('build.files', len(entries))
+
+                if manifest is not None:
+                    logging.debug(f'{sum(e.raw for e in entries)} entries copied raw, '
+                                  f'{sum(not e.raw for e in entries)} entries to read')
+
+                pipeline = StreamPipeline(self.max_workers, self.memory_budget, compression, level)
+                with metrics.timer('build.pipeline'):
+                    pipeline.run(zipFile, entries, progress)
+                with metrics.timer('build.end_record'):
+                    zipFile.close()
+
+                if manifest is not None:
+                    manifest.entries = {}
+                    for zipInfo in zipFile.filelist:
+                        manifest.add(zipInfo.filename, signatures[zipInfo.filename], zipInfo.CRC)
+
+            if previous:
+                previous.close()
+                previous = None
+                os.replace(out_path, path)
+            if manifest is not None:
+                manifest.size = path.stat().st_size
+                manifest.save()
 
         except FileNotFoundError as e:
             logging.error(f'{e}: invalid write path: {path}')
+            raise
         except PermissionError as e:
             logging.error(f'writing and reading on same path: {path}')
+            raise
         finally:
-            progress.close()
-
-    def read(self, zip_info):
-        bytes_read = self._read(zip_info)
-        self.queue.put((zip_info, bytes_read))
-
-    def write(self, lock, zip_file, progress):
-        zip_info, bytes_data = self.queue.get()
-        with lock:
-            zip_file.writestr(zip_info, bytes_data, compress_type=ZIP_STORED)
-        progress.update(zip_info.file_size)
+            if own_progress and progress is not None:
+                progress.close()
+            if previous:
+                previous.close()
+                out_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def open_previous(path):
+        if not path.exists():
+            return None
+        try:
+            return ZipFile(path, 'r')
+        except BadZipFile:
+            logging.warning(f'previous archive {path} is not a valid zip, rebuilding it')
+            return None
+
+    def get_compress_type(self, zip_info, compression):
+        if compression == AUTO:
+            return self.decisions[zip_info.filename][0]
+        if compression is not None:
+            return compression
+        return zip_info.compress_type if self.RAW_COPY else ZIP_STORED
+
+    def get_entry(self, zip_info, compression=None):
+        if self.RAW_COPY and zip_info.compress_type == self.get_compress_type(zip_info, compression):
+            return Entry(zip_info, partial(self._open_raw, zip_info), raw=True)
+        compression, level = self.decisions[zip_info.filename] if compression == AUTO else (None, None)
+        return Entry(zip_info, partial(self._open, zip_info), source=self.get_source(zip_info), compression=compression,
+                     level=level)
 
     def get_descriptor(self):
         raise NotImplementedError
@@ -77,31 +253,88 @@ class BaseHandler:
     def get_size(self):
         raise NotImplementedError
 
+    def get_signature(self, zip_info):
+        raise NotImplementedError
+
+    def get_source(self, zip_info):
+        raise NotImplementedError
+
     @property
     def infolist(self):
         raise NotImplementedError
 
-    def _read(self, zip_info):
+    def _open(self, zip_info):
+        raise NotImplementedError
+
+    def _open_raw(self, zip_info):
         raise NotImplementedError
 
     def close(self):
         raise NotImplementedError
 
 
-class PathHandler(BaseHandler):
-    IGNORE = {'.git', '.gitattributes'}
+_archive_locks = {}
+_archive_locks_lock = threading.Lock()
+
+
+def archive_lock(path: pathlib.Path):
+    # builds and compactions of one archive take turns
+    with _archive_locks_lock:
+        return _archive_locks.setdefault(os.path.abspath(path), threading.Lock())
+
 
-    def __init__(self, path, max_workers=None):
-        super(PathHandler, self).__init__(path, max_workers)
-        self.src_paths = self.get_paths()
+def compact_archive(path: pathlib.Path):
+    # copies the live entries of an archive updated in place to a fresh one, leaving the dead space behind
+    with archive_lock(path):
+        temp_path = path.with_name(f'{path.name}{config.TEMP_SUFFIX}')
+        try:
+            with ZipFile(path, 'r') as src, ZipFile(temp_path, 'w', durable=True) as dest:
+                for zipInfo in src.filelist:
+                    with src.open_raw(zipInfo) as raw:
+                        dest.write_raw(zipInfo, iter(partial(raw.read, config.CHUNK_SIZE), b''))
+            before = path.stat().st_size
+            os.replace(temp_path, path)
+            if (manifest := Manifest.load(path)).entries:
+                manifest.size = path.stat().st_size
+                manifest.save()
+            logging.info(f'compacted {path.name}: {before / 1024 ** 2:.1f} -> '
+                         f'{path.stat().st_size / 1024 ** 2:.1f} MiB')
+        except (OSError, BadZipFile) as e:
+            logging.warning(f'{e}: could not compact {path}')
+            temp_path.unlink(missing_ok=True)
+
+
+class PathHandler(BaseHandler):
+    IGNORE = ['.git', '.gitattributes', config.IGNORE_FILE, config.POLICY_FILE, '*.zip']
+
+    def __init__(self, path, max_workers=None, memory_budget=None):
+        super(PathHandler, self).__init__(path, max_workers, memory_budget)
+        self.ignore = ModIgnore.load(self.path, self.IGNORE)
+        with metrics.timer('build.scan'):
+            self.src_files = self.get_paths()
+        self._stats = {src.arcname: src.stat for src in self.src_files}
         self.size = self.get_size()
 
     def get_paths(self):
-        paths = list(pathlib.Path(p) for p in self.path.glob('**/*'))
-        paths = list(filter(lambda x: not any(i in x.parts for i in self.IGNORE), paths))
-        paths = list(filter(lambda x: x.suffix != '.zip', paths))
-        paths = list(filter(lambda x: not x.is_dir(), paths))
-        return paths
+        return scan_tree(self.path, self.ignore)
+
+    def update(self, arcnames):
+        # modified files are re-stat'ed in place; added or removed files and folders mean a rescan
+        rescan = any(arcname.endswith('/') or arcname not in self._stats for arcname in arcnames)
+        if not rescan:
+            for src in self.src_files:
+                if src.arcname in arcnames:
+                    try:
+                        src.stat = os.stat(src.path)
+                    except FileNotFoundError:
+                        rescan = True
+                        break
+        if rescan:
+            if RESCAN in arcnames:
+                self.ignore = ModIgnore.load(self.path, self.IGNORE)
+            self.src_files = self.get_paths()
+        self._stats = {src.arcname: src.stat for src in self.src_files}
+        self.size = self.get_size()
 
     def get_descriptor(self):
         desc_path = self.path / 'descriptor.mod'
@@ -110,54 +343,66 @@ class PathHandler(BaseHandler):
             logging.error(f'no descriptor.mod found in {desc_path}')
             raise FileNotFoundError
 
-        with desc_path.open('r') as desc_file:
-            return desc_file.read()
+        return descriptor.load(desc_path)
 
     def get_size(self):
-        return sum(map(lambda x: x.stat().st_size, self.src_paths))
+        return sum(src.stat.st_size for src in self.src_files)
+
+    def get_signature(self, zip_info):
+        stat = self._stats[zip_info.filename]
+        return stat.st_size, stat.st_mtime_ns
+
+    def get_source(self, zip_info):
+        return 'path', str(zip_info.orig_filename)
 
     @property
     def infolist(self):
-        for path in self.src_paths:
-            zip_info = ZipInfo.from_file(path, arcname=path.relative_to(self.path))
-            zip_info.orig_filename = path
+        for src in self.src_files:
+            zip_info = src.zip_info()
             zip_info.extract_version = 20
             yield zip_info
 
-    def _read(self, zip_info):
-        path: pathlib.Path = zip_info.orig_filename
-        with path.open('rb') as file:
-            return file.read()
+    def _open(self, zip_info):
+        return open_source(zip_info.orig_filename, zip_info.file_size)
 
     def close(self):
-        self.src_paths = None
+        self.src_files = None
+        self._stats = None
         return
 
 
 class BinHandler(BaseHandler):
+    RAW_COPY = True
 
-    def __init__(self, path, max_workers=None):
-        super(BinHandler, self).__init__(path, max_workers)
+    def __init__(self, path, max_workers=None, memory_budget=None):
+        super(BinHandler, self).__init__(path, max_workers, memory_budget)
         self.binFile = ZipFile(path, 'r')
         self.size = self.get_size()
 
     def get_descriptor(self):
-        desc = ''
-        for line in self.binFile.read('descriptor.mod').decode().splitlines():
-            if not line.startswith('archive='):
-                desc += f'{line}\n'
+        desc = descriptor.loads(self.binFile.read('descriptor.mod'))
+        desc.remove('archive')
         return desc
 
     def get_size(self):
         return sum(map(lambda x: x.file_size, self.binFile.infolist()))
 
+    def get_signature(self, zip_info):
+        return zip_info.file_size, zip_info.CRC
+
+    def get_source(self, zip_info):
+        return 'zip', str(self.path), zip_info.filename
+
     @property
     def infolist(self):
         for zip_info in self.binFile.filelist:
             yield zip_info
 
-    def _read(self, zip_info):
-        return self.binFile.read(zip_info)
+    def _open(self, zip_info):
+        return self.binFile.open(zip_info)
+
+    def _open_raw(self, zip_info):
+        return self.binFile.open_raw(zip_info)
 
     def close(self):
         self.binFile.close()
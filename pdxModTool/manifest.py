@@ -0,0 +1,51 @@
+import json
+import logging
+import pathlib
+
+from pdxModTool import config
+
+
+class Manifest:
+    VERSION = 1
+
+    def __init__(self, archive_path: pathlib.Path):
+        self.path = archive_path.with_suffix(config.MANIFEST_SUFFIX)
+        self.entries = {}
+        # size of the archive the entries were saved for
+        self.size = None
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.path})'
+
+    @classmethod
+    def load(cls, archive_path):
+        manifest = cls(archive_path)
+        if not manifest.path.exists():
+            return manifest
+
+        try:
+            with manifest.path.open('r') as manifest_file:
+                data = json.load(manifest_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'{e}: ignoring unreadable manifest {manifest.path}')
+            return manifest
+
+        if data.get('version') == cls.VERSION:
+            manifest.entries = {name: list(entry) for name, entry in data['entries'].items()}
+            manifest.size = data.get('size')
+        return manifest
+
+    def save(self):
+        with self.path.open('w') as manifest_file:
+            json.dump({'version': self.VERSION, 'size': self.size, 'entries': self.entries}, manifest_file)
+
+    def add(self, arcname, signature, crc):
+        self.entries[arcname] = [*signature, crc]
+
+    def is_unchanged(self, zip_info, signature, previous_info):
+        entry = self.entries.get(zip_info.filename)
+        if not entry or previous_info is None:
+            return False
+        return entry[:-1] == list(signature) \
+            and entry[-1] == previous_info.CRC \
+            and previous_info.file_size == zip_info.file_size
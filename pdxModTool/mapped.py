@@ -0,0 +1,72 @@
+import logging
+import mmap
+import os
+import pathlib
+
+from pdxModTool import config
+
+# each read maps just the window it returns and hands out a memoryview of it. the map is
+# released as soon as the last view of it is dropped, so resident memory follows the chunks in
+# flight instead of growing with the size of the file, and no bytes are copied on the way to
+# the writer or socket.
+
+
+class MappedFile:
+
+    def __init__(self, fileno, offset=0, size=None):
+        self._fileno = fileno
+        self._pos = offset
+        self._remaining = os.fstat(fileno).st_size - offset if size is None else size
+        self._owned = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @classmethod
+    def open(cls, path: pathlib.Path):
+        file = path.open('rb')
+        try:
+            mapped = cls(file.fileno())
+        except BaseException:
+            file.close()
+            raise
+        mapped._owned = file
+        return mapped
+
+    def read(self, n=-1):
+        n = self._remaining if n < 0 else min(n, self._remaining)
+        if n <= 0:
+            return memoryview(b'')
+
+        # maps must start on an allocation boundary
+        start = self._pos - self._pos % mmap.ALLOCATIONGRANULARITY
+        window = mmap.mmap(self._fileno, self._pos + n - start, offset=start, access=mmap.ACCESS_READ)
+        view = memoryview(window)[self._pos - start:]
+        self._pos += n
+        self._remaining -= n
+        return view
+
+    def seek(self, offset):
+        self._remaining += self._pos - offset
+        self._pos = offset
+        return offset
+
+    def close(self):
+        # views already handed out keep their windows alive on their own
+        self._remaining = 0
+        if self._owned:
+            self._owned.close()
+            self._owned = None
+
+
+def open_source(path: pathlib.Path, size):
+    # maps sources big enough to be worth it, reads the rest (and anything that cannot be mapped)
+    if config.MMAP_READS and size >= config.MMAP_THRESHOLD:
+        try:
+            return MappedFile.open(path)
+        except (OSError, ValueError) as e:
+            logging.debug(f'{e}: reading {path} without mmap')
+    return path.open('rb')
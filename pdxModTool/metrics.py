@@ -0,0 +1,178 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+
+# timers and counters around the build pipeline and the socket loops. collection is off unless
+# --profile or --metrics-json is given; while off, timer() hands out one shared no-op context
+# and count() returns straight away, so instrumented code pays a function call and nothing more.
+
+enabled = False
+
+_timers = {}
+_counters = {}
+_lock = threading.Lock()
+
+
+class _NullTimer:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def enable():
+    global enabled
+    enabled = True
+    reset()
+
+
+def reset():
+    with _lock:
+        _timers.clear()
+        _counters.clear()
+
+
+def timer(name):
+    # time spent in a stage. timers started on several threads at once add up, so a total can
+    # exceed the wall time of the command
+    return _Timer(name) if enabled else _NULL_TIMER
+
+
+def record(name, elapsed):
+    if not enabled:
+        return
+    with _lock:
+        if stat := _timers.get(name):
+            stat[0] += 1
+            stat[1] += elapsed
+            stat[2] = max(stat[2], elapsed)
+        else:
+            _timers[name] = [1, elapsed, elapsed]
+
+
+def count(name, value=1):
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def summary(command=None, wall=None):
+    with _lock:
+        return {
+            'command': command,
+            'wall': wall,
+            'timers': {name: {'calls': calls, 'total': total, 'max': longest}
+                       for name, (calls, total, longest) in sorted(_timers.items())},
+            'counters': dict(sorted(_counters.items())),
+        }
+
+
+def table(report):
+    lines = [f'{report["command"]}: {report["wall"]:.3f}s wall',
+             f'{"timer":<24}{"calls":>10}{"total s":>12}{"mean ms":>12}{"max ms":>12}']
+    for name, stat in report['timers'].items():
+        lines.append(f'{name:<24}{stat["calls"]:>10}{stat["total"]:>12.3f}'
+                     f'{stat["total"] / stat["calls"] * 1000:>12.3f}{stat["max"] * 1000:>12.3f}')
+    if report['counters']:
+        lines.append(f'{"counter":<24}{"value":>10}')
+        for name, value in report['counters'].items():
+            lines.append(f'{name:<24}{value:>10}')
+    return '\n'.join(lines)
+
+
+class ThreadProfile:
+    # cProfile over every thread started while it runs. before python 3.12 a profile only hooks the
+    # thread that enables it, so each new thread enables one of its own and their stats are merged.
+    # the worker processes of compressed builds are not profiled
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _start_thread(self, *_):
+        # the first event of a new thread swaps this hook for a profile of the thread's own
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def runcall(self, func, *args):
+        profile = cProfile.Profile()
+        self.profiles.append(profile)
+        per_thread = sys.version_info < (3, 12)
+        if per_thread:
+            threading.setprofile(self._start_thread)
+        try:
+            return profile.runcall(func, *args)
+        finally:
+            if per_thread:
+                threading.setprofile(None)
+
+    def stats(self, stream=None):
+        with self._lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0], stream=stream)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+def profile_stats(profile: ThreadProfile, limit=25):
+    stream = io.StringIO()
+    profile.stats(stream).sort_stats('cumulative').print_stats(limit)
+    return stream.getvalue()
+
+
+def run(func, args, command, show=False, json_path=None, profile_path=None):
+    # runs a subcommand with metrics collection and/or cProfile, and reports once it returns
+    if show or json_path:
+        enable()
+
+    profile = ThreadProfile() if profile_path else None
+    start = time.perf_counter()
+    try:
+        if profile:
+            profile.runcall(func, args)
+        else:
+            func(args)
+    finally:
+        wall = time.perf_counter() - start
+        if enabled:
+            report = summary(command, wall)
+            if show:
+                logging.info(f'metrics\n{table(report)}')
+            if json_path:
+                with open(json_path, 'w') as json_file:
+                    json.dump(report, json_file, indent=2)
+                logging.info(f'metrics written to {json_path}')
+        if profile:
+            profile.stats().dump_stats(profile_path)
+            logging.info(f'profile written to {profile_path}')
+            logging.debug(profile_stats(profile))
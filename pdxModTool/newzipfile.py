@@ -1,14 +1,155 @@
+import logging
+import os
 import struct
 import sys
 from zipfile import *
 from zipfile import ZIP64_LIMIT, _strip_extra, ZIP64_VERSION, BZIP2_VERSION, LZMA_VERSION, structCentralDir, \
     stringCentralDir, ZIP_FILECOUNT_LIMIT, structEndArchive64, stringEndArchive64, structEndArchive64Locator, \
-    stringEndArchive64Locator, structEndArchive, stringEndArchive
+    stringEndArchive64Locator, structEndArchive, stringEndArchive, structFileHeader, stringFileHeader, \
+    sizeFileHeader, _FH_SIGNATURE, _FH_FILENAME_LENGTH, _FH_EXTRA_FIELD_LENGTH
+
+from pdxModTool import config, metrics
+from pdxModTool.mapped import MappedFile
+
+DATA_DESCRIPTOR_FLAG = 0x08
 
 
 class ZipFile(ZipFile):
+    # whole payloads handed to write_raw are queued with their local headers and go out in batches
+    # with one vectored write (os.writev), straight from the caller's buffers. anything else that
+    # writes to the archive goes through _writecheck, which flushes the queue first
+
+    # with durable, appending leaves everything already in the archive as it was: new entries go after
+    # the old end record, and the new central directory is only written once they are on disk. an
+    # interrupted update can then be undone by truncating the archive back to its old size
+
+    def __init__(self, *args, durable=False, **kwargs):
+        self._vector = []
+        self._vector_size = 0
+        self._vector_offset = 0
+        self._fileno = None
+        self._durable = durable
+        super(ZipFile, self).__init__(*args, **kwargs)
+
+        if durable and self.mode == 'a':
+            self.start_dir = self.fp.seek(0, os.SEEK_END)
+
+        if self.mode != 'r' and self._seekable and hasattr(os, 'writev'):
+            try:
+                self._fileno = self.fp.fileno()
+            except (AttributeError, OSError, ValueError):
+                pass
+
+    def open_raw(self, zinfo):
+        # compressed payload of a member, without inflating it or checking its CRC
+        with self._lock:
+            self._flush_vector()
+            self.fp.seek(zinfo.header_offset)
+            fheader = struct.unpack(structFileHeader, self.fp.read(sizeFileHeader))
+            if fheader[_FH_SIGNATURE] != stringFileHeader:
+                raise BadZipFile(f'Bad magic number for file header: {zinfo.filename}')
+            offset = self.fp.tell() + fheader[_FH_FILENAME_LENGTH] + fheader[_FH_EXTRA_FIELD_LENGTH]
+        return RawReader(self, offset, zinfo.compress_size)
+
+    def read_raw(self, zinfo):
+        with self.open_raw(zinfo) as raw:
+            return bytes(raw.read())
+
+    def write_raw(self, zinfo, data):
+        # append an already compressed payload, given as bytes or an iterable of chunks, trusting
+        # zinfo's CRC, sizes and compress_type
+        whole = isinstance(data, (bytes, bytearray, memoryview))
+        if whole:
+            data = (data,)
+        zinfo = raw_info(zinfo)
+        zip64 = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+        if zip64 and not self._allowZip64:
+            raise LargeZipFile('Filesize would require ZIP64 extensions')
+
+        with self._lock:
+            if self._writing:
+                raise ValueError("Can't write to ZIP archive while an open writing handle exists.")
+            super(ZipFile, self)._writecheck(zinfo)
+            self._didModify = True
+
+            if self._fileno is None:
+                if self._seekable:
+                    self.fp.seek(self.start_dir)
+                zinfo.header_offset = self.fp.tell()
+                self.fp.write(zinfo.FileHeader(zip64))
+                for chunk in data:
+                    self.fp.write(chunk)
+                self.start_dir = self.fp.tell()
+            else:
+                zinfo.header_offset = self.start_dir
+                self._queue(zinfo.FileHeader(zip64))
+                if whole:
+                    self._queue(data[0])
+                else:
+                    # chunks of a stream may be reused by their producer once the next one is asked for
+                    for chunk in data:
+                        self._queue(chunk)
+                        self._flush_vector()
+
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+        return zinfo
+
+    def discard(self, names):
+        # drops members from the central directory. their bytes stay where they are, as dead space,
+        # until the archive is compacted
+        with self._lock:
+            if not (names := {name for name in names if name in self.NameToInfo}):
+                return
+            self.filelist = [zinfo for zinfo in self.filelist if zinfo.filename not in names]
+            for name in names:
+                del self.NameToInfo[name]
+            self._didModify = True
+
+    def live_size(self):
+        # bytes of local headers and payloads still referenced by the central directory
+        return sum(sizeFileHeader + len(zinfo._encodeFilenameFlags()[0]) + len(zinfo.extra) + zinfo.compress_size
+                   for zinfo in self.filelist)
+
+    def _queue(self, part):
+        if not self._vector:
+            self._vector_offset = self.start_dir
+        self._vector.append(part)
+        self._vector_size += len(part)
+        self.start_dir += len(part)
+        if self._vector_size >= config.WRITEV_SIZE or len(self._vector) >= config.WRITEV_PARTS:
+            self._flush_vector()
+
+    def _flush_vector(self):
+        if not self._vector:
+            return
+        parts, self._vector, self._vector_size = self._vector, [], 0
+        with metrics.timer('write.vector'):
+            self.fp.seek(self._vector_offset)
+            self.fp.flush()
+            written = self._vector_offset
+            while parts:
+                n = os.writev(self._fileno, parts)
+                written += n
+                # drop what made it out, keep the rest of a partly written part
+                while parts and n >= len(parts[0]):
+                    n -= len(parts[0])
+                    parts.pop(0)
+                if n:
+                    parts[0] = memoryview(parts[0])[n:]
+            # the file object has to learn where the descriptor ended up
+            self.fp.seek(written)
+
+    def _writecheck(self, zinfo):
+        self._flush_vector()
+        super(ZipFile, self)._writecheck(zinfo)
 
     def _write_end_record(self):
+        self._flush_vector()
+        if self._durable:
+            self._sync()
+        # the central directory and end records are built in one buffer and written at once
+        buffer = bytearray()
         for zinfo in self.filelist:         # write central directory
             dt = zinfo.date_time
             dosdate = (dt[0] - 1980) << 9 | dt[1] << 5 | dt[2]
@@ -67,12 +208,12 @@ class ZipFile(ZipFile):
                        0, zinfo.internal_attr, zinfo.external_attr,
                        header_offset), file=sys.stderr)
                 raise
-            self.fp.write(centdir)
-            self.fp.write(filename)
-            self.fp.write(extra_data)
-            self.fp.write(zinfo.comment)
+            buffer += centdir
+            buffer += filename
+            buffer += extra_data
+            buffer += zinfo.comment
 
-        pos2 = self.fp.tell()
+        pos2 = self.start_dir + len(buffer)
         # Write end-of-zip-archive record
         centDirCount = len(self.filelist)
         centDirSize = pos2 - self.start_dir
@@ -93,12 +234,12 @@ class ZipFile(ZipFile):
                 structEndArchive64, stringEndArchive64,
                 44, 45, 45, 0, 0, centDirCount, centDirCount,
                 centDirSize, centDirOffset)
-            self.fp.write(zip64endrec)
+            buffer += zip64endrec
 
             zip64locrec = struct.pack(
                 structEndArchive64Locator,
                 stringEndArchive64Locator, 0, pos2, 1)
-            self.fp.write(zip64locrec)
+            buffer += zip64locrec
             centDirCount = min(centDirCount, 0xFFFF)
             centDirSize = min(centDirSize, 0xFFFFFFFF)
             centDirOffset = min(centDirOffset, 0xFFFFFFFF)
@@ -106,8 +247,80 @@ class ZipFile(ZipFile):
         endrec = struct.pack(structEndArchive, stringEndArchive,
                              0, 0, centDirCount, centDirCount,
                              centDirSize, centDirOffset, len(self._comment))
-        self.fp.write(endrec)
-        self.fp.write(self._comment)
+        buffer += endrec
+        buffer += self._comment
+        if self._seekable:
+            self.fp.seek(self.start_dir)
+        self.fp.write(buffer)
+        if self.mode == 'a':
+            self.fp.truncate()
+        self.fp.flush()
+        if self._durable:
+            self._sync()
+
+    def _sync(self):
         self.fp.flush()
+        with metrics.timer('write.sync'):
+            os.fsync(self.fp.fileno())
+
+
+class RawReader:
+    # big payloads are mapped, which also spares readers from taking turns on the archive's file
+    # object; small ones are read under the archive's lock
+
+    def __init__(self, zip_file, offset, size):
+        self._zip_file = zip_file
+        self._pos = offset
+        self._remaining = size
+        self._mapped = None
+
+        if config.MMAP_READS and size >= config.MMAP_THRESHOLD:
+            try:
+                self._mapped = MappedFile(zip_file.fp.fileno(), offset, size)
+            except (OSError, ValueError, AttributeError) as e:
+                logging.debug(f'{e}: reading {zip_file.filename} without mmap')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def read(self, n=-1):
+        if self._mapped:
+            return self._mapped.read(n)
+
+        n = self._remaining if n < 0 else min(n, self._remaining)
+        # readers of one archive take turns on its file object
+        with metrics.timer('zip.lock_wait'):
+            self._zip_file._lock.acquire()
+        try:
+            self._zip_file.fp.seek(self._pos)
+            data = self._zip_file.fp.read(n)
+        finally:
+            self._zip_file._lock.release()
+        self._pos += len(data)
+        self._remaining -= len(data)
+        return data
+
+    def close(self):
+        self._remaining = 0
+        if self._mapped:
+            self._mapped.close()
 
 
+def raw_info(zinfo):
+    info = ZipInfo(zinfo.filename, zinfo.date_time)
+    info.compress_type = zinfo.compress_type
+    info.comment = zinfo.comment
+    info.extra = _strip_extra(zinfo.extra, (1,))
+    info.create_system = zinfo.create_system
+    info.create_version = zinfo.create_version
+    info.extract_version = zinfo.extract_version
+    info.flag_bits = zinfo.flag_bits & ~DATA_DESCRIPTOR_FLAG
+    info.internal_attr = zinfo.internal_attr
+    info.external_attr = zinfo.external_attr
+    info.CRC = zinfo.CRC
+    info.compress_size = zinfo.compress_size
+    info.file_size = zinfo.file_size
+    return info
@@ -1,5 +1,7 @@
 import logging
 
+from pdxModTool import descriptor
+
 from pdxModTool.handler import PathHandler, BinHandler
 from pdxModTool.util import make_backup
 
@@ -11,11 +13,12 @@ class PDXMod:
         lambda x: x.suffix == '.zip': BinHandler
     }
 
-    def __init__(self, src_path, max_threads=None):
+    def __init__(self, src_path, max_threads=None, memory_budget=None):
         self.path = src_path
         self.handler = None
 
         self.max_threads = max_threads
+        self.memory_budget = memory_budget
 
         self.name = None
         self.descriptor = None
@@ -23,14 +26,25 @@ class PDXMod:
     def __enter__(self):
         for condition, handler in self.HANDLER.items():
             if condition(self.path):
-                self.handler = handler(self.path, max_workers=self.max_threads)
+                self.handler = handler(self.path, max_workers=self.max_threads, memory_budget=self.memory_budget)
                 break
 
         self.descriptor = self.handler.get_descriptor()
         self.name = self.handler.get_name(self.descriptor).lower().replace(' ', '_')
         return self
 
-    def build(self, mod_dir, desc=False, backup=False):
+    def reload_descriptor(self):
+        # the name stays as it was, so the mod keeps building to the same archive
+        try:
+            self.descriptor = self.handler.get_descriptor()
+        except (FileNotFoundError, descriptor.DescriptorError) as e:
+            logging.warning(f'{e}: keeping the previous descriptor of {self.name}')
+            return
+        if (name := self.handler.get_name(self.descriptor)) != self.name:
+            logging.warning(f'mod was renamed to {name}, still building it as {self.name}')
+
+    def build(self, mod_dir, desc=False, backup=False, incremental=False, in_place=False, compression=None,
+              level=None, progress=None):
         mod_path = (mod_dir / self.name).with_suffix('.zip') if mod_dir.is_dir() else mod_dir.with_suffix('.zip')
 
         if backup and mod_path.exists():
@@ -38,15 +52,16 @@ class PDXMod:
 
         logging.info(f'building {self.name} to {mod_path}')
         logging.debug(f'handler = {self.handler}')
-        self.handler.build(mod_path)
+        self.handler.build(mod_path, incremental=incremental, in_place=in_place, compression=compression,
+                           level=level, progress=progress)
 
         if desc:
-            desc_path = mod_path.parent / f'{self.name}.mod'
-            with desc_path.open('w') as desc_file:
-                desc_file.write(self.descriptor)
-                desc_file.write(f'\narchive="mod/{mod_path.name}"')
+            mod_desc = self.descriptor.copy()
+            mod_desc.set('archive', f'mod/{mod_path.name}')
+            descriptor.save(mod_desc, mod_path.parent / f'{self.name}.mod')
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        self.handler.wait_compactions()
         self.handler.close()
         self.descriptor = None
         self.data = None
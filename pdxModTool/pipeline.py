@@ -0,0 +1,203 @@
+import os
+import threading
+import zlib
+from concurrent.futures.process import ProcessPoolExecutor
+from concurrent.futures.thread import ThreadPoolExecutor
+from queue import SimpleQueue
+from zipfile import ZipInfo, ZIP_STORED
+
+from pdxModTool import config, metrics
+from pdxModTool.compression import compress_source, compressed_info, AUTO
+
+
+class BuildAborted(Exception):
+    pass
+
+
+class ByteBudget:
+    # bytes read but not yet written. the entry the writer is on may always keep one chunk in
+    # flight, so readers that ran ahead can never starve it.
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.head = 0
+        self.pending = {}
+        self.aborted = False
+        self._condition = threading.Condition()
+
+    def _available(self, size, index):
+        if self.used + size <= self.limit:
+            return True
+        return index <= self.head and not self.pending.get(index)
+
+    def acquire(self, size, index):
+        with self._condition:
+            self._condition.wait_for(lambda: self.aborted or self._available(size, index))
+            if self.aborted:
+                raise BuildAborted
+            self.used += size
+            self.pending[index] = self.pending.get(index, 0) + size
+
+    def release(self, size, index):
+        with self._condition:
+            self.used -= size
+            if pending := self.pending.get(index, 0) - size:
+                self.pending[index] = pending
+            else:
+                self.pending.pop(index, None)
+            self._condition.notify_all()
+
+    def advance(self, index):
+        with self._condition:
+            self.head = index
+            self._condition.notify_all()
+
+    def abort(self):
+        with self._condition:
+            self.aborted = True
+            self._condition.notify_all()
+
+
+class Entry:
+    __slots__ = ('zip_info', 'opener', 'raw', 'source', 'compression', 'level', 'chunks')
+
+    def __init__(self, zip_info, opener, raw=False, source=None, compression=None, level=None):
+        self.zip_info = zip_info
+        self.opener = opener
+        self.raw = raw
+        self.source = source
+        # overrides the pipeline's compression and level for this entry
+        self.compression = compression
+        self.level = level
+        self.chunks = SimpleQueue()
+
+
+class StreamPipeline:
+
+    def __init__(self, max_workers, memory_budget=None, compression=None, level=None):
+        self.max_workers = max_workers
+        self.budget = ByteBudget(memory_budget if memory_budget else config.MEMORY_BUDGET)
+        self.chunk_size = min(config.CHUNK_SIZE, self.budget.limit)
+
+        # with AUTO compression each entry brings its own, entries without one are stored
+        self.compression = compression if compression not in (None, AUTO) else ZIP_STORED
+        self.level = level
+        self.pool = None
+        # entries up to a worker's share of the budget are compressed whole in the process pool,
+        # larger ones are stream compressed by the writer
+        self.pool_limit = self.budget.limit // max_workers
+
+    def run(self, zip_file, entries, progress):
+        entries = list(entries)
+        if any(entry.source and self.compression_of(entry)[0] != ZIP_STORED for entry in entries):
+            self.pool = ProcessPoolExecutor(max_workers=min(self.max_workers, os.cpu_count() or 1))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as e:
+                for index, entry in enumerate(entries):
+                    e.submit(self.produce, index, entry)
+
+                try:
+                    for index, entry in enumerate(entries):
+                        self.budget.advance(index)
+                        self.consume(zip_file, index, entry, progress)
+                except BaseException:
+                    self.budget.abort()
+                    raise
+        finally:
+            if self.pool:
+                self.pool.shutdown()
+                self.pool = None
+            for entry in entries:
+                entry.chunks = None
+
+    def compression_of(self, entry):
+        if entry.compression is not None:
+            return entry.compression, entry.level
+        return self.compression, self.level
+
+    def pooled(self, entry):
+        return self.pool is not None and entry.source is not None and not entry.raw \
+            and entry.zip_info.file_size <= self.pool_limit and self.compression_of(entry)[0] != ZIP_STORED
+
+    def produce(self, index, entry):
+        try:
+            if self.pooled(entry):
+                with metrics.timer('read.budget_wait'):
+                    self.budget.acquire(entry.zip_info.file_size, index)
+                with metrics.timer('compress.pool'):
+                    future = self.pool.submit(compress_source, entry.source, *self.compression_of(entry))
+                    entry.chunks.put(future.result())
+            else:
+                with entry.opener() as src:
+                    while True:
+                        with metrics.timer('read.budget_wait'):
+                            self.budget.acquire(self.chunk_size, index)
+                        with metrics.timer('read'):
+                            data = src.read(self.chunk_size)
+                        self.budget.release(self.chunk_size - len(data), index)
+                        if not data:
+                            break
+                        metrics.count('read.bytes', len(data))
+                        entry.chunks.put(data)
+            entry.chunks.put(None)
+        except BaseException as e:
+            entry.chunks.put(e)
+
+    @staticmethod
+    def results(entry):
+        while True:
+            # time the writer spends waiting on readers
+            with metrics.timer('write.stall'):
+                data = entry.chunks.get()
+            if data is None:
+                return
+            if isinstance(data, BaseException):
+                raise data
+            yield data
+
+    def chunks(self, index, entry, progress):
+        for data in self.results(entry):
+            yield data
+            self.budget.release(len(data), index)
+            if not entry.raw:
+                progress.update(len(data))
+
+    def consume(self, zip_file, index, entry, progress):
+        metrics.count('write.entries')
+        if entry.raw:
+            # includes the stalls of the chunks generator
+            with metrics.timer('write.raw'):
+                zip_file.write_raw(entry.zip_info, self.chunks(index, entry, progress))
+            progress.update(entry.zip_info.file_size)
+            return
+
+        compression, level = self.compression_of(entry)
+        if self.pooled(entry):
+            for payload, crc, file_size in self.results(entry):
+                with metrics.timer('write'):
+                    zip_file.write_raw(compressed_info(entry.zip_info, compression, payload, crc, file_size), payload)
+                self.budget.release(entry.zip_info.file_size, index)
+                progress.update(file_size)
+            return
+
+        if compression == ZIP_STORED and entry.zip_info.file_size <= self.chunk_size:
+            # small stored files are written whole, sparing them the header rewrite of zipfile's writer
+            data = list(self.chunks(index, entry, progress))
+            data = data[0] if len(data) == 1 else b''.join(data)
+            with metrics.timer('write'):
+                zip_file.write_raw(compressed_info(entry.zip_info, ZIP_STORED, data, zlib.crc32(data), len(data)), data)
+            return
+
+        zip_info = ZipInfo(entry.zip_info.filename, entry.zip_info.date_time)
+        zip_info.external_attr = entry.zip_info.external_attr
+        zip_info.extract_version = entry.zip_info.extract_version
+        zip_info.file_size = entry.zip_info.file_size
+        zip_info.compress_type = compression
+        zip_info._compresslevel = level
+        with zip_file.open(zip_info, 'w') as dest:
+            for data in self.chunks(index, entry, progress):
+                # crc, compression and the disk write of zipfile's writer
+                with metrics.timer('write'):
+                    dest.write(data)
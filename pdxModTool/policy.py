@@ -0,0 +1,155 @@
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import threading
+import zlib
+from zipfile import ZIP_STORED, ZIP_DEFLATED
+
+from pdxModTool import config, metrics
+from pdxModTool.compression import COMPRESSION, AUTO
+
+# formats that are compressed already: deflating them costs cpu for next to nothing
+DEFAULT_RULES = [f'{pattern} store' for pattern in
+                 ('*.ogg', '*.mp3', '*.wem', '*.png', '*.jpg', '*.jpeg', '*.bk2', '*.bik', '*.webm', '*.zip', '*.gz',
+                  '*.7z')]
+
+
+class CompressionRules:
+    # one rule per line, the last one matching an entry wins:
+    #   *.dds      auto        patterns as in .modignore, matched regardless of case
+    #   gfx/*      deflate:9   store, auto, or a compression with an optional level. the level of
+    #                          auto is the one entries that shrink well are deflated with
+    #   # comment
+
+    def __init__(self, rules=()):
+        self.rules = []
+        for rule in rules:
+            self.add(rule)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({len(self.rules)} rules)'
+
+    @classmethod
+    def load(cls, root: pathlib.Path = None, defaults=()):
+        rules = cls(defaults)
+        rules_path = root / config.POLICY_FILE if root else None
+        if rules_path and rules_path.is_file():
+            with rules_path.open('r') as rules_file:
+                for line in rules_file:
+                    rules.add(line)
+            logging.debug(f'loaded {rules} from {rules_path}')
+        return rules
+
+    def add(self, rule):
+        rule = rule.strip()
+        if not rule or rule.startswith('#'):
+            return
+        try:
+            pattern, action = rule.split()
+            name, _, level = action.partition(':')
+            if name != AUTO and (name not in COMPRESSION or level and COMPRESSION[name] == ZIP_STORED):
+                raise ValueError(f'unknown compression {action}')
+            action = AUTO if name == AUTO else COMPRESSION[name], int(level) if level else None
+        except ValueError as e:
+            logging.warning(f'{e}: skipping compression rule "{rule}"')
+            return
+        pattern = pattern.lower()
+        if pattern.endswith('/'):
+            pattern += '*'
+        self.rules.append((pattern.lstrip('/'), '/' in pattern, action))
+
+    def action(self, arcname):
+        arcname = arcname.lower()
+        name = arcname.rpartition('/')[2]
+        for pattern, is_path, action in reversed(self.rules):
+            if fnmatch.fnmatchcase(arcname if is_path else name, pattern):
+                return action
+        return AUTO, None
+
+
+class CompressionPolicy:
+    # compression and level per entry: from the rules, or from how well the first POLICY_SAMPLE
+    # bytes of the entry deflate. sampled ratios are kept next to the archive under a hash of the
+    # sample, and entries whose signature did not change are not read again at all
+    VERSION = 1
+
+    def __init__(self, archive_path: pathlib.Path, rules: CompressionRules, level=None):
+        self.path = archive_path.with_suffix(config.POLICY_SUFFIX)
+        self.rules = rules
+        self.level = level
+        self.ratios = {}
+        self.entries = {}
+
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.path})'
+
+    @classmethod
+    def load(cls, archive_path: pathlib.Path, root: pathlib.Path = None, level=None):
+        policy = cls(archive_path, CompressionRules.load(root, DEFAULT_RULES), level)
+        if not policy.path.exists():
+            return policy
+
+        try:
+            with policy.path.open('r') as policy_file:
+                data = json.load(policy_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'{e}: ignoring unreadable compression cache {policy.path}')
+            return policy
+
+        if data.get('version') == cls.VERSION:
+            policy.ratios = data['ratios']
+            policy.entries = data['entries']
+        return policy
+
+    def save(self):
+        with self._lock:
+            # ratios of entries gone from the archive stay around for a while, in case they come back
+            used = {key for *_, key in self._seen.values()}
+            ratios = {key: ratio for key, ratio in self.ratios.items() if key not in used}
+            ratios = dict(list(ratios.items())[max(0, len(ratios) + len(used) - config.POLICY_CACHE_SIZE):])
+            ratios.update((key, self.ratios[key]) for key in used)
+            temp_path = self.path.with_name(f'{self.path.name}{config.TEMP_SUFFIX}')
+            with temp_path.open('w') as policy_file:
+                json.dump({'version': self.VERSION, 'ratios': ratios, 'entries': self._seen}, policy_file)
+            os.replace(temp_path, self.path)
+
+    def decide(self, zip_info, signature, opener):
+        # (compression, level) for zip_info. opener is only called when the entry has to be sampled
+        compression, level = self.rules.action(zip_info.filename)
+        if compression != AUTO:
+            return compression, level
+
+        signature = list(signature)
+        known = self.entries.get(zip_info.filename)
+        if known and known[:-1] == signature and known[-1] in self.ratios:
+            key = known[-1]
+        else:
+            with opener() as src:
+                data = src.read(config.POLICY_SAMPLE)
+            digest = hashlib.blake2b(data, digest_size=16)
+            digest.update(str(zip_info.file_size).encode())
+            key = digest.hexdigest()
+            if key not in self.ratios:
+                with metrics.timer('build.sample'):
+                    ratio = len(zlib.compress(data, 1)) / len(data) if len(data) else 1.0
+                with self._lock:
+                    self.ratios[key] = ratio
+
+        with self._lock:
+            self._seen[zip_info.filename] = [*signature, key]
+        return self.choose(self.ratios[key], level)
+
+    def choose(self, ratio, level=None):
+        # entries that barely shrink get the fastest level, those that shrink well the rule's level, or
+        # the configured one
+        if ratio > config.POLICY_STORE_RATIO:
+            return ZIP_STORED, None
+        if ratio > config.POLICY_FAST_RATIO:
+            return ZIP_DEFLATED, 1
+        return ZIP_DEFLATED, level if level is not None else self.level
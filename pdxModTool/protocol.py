@@ -0,0 +1,372 @@
+import json
+import logging
+import socket
+import struct
+
+from pdxModTool import config, metrics
+from pdxModTool.sync import FILE
+from pdxModTool.util import make_header
+from pdxModTool.wire import available, decompress
+
+MAGIC = b'PDXM'
+VERSION = 2
+CAPABILITIES = ['sync', 'resume']
+
+# frame header: type, flags, metadata length, payload length
+FRAME = struct.Struct('!BBHQ')
+
+HELLO = 1
+WELCOME = 2
+MANIFEST = 3
+PAYLOAD = 4
+END = 5
+RESUME = 6
+# swarm requests, sent in place of HELLO: the chunk map, a chunk, and a peer offering to seed
+MAP = 7
+GET = 8
+CHUNK = 9
+SEED = 10
+MISSING = 11
+# peers a swarm client could not fetch from, for the origin to stop handing out
+GONE = 16
+# parallel streams: every file announced up front, byte ranges of them, and a connection joining a transfer
+PLAN = 12
+RANGE = 13
+JOIN = 14
+# one compressed block of a file body
+DATA = 15
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def load_json(data, kind=dict):
+    # a message from the peer, which is a protocol error rather than a crash when it is malformed
+    try:
+        value = json.loads(data.decode())
+    except ValueError as e:
+        raise ProtocolError(f'malformed message: {e}')
+    if not isinstance(value, kind):
+        raise ProtocolError(f'malformed message: expected {kind.__name__}, received {type(value).__name__}')
+    return value
+
+
+class Channel:
+    # a connection plus one reusable receive buffer, shared by both protocol versions
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.game = None
+        self.count = None
+        self.sync = False
+        self.resume = False
+        self.manifest = {}
+        self.partials = {}
+        # connections the transfer is spread over, and the token the extra ones join it with
+        self.streams = 1
+        self.token = None
+        # codec for the files worth compressing, None to send everything as is
+        self.codec = None
+
+        self._buffer = bytearray(config.RECV_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+
+    def recv_into(self, view):
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if not n:
+                raise ConnectionError(f'connection closed after {received} of {len(view)} bytes')
+            received += n
+        return view
+
+    def recv_exact(self, size):
+        if size <= len(self._buffer):
+            return bytes(self.recv_into(self._view[:size]))
+        return bytes(self.recv_into(memoryview(bytearray(size))))
+
+    def recv_chunks(self, size):
+        # yields views into the shared buffer, each only valid until the next one is requested
+        remaining = size
+        while remaining:
+            n = self.sock.recv_into(self._view[:min(len(self._view), remaining)])
+            if not n:
+                raise ConnectionError(f'connection closed after {size - remaining} of {size} bytes')
+            remaining -= n
+            metrics.count('recv.bytes', n)
+            yield self._view[:n]
+
+    def send(self, data):
+        with metrics.timer('send'):
+            self.sock.sendall(data)
+        metrics.count('send.bytes', len(data))
+
+    def sendfile(self, file, offset, size, progress=None):
+        sent_total = 0
+        while sent_total < size:
+            # socket.sendfile uses os.sendfile where available, so the body never enters python
+            with metrics.timer('send.sendfile'):
+                sent = self.sock.sendfile(file, offset + sent_total, min(config.SENDFILE_SIZE, size - sent_total))
+            metrics.count('send.bytes', sent)
+            if not sent:
+                raise ConnectionError(f'{file.name} ended after {sent_total} of {size} bytes')
+            sent_total += sent
+            if progress:
+                progress.update(sent)
+
+    def recv_manifest(self, size):
+        # the client's copies, described by name
+        manifest = load_json(self.recv_exact(size))
+        if not all(isinstance(remote, dict) for remote in manifest.values()):
+            raise ProtocolError('malformed manifest')
+        self.manifest = manifest
+
+    def recv_partials(self, size):
+        # files the client kept part of, with the id, offset and crc32 of what it has
+        partials = load_json(self.recv_exact(size))
+        for partial in partials.values():
+            if not isinstance(partial, dict) or not {'id', 'offset', 'crc32'} <= partial.keys() or \
+                    not isinstance(partial['offset'], int):
+                raise ProtocolError('malformed resume request')
+        self.partials = partials
+
+    def close(self):
+        self.sock.close()
+
+
+class LegacyChannel(Channel):
+    # the original 64 byte text headers, kept for peers without frame support
+    version = 1
+
+    def __init__(self, sock):
+        super(LegacyChannel, self).__init__(sock)
+        self._announced = 0
+
+    def get_header(self):
+        return self.recv_exact(config.HEADER_SIZE).decode().strip()
+
+    # server side
+
+    def welcome(self, game, count, sync, hello=None, token=None, streams=1, codec=None):
+        # sync is only offered in a v2 WELCOME. a legacy client reads exactly count and game, and
+        # never sends a manifest
+        self.game, self.count = game, count
+        header = make_header(count, game)
+        logging.debug(f'send header: {header}')
+        self.send(header)
+
+    def announce(self, name, kind, size, extra=0, offset=0, **meta):
+        self.send(make_header(name) + make_header(size))
+
+    def finish(self):
+        # closing over bytes the client sent and nobody read (a late hello) resets the connection and
+        # loses whatever is still in the send buffer. the client hangs up once it has every file
+        self.sock.shutdown(socket.SHUT_WR)
+        self.sock.settimeout(config.HANDSHAKE_TIMEOUT)
+        try:
+            while self.sock.recv(config.HEADER_SIZE):
+                pass
+        except OSError:
+            pass
+
+    # client side
+
+    def join(self, streams=1):
+        header = self.get_header()
+        logging.debug(f'received header: {header}')
+        count, self.game = header.split(config.SEPARATOR)
+        self.count = int(count)
+
+    def send_partials(self, partials):
+        raise ProtocolError('the legacy protocol cannot resume transfers')
+
+    def next_file(self):
+        if self._announced == self.count:
+            return None
+        self._announced += 1
+
+        name = self.get_header()
+        return name, FILE, int(self.get_header()), {}
+
+
+class FrameChannel(Channel):
+    # length prefixed binary frames, negotiated with a HELLO/WELCOME handshake
+    version = VERSION
+
+    def __init__(self, sock):
+        super(FrameChannel, self).__init__(sock)
+        self._header = memoryview(bytearray(FRAME.size))
+
+    def send_frame(self, frame_type, meta=None, size=0, payload=b'', flags=0):
+        meta = json.dumps(meta).encode() if meta else b''
+        self.send(FRAME.pack(frame_type, flags, len(meta), size + len(payload)) + meta + payload)
+
+    def recv_frame(self, expected=None):
+        frame_type, flags, meta_size, size = FRAME.unpack(self.recv_into(self._header))
+        meta = load_json(self.recv_exact(meta_size)) if meta_size else {}
+        if expected is not None and frame_type != expected:
+            raise ProtocolError(f'expected frame {expected}, received {frame_type}')
+        return frame_type, flags, meta, size
+
+    # server side
+
+    def welcome(self, game, count, sync, hello=None, token=None, streams=1, codec=None):
+        # hello is given when the server already read the HELLO frame. the transfer is spread over
+        # up to streams connections when a token is given and the client asks for it, and files are
+        # compressed with codec, or zlib, when the client can decode it
+        if hello is None:
+            _, _, hello, _ = self.recv_frame(HELLO)
+        logging.debug(f'client hello: {hello}')
+        self.game, self.count = game, count
+        self.sync = sync and 'sync' in hello.get('capabilities', [])
+        self.resume = 'resume' in hello.get('capabilities', [])
+
+        capabilities = ['sync'] if self.sync else []
+        if self.resume:
+            capabilities.append('resume')
+        welcome = {'version': VERSION, 'game': game, 'count': count, 'capabilities': capabilities}
+        if token and 'streams' in hello.get('capabilities', []) and min(streams, hello.get('streams', 1)) > 1:
+            self.streams, self.token = min(streams, hello['streams']), token
+            capabilities.append('streams')
+            welcome.update(streams=self.streams, token=token)
+        if codec and 'compress' in hello.get('capabilities', []):
+            codecs = hello.get('codecs', [])
+            self.codec = codec if codec in codecs else 'zlib' if 'zlib' in codecs else None
+        if self.codec:
+            capabilities.append('compress')
+            welcome['codec'] = self.codec
+        self.send_frame(WELCOME, welcome)
+        if self.sync:
+            _, _, _, size = self.recv_frame(MANIFEST)
+            self.recv_manifest(size)
+        if self.resume:
+            _, _, _, size = self.recv_frame(RESUME)
+            self.recv_partials(size)
+
+    def announce(self, name, kind, size, extra=0, offset=0, **meta):
+        meta.update(name=name, kind=kind, size=size)
+        if offset:
+            meta['offset'] = offset
+        # a compressed body follows in DATA frames of its own
+        self.send_frame(PAYLOAD, meta, 0 if meta.get('codec') else size - offset + extra)
+
+    def send_blocks(self, blocks, progress=None):
+        for raw, block in blocks:
+            self.send_frame(DATA, {'raw': raw}, payload=block)
+            metrics.count('send.encoded_bytes', raw)
+            if progress:
+                progress.update(raw)
+
+    def finish(self):
+        self.send_frame(END)
+
+    # client side
+
+    def join(self, streams=1):
+        self.hello(streams)
+        self.recv_welcome()
+
+    def hello(self, streams=1):
+        self.send(MAGIC)
+        hello = {'version': VERSION, 'capabilities': CAPABILITIES + ['compress'], 'codecs': available()}
+        if streams > 1:
+            hello['capabilities'].append('streams')
+            hello['streams'] = streams
+        self.send_frame(HELLO, hello)
+
+    def recv_welcome(self):
+        _, _, welcome, _ = self.recv_frame(WELCOME)
+        logging.debug(f'server welcome: {welcome}')
+        self.game, self.count = welcome['game'], welcome['count']
+        self.sync = 'sync' in welcome['capabilities']
+        self.resume = 'resume' in welcome['capabilities']
+        if 'streams' in welcome['capabilities']:
+            self.streams, self.token = welcome['streams'], welcome['token']
+        self.codec = welcome.get('codec')
+
+    def send_manifest(self, manifest):
+        self.send_frame(MANIFEST, payload=manifest)
+
+    def send_partials(self, partials):
+        self.send_frame(RESUME, payload=json.dumps(partials).encode())
+
+    def recv_blocks(self, codec, size):
+        # decoded DATA frames, until size bytes came out of them
+        while size > 0:
+            _, _, meta, n = self.recv_frame(DATA)
+            try:
+                data = decompress(codec, self.recv_exact(n))
+            except ValueError as e:
+                raise ProtocolError(e)
+            if len(data) != meta.get('raw') or len(data) > size:
+                raise ProtocolError(f'block decoded to {len(data)} bytes, expected {meta.get("raw")}')
+            metrics.count('recv.bytes', n)
+            size -= len(data)
+            yield data
+
+    def next_file(self):
+        frame_type, _, meta, size = self.recv_frame()
+        if frame_type == END:
+            return None
+        if frame_type != PAYLOAD:
+            raise ProtocolError(f'unexpected frame {frame_type}')
+        return meta.pop('name'), meta.pop('kind'), meta.pop('size', size), meta
+
+
+def accept_channel(sock: socket.socket):
+    # v2 clients open with MAGIC; legacy clients wait silently for the server's text header
+    sock.settimeout(config.HANDSHAKE_TIMEOUT)
+    try:
+        magic = sock.recv(len(MAGIC), socket.MSG_WAITALL)
+    except socket.timeout:
+        magic = None
+    finally:
+        sock.settimeout(None)
+
+    if magic == MAGIC:
+        return FrameChannel(sock)
+    if magic:
+        raise ProtocolError(f'unknown handshake {magic!r}')
+    return LegacyChannel(sock)
+
+
+def open_channel(sock: socket.socket):
+    # a v2 channel for requests that skip the HELLO/WELCOME handshake
+    sock.sendall(MAGIC)
+    return FrameChannel(sock)
+
+
+def join_transfer(sock: socket.socket, token):
+    # one more connection for the transfer the server handed out token for
+    channel = open_channel(sock)
+    channel.send_frame(JOIN, {'token': token})
+    return channel
+
+
+def connect_channel(sock: socket.socket, streams=1, rtt=None):
+    # legacy servers speak first and never read, so the hello cannot go out before we know: bytes a
+    # legacy server leaves unread make it reset the connection at the end, cutting off the last file.
+    # the wait for its header is a few of the round trips the connect took, not a fixed window
+    wait = config.LEGACY_WAIT if rtt is None else min(config.LEGACY_WAIT, max(config.LEGACY_MIN,
+                                                                              config.LEGACY_RTTS * rtt))
+    sock.settimeout(wait)
+    try:
+        legacy = bool(sock.recv(1, socket.MSG_PEEK))
+    except socket.timeout:
+        legacy = False
+    finally:
+        sock.settimeout(None)
+
+    if not legacy:
+        channel = FrameChannel(sock)
+        channel.hello(streams)
+        # a server is told apart by its reply all the same: a WELCOME frame, or a late legacy header
+        if sock.recv(1, socket.MSG_PEEK) in (bytes([WELCOME]), b''):
+            channel.recv_welcome()
+            return channel
+        logging.warning('server answered with a legacy header, falling back to the legacy protocol')
+
+    channel = LegacyChannel(sock)
+    channel.join(streams)
+    return channel
@@ -0,0 +1,131 @@
+import logging
+import pathlib
+import threading
+import time
+import zlib
+from queue import SimpleQueue
+
+from pdxModTool import config, metrics
+from pdxModTool.protocol import ProtocolError, DATA
+from pdxModTool.wire import decompress
+
+
+class ReceiveEngine:
+    # reads a file body straight into a small ring of reusable buffers while a writer thread
+    # drains the filled ones to disk, so socket reads and disk writes overlap
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.fill_size = config.RECV_BUFFER_SIZE
+        self._buffers = [memoryview(bytearray(config.RECV_BUFFER_MAX)) for _ in range(config.RECV_BUFFERS)]
+
+    def receive(self, path: pathlib.Path, size, progress=None, offset=0, crc=None, checkpoint=None, channel=None,
+                codec=None):
+        # writes size bytes at offset of path. when crc is given it is carried on over the received
+        # bytes, and checkpoint(offset, crc) is called whenever a stretch of them is safely on disk.
+        # with a codec the body comes as DATA frames on channel, decoded by the writer thread
+        free = SimpleQueue()
+        filled = SimpleQueue()
+        for buffer in self._buffers:
+            free.put(buffer)
+
+        state = {'offset': offset, 'crc': crc, 'checkpoint': checkpoint, 'codec': codec, 'error': None}
+        writer = threading.Thread(target=self._write, args=(path, filled, free, state), daemon=True)
+        writer.start()
+
+        start = time.perf_counter()
+        received = 0
+        try:
+            while received < size and not state['error']:
+                # waiting for a free buffer means the disk is behind the socket
+                with metrics.timer('recv.buffer_wait'):
+                    buffer = free.get()
+                if codec:
+                    n, raw = self._fill_block(channel, buffer, size - received)
+                else:
+                    fill_start = time.perf_counter()
+                    n = raw = self._fill(buffer[:min(self.fill_size, size - received)])
+                    fill_time = time.perf_counter() - fill_start
+                    metrics.record('recv.fill', fill_time)
+                    self._adapt(fill_time, n)
+                metrics.count('recv.bytes', n)
+                filled.put((buffer, n, raw))
+                received += raw
+                if progress:
+                    progress.update(raw)
+        finally:
+            filled.put(None)
+            writer.join()
+
+        if state['error']:
+            raise state['error']
+
+        elapsed = time.perf_counter() - start
+        logging.debug(f'received {path.name}: {size} bytes in {elapsed:.2f}s '
+                      f'({size / (elapsed or 1e-9) / 1024 ** 2:.1f} MiB/s)')
+        return state['crc']
+
+    def _fill(self, view):
+        received = 0
+        while received < len(view):
+            n = self.sock.recv_into(view[received:])
+            if not n:
+                raise ConnectionError(f'connection closed after {received} of {len(view)} bytes')
+            received += n
+        return received
+
+    def _fill_block(self, channel, buffer, remaining):
+        # one DATA frame into buffer; its size, and the size it decodes to
+        _, _, meta, n = channel.recv_frame(DATA)
+        raw = meta.get('raw', 0)
+        if n > len(buffer) or not 0 < raw <= remaining:
+            raise ProtocolError(f'block of {n} bytes decoding to {raw} does not fit')
+        return self._fill(buffer[:n]), raw
+
+    def _adapt(self, elapsed, n):
+        # aim for about RECV_FILL_TIME per buffer: big buffers on fast links, small ones on slow links
+        if n == self.fill_size and elapsed < config.RECV_FILL_TIME:
+            self.fill_size = min(self.fill_size * 2, config.RECV_BUFFER_MAX)
+        elif elapsed > config.RECV_FILL_TIME * 4:
+            self.fill_size = max(self.fill_size // 2, config.RECV_BUFFER_SIZE)
+
+    @staticmethod
+    def _write(path: pathlib.Path, filled, free, state):
+        offset, crc, checkpoint, codec = state['offset'], state['crc'], state['checkpoint'], state['codec']
+        written = saved = 0
+        try:
+            with path.open('r+b' if offset else 'wb') as file:
+                file.seek(offset)
+                file.truncate()
+                while (item := filled.get()) is not None:
+                    buffer, n, raw = item
+                    data = buffer[:n]
+                    if codec:
+                        with metrics.timer('recv.decompress'):
+                            try:
+                                data = decompress(codec, data)
+                            except ValueError as e:
+                                raise ProtocolError(e)
+                        # nothing of a block that is not what its frame said goes to disk
+                        if len(data) != raw:
+                            raise ProtocolError(f'block decoded to {len(data)} bytes, expected {raw}')
+                    with metrics.timer('recv.write'):
+                        file.write(data)
+                    if crc is not None:
+                        crc = zlib.crc32(data, crc)
+                    written += len(data)
+                    free.put(buffer)
+
+                    if checkpoint and written - saved >= config.RESUME_CHECKPOINT:
+                        file.flush()
+                        checkpoint(offset + written, crc)
+                        saved = written
+        except BaseException as e:
+            state['error'] = e
+            # keep recycling buffers so the reader never blocks on a dead writer
+            while (item := filled.get()) is not None:
+                free.put(item[0])
+        finally:
+            state['crc'] = crc
+            if checkpoint:
+                checkpoint(offset + written, crc)
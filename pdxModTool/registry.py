@@ -0,0 +1,153 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import threading
+
+from pdxModTool import config, descriptor
+from pdxModTool.resume import file_id, checksum
+from pdxModTool.util import get_game_dir, get_enabled_mods_desc, get_mod_path
+
+
+def stat_key(path: pathlib.Path):
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def desc_hash(path: pathlib.Path):
+    try:
+        return hashlib.blake2b(path.read_bytes(), digest_size=16).hexdigest()
+    except OSError:
+        return None
+
+
+class ModRegistry:
+    # what every descriptor of a game resolves to, kept on disk next to dlc_load.json. a record is
+    # reused for as long as its descriptor's size and mtime are unchanged, so a run costs a stat per
+    # mod instead of opening and parsing every descriptor. a descriptor saved again with the same
+    # contents is recognized by its hash and not parsed either
+    VERSION = 2
+
+    def __init__(self, game):
+        self.game = game
+        self.game_dir = get_game_dir(game)
+        self.path = self.game_dir / config.REGISTRY_FILE
+        self.mods = {}
+        self.checksums = {}
+
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.path})'
+
+    @classmethod
+    def load(cls, game):
+        registry = cls(game)
+        if not registry.path.exists():
+            return registry
+
+        try:
+            with registry.path.open('r') as registry_file:
+                data = json.load(registry_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'{e}: rebuilding unreadable mod registry {registry.path}')
+            return registry
+
+        if data.get('version') == cls.VERSION:
+            registry.mods = data['mods']
+            registry.checksums = data['checksums']
+        return registry
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            temp_path = self.path.with_name(f'{self.path.name}{config.TEMP_SUFFIX}')
+            with temp_path.open('w') as registry_file:
+                json.dump({'version': self.VERSION, 'mods': self.mods, 'checksums': self.checksums}, registry_file)
+            os.replace(temp_path, self.path)
+            self._dirty = False
+
+    def resolve(self, desc):
+        # the record of descriptor desc ("mod/<name>.mod"), None if the descriptor is gone.
+        # record['path'] is None when the descriptor points at nothing
+        desc_path = self.game_dir / desc
+        if not (key := stat_key(desc_path)):
+            return None
+
+        record = self.mods.get(desc)
+        if record and record['desc'] != key and record['hash'] == desc_hash(desc_path):
+            record['desc'] = key
+            self._dirty = True
+        if not record or record['desc'] != key:
+            record = self.mods[desc] = self.describe(desc_path, key)
+            self._dirty = True
+        elif record['path'] and (mod_key := stat_key(pathlib.Path(record['path']))) != record['mod']:
+            record['mod'] = mod_key
+            self._dirty = True
+        return record
+
+    def describe(self, desc_path: pathlib.Path, key):
+        logging.debug(f'resolving {desc_path}')
+        try:
+            mod_path = get_mod_path(self.game, desc_path)
+            name = descriptor.load(desc_path).get('name')
+        except FileNotFoundError:
+            mod_path, name = None, None
+        except descriptor.DescriptorError as e:
+            logging.warning(f'{e}: skipping unreadable descriptor {desc_path}')
+            mod_path, name = None, None
+
+        return {
+            'desc': key,
+            'hash': desc_hash(desc_path),
+            'name': name if isinstance(name, str) else desc_path.stem,
+            'path': str(mod_path) if mod_path else None,
+            'mod': stat_key(mod_path) if mod_path else None,
+        }
+
+    def enabled(self):
+        # (descriptor path, mod path, record) of the enabled mods, in load order
+        mods = []
+        for desc in get_enabled_mods_desc(self.game):
+            if (record := self.resolve(desc)) and record['path']:
+                mods.append((self.game_dir / desc, pathlib.Path(record['path']), record))
+        return mods
+
+    def content_size(self, record, measure):
+        # size of what a folder mod holds, as measure(path) sums it up. remembered in the record and
+        # measured again only once the folder's own size or mtime changes
+        with self._lock:
+            if not (cached := record.get('content')) or cached[0] != record['mod']:
+                cached = record['content'] = [record['mod'], measure(pathlib.Path(record['path']))]
+                self._dirty = True
+            return cached[1]
+
+    def checksum(self, path: pathlib.Path):
+        # crc32 of a whole file, remembered across runs for as long as its size and mtime hold
+        key = str(path)
+        source_id = file_id(path)
+        with self._lock:
+            if not (cached := self.checksums.get(key)) or cached[0] != source_id:
+                cached = self.checksums[key] = [source_id, checksum(path)]
+                self._dirty = True
+            return cached[1]
+
+
+def get_enabled_mod_paths(game, ordered=False):
+    registry = ModRegistry.load(game)
+    mods = registry.enabled()
+    registry.save()
+
+    if ordered:
+        return [(desc_path, mod_path) for desc_path, mod_path, _ in mods]
+    paths = []
+    for desc_path, mod_path, _ in mods:
+        paths.append(desc_path)
+        paths.append(mod_path)
+    return paths
@@ -0,0 +1,112 @@
+import json
+import logging
+import os
+import pathlib
+import threading
+import zlib
+
+from pdxModTool import config
+from pdxModTool.mapped import open_source
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def file_id(path: pathlib.Path):
+    stat = path.stat()
+    return f'{stat.st_size}:{stat.st_mtime_ns}'
+
+
+def checksum(path: pathlib.Path, size=None, crc=0, start=0):
+    # crc32 can be carried on from a previous value, so a prefix never has to be hashed twice
+    stat_size = path.stat().st_size
+    remaining = stat_size - start if size is None else size
+    with open_source(path, stat_size) as file:
+        if start:
+            file.seek(start)
+        while remaining and (chunk := file.read(min(config.CHUNK_SIZE, remaining))):
+            crc = zlib.crc32(chunk, crc)
+            remaining -= len(chunk)
+    return crc
+
+
+class PrefixChecksums:
+    # crc32 of one version of a file up to every checkpoint, filled in as far as it has been asked
+    # for. checking a partial download then reads at most one checkpoint's worth of the file
+
+    def __init__(self, path: pathlib.Path, step=None):
+        self.path = path
+        self.step = step if step else config.RESUME_CHECKPOINT
+        self.marks = [0]
+        self._lock = threading.Lock()
+
+    def at(self, offset):
+        index = offset // self.step
+        with self._lock:
+            while len(self.marks) <= index:
+                start = (len(self.marks) - 1) * self.step
+                self.marks.append(checksum(self.path, self.step, self.marks[-1], start))
+        return checksum(self.path, offset - index * self.step, self.marks[index], index * self.step)
+
+
+class PartialFile:
+    # a download in progress: the bytes so far in <name>.part, and how far they are known to be
+    # good in <name>.resume
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.part_path = path.with_name(f'{path.name}{config.PARTIAL_SUFFIX}')
+        self.state_path = path.with_name(f'{path.name}{config.RESUME_SUFFIX}')
+        self.state = {}
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.path})'
+
+    def load(self):
+        if not (self.part_path.exists() and self.state_path.exists()):
+            return None
+        try:
+            with self.state_path.open('r') as state_file:
+                self.state = json.load(state_file)
+        except (OSError, ValueError) as e:
+            logging.warning(f'{e}: discarding unreadable resume state {self.state_path}')
+            self.discard()
+            return None
+
+        # never trust more than what actually reached the disk
+        if self.part_path.stat().st_size < self.state['offset']:
+            self.discard()
+            return None
+        return self.state
+
+    def start(self, source_id, size):
+        self.state = {'id': source_id, 'size': size, 'offset': 0, 'crc32': 0}
+        self.save()
+
+    def checkpoint(self, offset, crc):
+        self.state['offset'] = offset
+        self.state['crc32'] = crc
+        self.save()
+
+    def save(self):
+        with self.state_path.open('w') as state_file:
+            json.dump(self.state, state_file)
+
+    def complete(self):
+        os.replace(self.part_path, self.path)
+        self.state_path.unlink(missing_ok=True)
+
+    def discard(self):
+        self.part_path.unlink(missing_ok=True)
+        self.state_path.unlink(missing_ok=True)
+        self.state = {}
+
+
+def partial_states(mod_dir: pathlib.Path):
+    states = {}
+    for state_path in mod_dir.glob(f'*{config.RESUME_SUFFIX}'):
+        partial = PartialFile(state_path.with_name(state_path.name[:-len(config.RESUME_SUFFIX)]))
+        if state := partial.load():
+            states[partial.path.name] = {'id': state['id'], 'offset': state['offset'], 'crc32': state['crc32']}
+    return states
@@ -0,0 +1,121 @@
+import fnmatch
+import logging
+import os
+import pathlib
+import time
+from zipfile import ZipInfo
+
+from pdxModTool import config
+
+# arcname standing for the whole tree
+RESCAN = '/'
+
+# files the tool keeps beside an archive it built, named after it
+OWN_SUFFIXES = (config.MANIFEST_SUFFIX, config.POLICY_SUFFIX, f'.zip{config.TEMP_SUFFIX}',
+                f'{config.POLICY_SUFFIX}{config.TEMP_SUFFIX}')
+
+
+class ModIgnore:
+    # gitignore style patterns, one per line:
+    #   name or glob   matches a file or folder of that name anywhere in the tree
+    #   a/b or /glob   matches a path relative to the mod root
+    #   trailing /     matches folders only
+    #   # comment
+
+    def __init__(self, patterns=()):
+        self.names = []
+        self.paths = []
+        for pattern in patterns:
+            self.add(pattern)
+
+    def __repr__(self):
+        return f'{type(self).__name__}({len(self.names) + len(self.paths)} patterns)'
+
+    @classmethod
+    def load(cls, root: pathlib.Path, defaults=()):
+        ignore = cls(defaults)
+        ignore_path = root / config.IGNORE_FILE
+        if ignore_path.is_file():
+            with ignore_path.open('r') as ignore_file:
+                for line in ignore_file:
+                    ignore.add(line)
+            logging.debug(f'loaded {ignore} from {ignore_path}')
+        return ignore
+
+    def add(self, pattern):
+        pattern = pattern.strip()
+        if not pattern or pattern.startswith('#'):
+            return
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if '/' in pattern:
+            self.paths.append((pattern.lstrip('/'), dir_only))
+        else:
+            self.names.append((pattern, dir_only))
+
+    def match(self, name, arcname, is_dir):
+        for pattern, dir_only in self.names:
+            if (is_dir or not dir_only) and fnmatch.fnmatchcase(name, pattern):
+                return True
+        for pattern, dir_only in self.paths:
+            if (is_dir or not dir_only) and fnmatch.fnmatchcase(arcname, pattern):
+                return True
+        return False
+
+
+class ScannedFile:
+    __slots__ = ('path', 'arcname', 'stat')
+
+    def __init__(self, path, arcname, stat):
+        self.path = path
+        self.arcname = arcname
+        self.stat = stat
+
+    def zip_info(self):
+        # what ZipInfo.from_file builds, from the stat taken during the scan
+        zip_info = ZipInfo(self.arcname, time.localtime(self.stat.st_mtime)[0:6])
+        zip_info.external_attr = (self.stat.st_mode & 0xFFFF) << 16
+        zip_info.file_size = self.stat.st_size
+        zip_info.orig_filename = self.path
+        return zip_info
+
+
+def archive_name(name):
+    # the archive name belongs to when it is one of the tool's own files, like <mod>.manifest for
+    # <mod>.zip. whether it is depends on that archive being beside it
+    for suffix in OWN_SUFFIXES:
+        if name.endswith(suffix) and len(name) > len(suffix):
+            return f'{name[:-len(suffix)]}.zip'
+    return None
+
+
+def scan_tree(root: pathlib.Path, ignore: ModIgnore):
+    # walks root with os.scandir in a stable order. ignored folders are never entered, and each
+    # file is stat'ed exactly once. linked folders are followed, except into one of their own
+    # parents, so a link back up the tree cannot loop. the manifest, policy and temp files of an
+    # archive built inside the tree are left out, other files with those suffixes are not
+    files = []
+    stat = root.stat()
+    stack = [(str(root), '', ((stat.st_dev, stat.st_ino),))]
+    while stack:
+        directory, prefix, parents = stack.pop()
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: e.name)
+        names = {entry.name for entry in entries}
+
+        folders = []
+        for entry in entries:
+            arcname = f'{prefix}{entry.name}'
+            is_dir = entry.is_dir()
+            if ignore.match(entry.name, arcname, is_dir):
+                continue
+            if is_dir:
+                stat = entry.stat()
+                if (key := (stat.st_dev, stat.st_ino)) in parents:
+                    logging.warning(f'{entry.path} links to one of its parent folders, skipping it')
+                    continue
+                folders.append((entry.path, f'{arcname}/', parents + (key,)))
+            elif entry.is_file() and archive_name(entry.name) not in names:
+                files.append(ScannedFile(pathlib.Path(entry.path), arcname, entry.stat()))
+        stack.extend(reversed(folders))
+    return files
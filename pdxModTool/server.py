@@ -1,86 +1,338 @@
+import itertools
+import json
 import logging
 import pathlib
+import secrets
 import socket
-# import threading
+import threading
+from concurrent.futures.thread import ThreadPoolExecutor
 
 from tqdm import tqdm
 
-from pdxModTool import config
-from pdxModTool.util import make_header
+from pdxModTool import config, metrics
+from pdxModTool.newzipfile import ZipFile
+from pdxModTool.protocol import accept_channel, Channel, FrameChannel, ProtocolError, HELLO, PLAN, RANGE, JOIN
+from pdxModTool.resume import file_id, PrefixChecksums
+from pdxModTool.session import Broadcast
+from pdxModTool.swarm import ChunkPlan
+from pdxModTool.sync import plan_file, encode, remote_size, SAME, FILE, DELTA, REMOTE
+from pdxModTool.wire import available, choose, compressed_blocks
+
+
+def split_ranges(files, range_size):
+    # each file's first range comes before any file's second, so descriptors and other small files
+    # go out between the ranges of the archives instead of waiting behind them
+    ranges = [[(path.name, path, offset, min(range_size, size - offset), codec)
+               for offset in range(start, size, range_size)] for path, size, codec, start in files]
+    return [task for row in itertools.zip_longest(*ranges) for task in row if task]
+
+
+class StreamTransfer:
+    # the ranges still to send to one client, taken by each of its connections as it frees up.
+    # a range whose connection fails goes back for another one to send
+
+    def __init__(self, compressor=None):
+        self.plan = None
+        self.progress = None
+        self.ready = threading.Event()
+        self._compressor = compressor
+
+    def start(self, ranges):
+        self.progress = tqdm(total=sum(task[3] for task in ranges), desc='Sending', unit='B', unit_scale=True,
+                             unit_divisor=1024)
+        self.plan = ChunkPlan(ranges)
+        self.ready.set()
+
+    def abort(self):
+        # releases connections that joined a transfer which never got to start
+        if not self.ready.is_set():
+            self.plan = ChunkPlan([])
+            self.ready.set()
+
+    def serve(self, channel: FrameChannel):
+        self.ready.wait()
+        while task := self.plan.take(()):
+            name, path, offset, size, codec = task
+            ok = False
+            try:
+                if codec:
+                    channel.send_frame(RANGE, {'name': name, 'offset': offset, 'size': size, 'codec': codec})
+                    channel.send_blocks(compressed_blocks(self._compressor, path, offset, size, codec), self.progress)
+                else:
+                    channel.send_frame(RANGE, {'name': name, 'offset': offset}, size)
+                    with path.open('rb') as file:
+                        channel.sendfile(file, offset, size, self.progress)
+                ok = True
+            finally:
+                self.plan.finish(task, ok)
+            metrics.count('send.ranges')
+        channel.finish()
 
 
 class Server:
-    # LOCK = threading.Lock()
 
-    def __init__(self, game, host_ip=None, port=None):
+    def __init__(self, game, host_ip=None, port=None, persist=False, sync=False, registry=None, session=None,
+                 window=None, streams=None, compress=None):
         self._local_socket: socket.socket = None
         self._host_ip = host_ip if host_ip else config.localHost
-        self._port = port if port else config.default_port
+        self._port = port if port is not None else config.default_port
         self._game = game
+        self._persist = persist
+        self._sync = sync
+        self._registry = registry
+        # broadcast to groups of clients instead of serving each on its own
+        self._session = session
+        self._window = window
+        # most connections a single client may spread its transfer over
+        self._streams = streams if streams else config.TRANSFER_STREAMS
+        # codec for files that shrink well, compressed a few blocks ahead of the socket by a shared pool
+        if compress and compress not in available():
+            logging.warning(f'{compress} is not available, compressing with zlib')
+            compress = 'zlib'
+        self._compress = compress
+        self._compressor = ThreadPoolExecutor(max_workers=config.WIRE_WORKERS) if compress else None
+        # a Swarm when serving chunks to swarm clients and peers, besides regular clients
+        self.swarm = None
 
         self._connections = []
+        self._served = 0
+        self._checksums = {}
+        self._checksum_lock = threading.Lock()
+        self._codecs = {}
+        self._codec_lock = threading.Lock()
+        self._transfers = {}
         self.files = []
 
     @property
     def address(self):
         return self._host_ip, self._port
 
+    @property
+    def port(self):
+        return self._local_socket.getsockname()[1] if self._local_socket else self._port
+
+    @property
+    def finished(self):
+        self._connections = [conn for conn in self._connections if conn.is_alive()]
+        return not self._persist and not self.swarm and self._served and not self._connections
+
     def close(self):
         self._local_socket.close()
+        if self._compressor:
+            self._compressor.shutdown(wait=False)
+        if self._registry:
+            self._registry.save()
 
-    def start(self):
-        logging.info(f'listening on {self._host_ip}:{self._port}')
+    def listen(self):
         self._local_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._local_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._local_socket.bind(self.address)
         self._local_socket.listen()
+        # wake up regularly so KeyboardInterrupt and the end of the last transfer are noticed
+        self._local_socket.settimeout(config.ACCEPT_TIMEOUT)
+        logging.info(f'listening on {self._host_ip}:{self.port}')
+
+    def start(self):
+        if not self._local_socket:
+            self.listen()
 
+        try:
+            if self._session or self._window:
+                self.broadcast()
+                return
+            while not self.finished:
+                try:
+                    client_socket, client_addr = self._local_socket.accept()
+                except socket.timeout:
+                    continue
+                client_socket.settimeout(None)
+                conn = threading.Thread(target=self.handle, args=(client_socket, client_addr,))
+                conn.daemon = True
+                conn.start()
+                self._connections.append(conn)
+        except KeyboardInterrupt:
+            logging.info('KeyboardInterrupt: server terminating')
+        finally:
+            self.close()
+
+    def broadcast(self):
         while True:
-            try:
-                client_socket, client_addr = self._local_socket.accept()
-                self.handle(client_socket, client_addr)
-                # conn = threading.Thread(target=self.handle, args=(client_socket, client_addr,))
-                # conn.daemon = True
-                # conn.start()
-            except KeyboardInterrupt:
-                logging.info('KeyboardInterrupt: server terminating')
-            finally:
-                self.close()
-                break
+            session = Broadcast(self._game, self.files, self._sync, self.checksum, self._session, self._window)
+            session.gather(self._local_socket)
+            session.run()
+            if not self._persist:
+                return
 
     def handle(self, client_socket: socket.socket, addr):
         logging.info(f'client connected from {addr}')
-        # self.LOCK.acquire()
+        token = None
         try:
-            self.make_connection(client_socket)
-            for path in self.files:
-                self.send_file(client_socket, path)
+            channel = accept_channel(client_socket)
+            logging.debug(f'protocol v{channel.version} with {addr}')
+            hello = None
+            if isinstance(channel, FrameChannel):
+                # extra connections of a transfer open with JOIN, swarm clients and peers with a request
+                frame = channel.recv_frame()
+                if frame[0] == JOIN:
+                    self.join_transfer(channel, frame[2].get('token'), addr)
+                    return
+                if frame[0] != HELLO:
+                    if not self.swarm:
+                        raise ProtocolError(f'unexpected frame {frame[0]}')
+                    self.swarm.serve(channel, frame, addr)
+                    return
+                hello = frame[2]
+
+            if self._streams > 1:
+                # registered before the client learns the token, so its connections can join right away
+                token = secrets.token_hex(16)
+                self._transfers[token] = StreamTransfer(self._compressor)
+            channel.welcome(self._game, len(self.files), self._sync, hello, token, self._streams, self._compress)
+            if channel.token:
+                logging.debug(f'sending over {channel.streams} connections to {addr}')
+                self.send_streams(channel, self._transfers[token])
+            else:
+                for path in self.files:
+                    self.send_file(channel, path)
+                channel.finish()
+            logging.info(f'finished sending {len(self.files)} files to {addr}')
+        except (OSError, ProtocolError) as e:
+            logging.error(f'{e}: connection to {addr} lost')
+        except (KeyError, TypeError, ValueError) as e:
+            logging.error(f'malformed request from {addr}: {e!r}')
         finally:
-            # self.LOCK.release()
+            if token:
+                self._transfers.pop(token).abort()
             client_socket.close()
+            self._served += 1
+
+    def join_transfer(self, channel: FrameChannel, token, addr):
+        if not (transfer := self._transfers.get(token)):
+            raise ProtocolError(f'{addr} tried to join an unknown transfer')
+        logging.debug(f'{addr} joined a transfer')
+        transfer.serve(channel)
+
+    def send_streams(self, channel: FrameChannel, transfer: StreamTransfer):
+        # every file is announced up front. deltas follow on this connection, and whole files are
+        # cut into ranges that all of the client's connections send at once
+        entries, files, deltas = [], [], []
+        for path in self.files:
+            with metrics.timer('send.plan'):
+                kind, plan = plan_file(path, channel.manifest.get(path.name)) if channel.sync else (FILE, None)
+            metrics.count('send.files')
+            logging.debug(f'send {path.name}: {kind}')
+
+            if kind == DELTA:
+                deltas.append((path, plan))
+                continue
+            if kind == FILE:
+                size = path.lstat().st_size
+                source_id, crc = file_id(path), self.checksum(path)
+                # a verified prefix the client already has is kept, only the ranges after it are sent
+                offset = self.resume_offset(channel, path, source_id, size) if channel.resume else 0
+                if size and offset == size:
+                    # the client's copy may still have to be moved into place
+                    entries.append({'name': path.name, 'kind': SAME, 'id': source_id, 'crc32': crc})
+                    continue
+                entries.append({'name': path.name, 'kind': kind, 'size': size, 'offset': offset, 'id': source_id,
+                                'crc32': crc})
+                files.append((path, size, self.codec(channel, path, size), offset))
+                continue
+            entries.append({'name': path.name, 'kind': kind})
+
+        channel.send_frame(PLAN, payload=json.dumps(entries).encode())
+        transfer.start(split_ranges(files, config.STREAM_RANGE))
+        for path, plan in deltas:
+            self.send_delta(channel, path, plan)
+        transfer.serve(channel)
+        transfer.progress.close()
+
+    def checksum(self, path: pathlib.Path):
+        if self._registry:
+            return self._registry.checksum(path)
+        prefixes = self.prefixes(path)
+        with metrics.timer('send.checksum'):
+            return prefixes.at(path.stat().st_size)
+
+    def prefixes(self, path: pathlib.Path):
+        # one table per version of the file. each is filled under its own lock, so hashing one file
+        # never holds up clients of another
+        key = path, file_id(path)
+        with self._checksum_lock:
+            if key not in self._checksums:
+                self._checksums[key] = PrefixChecksums(path)
+            return self._checksums[key]
+
+    def codec(self, channel: Channel, path: pathlib.Path, size):
+        # the channel's codec if path is worth compressing. decided once per version of the file
+        if not channel.codec:
+            return None
+        key = path, file_id(path)
+        with self._codec_lock:
+            if key not in self._codecs:
+                codec = self._codecs[key] = choose(path, size, channel.codec)
+                logging.debug(f'{path.name}: ' + (f'compressing with {codec}' if codec else 'not worth compressing'))
+            return self._codecs[key]
+
+    def resume_offset(self, channel: Channel, path: pathlib.Path, source_id, size):
+        partial = channel.partials.get(path.name)
+        if not partial or partial['id'] != source_id or partial['offset'] > size:
+            return 0
+        crc = self.checksum(path) if partial['offset'] == size else self.prefixes(path).at(partial['offset'])
+        if crc != partial['crc32']:
+            logging.debug(f'partial {path.name} does not match, sending it from the start')
+            return 0
+        return partial['offset']
+
+    def send_file(self, channel: Channel, path: pathlib.Path):
+        with metrics.timer('send.plan'):
+            kind, plan = plan_file(path, channel.manifest.get(path.name)) if channel.sync else (FILE, None)
+        metrics.count('send.files')
+        logging.debug(f'send {path.name}: {kind}')
+
+        if kind == FILE:
+            size = path.lstat().st_size
+            offset, meta = 0, {}
+            if channel.resume:
+                meta = {'id': file_id(path), 'crc32': self.checksum(path)}
+                offset = self.resume_offset(channel, path, meta['id'], size)
+                if size and offset == size:
+                    channel.announce(path.name, SAME, 0, **meta)
+                    return
+                if offset:
+                    logging.info(f'resuming {path.name} at {offset} of {size} bytes')
+
+            if codec := self.codec(channel, path, size):
+                meta['codec'] = codec
+            channel.announce(path.name, kind, size, offset=offset, **meta)
+            progress = tqdm(total=size, initial=offset, desc=f"Sending {path.name}", unit='B', unit_scale=True,
+                            unit_divisor=1024)
+            if codec:
+                channel.send_blocks(compressed_blocks(self._compressor, path, offset, size - offset, codec), progress)
+            else:
+                with path.open('rb') as outFile:
+                    channel.sendfile(outFile, offset, size - offset, progress)
+            progress.close()
+            return
 
-    def make_connection(self, client_socket):
-        header = make_header(len(self.files), self._game)
-        logging.debug(f'send header: {header}')
-        client_socket.sendall(header)
+        if kind != DELTA:
+            channel.announce(path.name, kind, 0)
+            return
+        self.send_delta(channel, path, plan)
 
-    @staticmethod
-    def send_file(client_socket, path: pathlib.Path):
-        name_header = make_header(path.name)
-        size_header = make_header(path.lstat().st_size)
-        logging.debug(f'send file header: {name_header, size_header}')
-        client_socket.sendall(name_header + size_header)  # TODO: potential fuck up, separate
+    def send_delta(self, channel: Channel, path: pathlib.Path, plan):
+        data = encode(plan)
+        channel.announce(path.name, DELTA, len(data), remote_size(plan))
+        channel.send(data)
 
-        progress = tqdm(range(int(size_header)), f"Sending {path.name}", unit='B', unit_scale=True,
+        progress = tqdm(total=remote_size(plan), desc=f"Patching {path.name}", unit='B', unit_scale=True,
                         unit_divisor=1024)
-        # size = int(size_header)
-        # size_sent = 0
-        with path.open('rb') as outFile:
-            for _ in progress:
-                # buffer_size = config.BUFFER_SIZE if config.BUFFER_SIZE < size - size_sent else size - size_sent
-                # if size_sent == size:
-                #     break
-                bytes_read = outFile.read(config.BUFFER_SIZE)
-                if not bytes_read:
-                    break
-                client_socket.sendall(bytes_read)
-                progress.update(len(bytes_read))
+        with ZipFile(path, 'r') as zip_file:
+            for info, entry in zip(zip_file.infolist(), plan):
+                if entry[-1] != REMOTE:
+                    continue
+                with zip_file.open_raw(info) as raw:
+                    while chunk := raw.read(config.CHUNK_SIZE):
+                        channel.send(chunk)
+                        progress.update(len(chunk))
+        progress.close()
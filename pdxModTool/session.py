@@ -0,0 +1,200 @@
+import logging
+import pathlib
+import queue
+import socket
+import threading
+import time
+
+from tqdm import tqdm
+
+from pdxModTool import config, metrics
+from pdxModTool.mapped import open_source
+from pdxModTool.protocol import accept_channel, Channel, ProtocolError
+from pdxModTool.resume import file_id, checksum
+from pdxModTool.sync import describe, is_same, SAME, FILE
+
+
+class Member:
+    # one client of a broadcast: what is queued for it, and the thread sending it. queuing never
+    # blocks; a client SESSION_BACKLOG chunks behind is dropped
+
+    def __init__(self, channel: Channel, addr, drained: threading.Condition):
+        self.channel = channel
+        self.addr = addr
+        self.queue = queue.Queue(maxsize=config.SESSION_BACKLOG)
+        self.dropped = False
+        self.moved = time.monotonic()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+        self._drained = drained
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.addr})'
+
+    def put(self, item):
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.drop(f'{self.addr} fell {config.SESSION_BACKLOG} chunks behind')
+
+    def holds_up(self):
+        # whether the broadcast should wait for this client: it is behind, but still moving
+        if self.dropped or self.queue.qsize() < config.SESSION_QUEUE:
+            return False
+        idle = time.monotonic() - self.moved
+        if idle > config.SESSION_STALL:
+            self.drop(f'{self.addr} stopped receiving for {config.SESSION_STALL}s')
+            return False
+        return idle <= config.SESSION_LAG
+
+    def drop(self, reason):
+        logging.warning(f'{reason}: dropping it from the session')
+        self.dropped = True
+        try:
+            self.channel.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def run(self):
+        try:
+            while (item := self.queue.get()) is not None:
+                self.moved = time.monotonic()
+                with self._drained:
+                    self._drained.notify_all()
+                if isinstance(item, tuple):
+                    name, kind, size, meta = item
+                    self.channel.announce(name, kind, size, **meta)
+                else:
+                    self.channel.send(item)
+            self.channel.finish()
+        except (OSError, ProtocolError) as e:
+            if not self.dropped:
+                logging.error(f'{e}: connection to {self.addr} lost')
+            self.dropped = True
+        finally:
+            self.channel.close()
+
+
+class Broadcast:
+    # sends the same files to a group of clients at once. every chunk is read from disk once and
+    # queued for each client, so disk reads do not grow with the number of players
+
+    def __init__(self, game, files, sync=False, checksum=checksum, clients=None, window=None):
+        self.game = game
+        self.files = files
+        self.sync = sync
+        self.checksum = checksum
+        self.clients = clients
+        self.window = window
+        self.members = []
+
+        self._lock = threading.Lock()
+        self._joining = []
+        self._drained = threading.Condition()
+
+    def gather(self, local_socket: socket.socket):
+        # accepts clients until there are enough of them, or the window closes with at least one
+        deadline = time.monotonic() + self.window if self.window else None
+        logging.info(f'waiting for {self.clients if self.clients else "any number of"} clients'
+                     + (f' for up to {self.window}s' if self.window else ''))
+        while True:
+            with self._lock:
+                joined = len(self.members) + len(self._joining)
+            if self.clients and joined >= self.clients:
+                break
+            if deadline and time.monotonic() >= deadline and joined:
+                break
+            try:
+                client_socket, client_addr = local_socket.accept()
+            except socket.timeout:
+                continue
+            client_socket.settimeout(None)
+            joiner = threading.Thread(target=self.join, args=(client_socket, client_addr), daemon=True)
+            with self._lock:
+                self._joining.append(joiner)
+            joiner.start()
+
+        for joiner in list(self._joining):
+            joiner.join()
+        return self.members
+
+    def join(self, client_socket: socket.socket, addr):
+        logging.info(f'client connected from {addr}')
+        try:
+            channel = accept_channel(client_socket)
+            # a client stuck in its handshake must not hold the session back
+            client_socket.settimeout(config.SESSION_STALL)
+            channel.welcome(self.game, len(self.files), self.sync)
+            client_socket.settimeout(None)
+            logging.debug(f'protocol v{channel.version} with {addr}')
+            with self._lock:
+                self.members.append(Member(channel, addr, self._drained))
+        except (OSError, ProtocolError) as e:
+            logging.error(f'{e}: connection to {addr} lost')
+            client_socket.close()
+        finally:
+            with self._lock:
+                self._joining.remove(threading.current_thread())
+
+    def run(self):
+        for member in self.members:
+            member.thread.start()
+        logging.info(f'broadcasting {len(self.files)} files to {len(self.members)} clients')
+
+        for path in self.files:
+            if not (receivers := self.announce(path)):
+                continue
+            size = path.lstat().st_size
+            progress = tqdm(total=size, desc=f'Broadcasting {path.name}', unit='B', unit_scale=True,
+                            unit_divisor=1024)
+            with open_source(path, size) as src:
+                while receivers:
+                    with metrics.timer('read'):
+                        chunk = src.read(config.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    metrics.count('session.read_bytes', len(chunk))
+                    for member in receivers:
+                        member.put(chunk)
+                    self.pace(receivers)
+                    receivers = [member for member in receivers if not member.dropped]
+                    progress.update(len(chunk))
+            progress.close()
+
+        for member in self.members:
+            member.put(None)
+        served = [member for member in self.members if not member.dropped]
+        for member in served:
+            member.thread.join()
+        logging.info(f'finished broadcasting to {len(served)} of {len(self.members)} clients')
+
+    def pace(self, members):
+        # reading keeps to the slowest client that is still moving. one that stops for SESSION_LAG
+        # is left to fall behind on its own, so the others never wait on it for longer than that
+        with metrics.timer('session.throttle'), self._drained:
+            while any(member.holds_up() for member in members):
+                self._drained.wait(config.SESSION_LAG / 4)
+
+    def announce(self, path: pathlib.Path):
+        # queues the announcement of path for every member; those that have to receive it are returned
+        metrics.count('send.files')
+        members = [member for member in self.members if not member.dropped]
+        local = None
+        if any(member.channel.sync and path.name in member.channel.manifest for member in members):
+            with metrics.timer('send.plan'):
+                local = describe(path)
+
+        size = path.lstat().st_size
+        meta = None
+        receivers = []
+        for member in members:
+            if local and is_same(local, member.channel.manifest.get(path.name)):
+                member.put((path.name, SAME, 0, {}))
+                continue
+            if member.channel.resume and meta is None:
+                meta = {'id': file_id(path), 'crc32': self.checksum(path)}
+            member.put((path.name, FILE, size, meta if member.channel.resume else {}))
+            receivers.append(member)
+        return receivers
@@ -0,0 +1,295 @@
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import random
+import shutil
+import socket
+import threading
+from collections import deque
+
+from tqdm import tqdm
+
+from pdxModTool import config, metrics
+from pdxModTool.mapped import open_source
+from pdxModTool.protocol import open_channel, Channel, ProtocolError, MAP, GET, CHUNK, SEED, MISSING, GONE
+from pdxModTool.util import get_mod_dir, make_backup, update_desc_archive_path, write_at
+
+# every file is cut into chunks of a fixed size, each with its own hash. the origin server hands out
+# the chunk map and a list of peers; clients fetch chunks from the origin and the peers at once,
+# check each one against the map, and may then serve what they hold to the clients after them
+
+
+def chunk_digest(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def chunk_hashes(path: pathlib.Path, chunk_size, size=None):
+    size = path.stat().st_size if size is None else size
+    hashes = []
+    with open_source(path, size) as src:
+        while chunk := src.read(chunk_size):
+            hashes.append(chunk_digest(chunk))
+    return hashes
+
+
+def build_map(files, chunk_size=None):
+    chunk_size = chunk_size if chunk_size else config.SWARM_CHUNK
+    with metrics.timer('swarm.hash'):
+        return {
+            'chunk_size': chunk_size,
+            'files': [{'name': path.name, 'size': path.stat().st_size, 'hashes': chunk_hashes(path, chunk_size)}
+                      for path in files],
+        }
+
+
+class Swarm:
+    # the server side, shared by the origin and seeding peers: files by name, their chunk map, and
+    # the peers that announced they can serve them
+
+    def __init__(self, game, files, chunk_map=None):
+        self.game = game
+        self.paths = {path.name: path for path in files}
+        self.chunk_map = chunk_map if chunk_map else build_map(files)
+        self.sizes = {file['name']: file['size'] for file in self.chunk_map['files']}
+        self.peers = []
+
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({len(self.paths)} files, {len(self.peers)} peers)'
+
+    def serve(self, channel: Channel, frame, addr):
+        # answers requests until the client hangs up; frame is the first one, already read
+        while True:
+            frame_type, _, meta, size = frame
+            if frame_type == MAP:
+                with self._lock:
+                    peers = list(self.peers)
+                channel.send_frame(MAP, payload=json.dumps({**self.chunk_map, 'game': self.game,
+                                                            'peers': peers}).encode())
+            elif frame_type == GET:
+                self.send_chunk(channel, meta['name'], meta['index'])
+            elif frame_type == SEED:
+                with self._lock:
+                    if (peer := [addr[0], meta['port']]) not in self.peers:
+                        self.peers.append(peer)
+                logging.info(f'{addr[0]}:{meta["port"]} joined the swarm')
+            elif frame_type == GONE:
+                with self._lock:
+                    self.peers = [peer for peer in self.peers if peer not in meta['peers']]
+                logging.info(f'{len(meta["peers"])} peers left the swarm')
+            else:
+                raise ProtocolError(f'unexpected frame {frame_type} from swarm client')
+
+            try:
+                frame = channel.recv_frame()
+            except ConnectionError:
+                return
+
+    def send_chunk(self, channel: Channel, name, index):
+        chunk_size = self.chunk_map['chunk_size']
+        offset = index * chunk_size
+        path = self.paths.get(name)
+        if path is None or offset >= self.sizes.get(name, 0):
+            channel.send_frame(MISSING, {'name': name, 'index': index})
+            return
+        size = min(chunk_size, self.sizes[name] - offset)
+        channel.send_frame(CHUNK, {'name': name, 'index': index}, size)
+        with path.open('rb') as file:
+            channel.sendfile(file, offset, size)
+
+
+class ChunkPlan:
+    # the chunks still to fetch, handed out to one worker per source
+
+    def __init__(self, tasks):
+        self.pending = deque(tasks)
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def take(self, skip):
+        # next chunk of a file not in skip; None once nothing is left this source could fetch
+        with self._cond:
+            while True:
+                for index, task in enumerate(self.pending):
+                    if task[0] not in skip:
+                        del self.pending[index]
+                        self.active += 1
+                        return task
+                if not self.active:
+                    return None
+                self._cond.wait()
+
+    def finish(self, task, ok):
+        with self._cond:
+            self.active -= 1
+            if not ok:
+                self.pending.appendleft(task)
+            self._cond.notify_all()
+
+
+class SwarmClient:
+
+    def __init__(self):
+        self.game = None
+        self.desc_paths = []
+        self.chunk_map = None
+        self.paths = []
+
+        self._origin = None
+        self._gone = []
+        self._specs = {}
+        self._files = {}
+        self._progress = None
+
+    def fetch(self, server_ip, port=None):
+        origin = self._origin = (server_ip, port if port else config.default_port)
+        logging.info(f'fetching chunk map from {origin[0]}:{origin[1]}')
+        with socket.create_connection(origin) as sock:
+            channel = open_channel(sock)
+            channel.send_frame(MAP)
+            _, _, _, size = channel.recv_frame(MAP)
+            swarm = json.loads(channel.recv_exact(size).decode())
+        self.game = swarm.pop('game')
+        peers = [tuple(peer) for peer in swarm.pop('peers')]
+        self.chunk_map = swarm
+        self._specs = {file['name']: file for file in swarm['files']}
+
+        mod_dir = get_mod_dir(self.game)
+        tasks = []
+        for file in self.chunk_map['files']:
+            tasks.extend((file['name'], index) for index in self.prepare(mod_dir, file))
+
+        sources = [origin] + random.sample(peers, min(len(peers), config.SWARM_SOURCES))
+        total = sum(self.chunk_size(name, index) for name, index in tasks)
+        logging.info(f'{len(tasks)} chunks to fetch from {len(sources)} sources')
+        plan = ChunkPlan(tasks)
+        self._progress = tqdm(total=total, desc='Receiving', unit='B', unit_scale=True, unit_divisor=1024,
+                              mininterval=config.PROGRESS_INTERVAL)
+        try:
+            workers = [threading.Thread(target=self.work, args=(plan, source), daemon=True) for source in sources]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        finally:
+            self._progress.close()
+            for file in self._files.values():
+                file.close()
+
+        if self._gone:
+            self.report_gone()
+        if plan.pending:
+            raise ConnectionError(f'{len(plan.pending)} chunks could not be fetched from any source')
+        for file in self.chunk_map['files']:
+            self.complete(mod_dir / file['name'])
+
+    def chunk_size(self, name, index):
+        return min(self.chunk_map['chunk_size'], self._specs[name]['size'] - index * self.chunk_map['chunk_size'])
+
+    def prepare(self, mod_dir: pathlib.Path, file):
+        # indexes of the chunks missing locally. good chunks of an earlier partial download, or of an
+        # older copy of the file, are kept
+        path = mod_dir / file['name']
+        part_path = path.with_name(f'{path.name}{config.PARTIAL_SUFFIX}')
+        self.paths.append(path)
+        if not file['size'] and not path.exists():
+            path.touch()
+
+        missing = list(range(len(file['hashes'])))
+        for base in (part_path, path):
+            if base.exists() and base.stat().st_size == file['size']:
+                hashes = chunk_hashes(base, self.chunk_map['chunk_size'], file['size'])
+                missing = [index for index, digest in enumerate(file['hashes']) if hashes[index] != digest]
+                if not missing and base == path:
+                    part_path.unlink(missing_ok=True)
+                    logging.info(f'{path.name} is up to date')
+                if missing and base == path:
+                    shutil.copyfile(path, part_path)
+                break
+        if not missing:
+            return []
+
+        if not part_path.exists() or part_path.stat().st_size != file['size']:
+            with part_path.open('wb') as part_file:
+                part_file.truncate(file['size'])
+        self._files[file['name']] = part_path.open('r+b')
+        return missing
+
+    def work(self, plan: ChunkPlan, source):
+        # fetches chunks from one source until there are none left; a source that fails or sends a
+        # chunk that does not match the map is given up on
+        skip = set()
+        fetched = 0
+        try:
+            sock = socket.create_connection(source, timeout=config.SWARM_TIMEOUT)
+        except OSError as e:
+            logging.warning(f'{e}: skipping swarm source {source[0]}:{source[1]}')
+            self.drop(source)
+            return
+
+        with sock:
+            channel = open_channel(sock)
+            while task := plan.take(skip):
+                ok = False
+                try:
+                    ok = self.fetch_chunk(channel, *task)
+                    if not ok:
+                        skip.add(task[0])
+                    fetched += ok
+                except (OSError, ProtocolError, ValueError) as e:
+                    logging.warning(f'{e}: giving up on swarm source {source[0]}:{source[1]}')
+                    self.drop(source)
+                    return
+                finally:
+                    plan.finish(task, ok)
+        logging.debug(f'{fetched} chunks from {source[0]}:{source[1]}')
+
+    def drop(self, source):
+        if source != self._origin:
+            self._gone.append(list(source))
+
+    def report_gone(self):
+        # so the origin stops handing out peers that are down or serve bad chunks
+        try:
+            with socket.create_connection(self._origin, timeout=config.SWARM_TIMEOUT) as sock:
+                open_channel(sock).send_frame(GONE, {'peers': self._gone})
+        except OSError as e:
+            logging.warning(f'{e}: could not report unreachable peers to the origin')
+
+    def fetch_chunk(self, channel: Channel, name, index):
+        channel.send_frame(GET, {'name': name, 'index': index})
+        frame_type, _, meta, size = channel.recv_frame()
+        if frame_type == MISSING:
+            return False
+        if frame_type != CHUNK or meta != {'name': name, 'index': index}:
+            raise ProtocolError(f'expected chunk {index} of {name}, received frame {frame_type} {meta}')
+
+        data = channel.recv_exact(size)
+        if size != self.chunk_size(name, index) or chunk_digest(data) != self._specs[name]['hashes'][index]:
+            raise ValueError(f'chunk {index} of {name} does not match the chunk map')
+
+        write_at(self._files[name], data, index * self.chunk_map['chunk_size'])
+        metrics.count('swarm.chunks')
+        self._progress.update(size)
+        return True
+
+    def complete(self, path: pathlib.Path):
+        part_path = path.with_name(f'{path.name}{config.PARTIAL_SUFFIX}')
+        if part_path.exists():
+            if path.exists():
+                make_backup(path)
+            os.replace(part_path, path)
+        if path.suffix == '.mod':
+            self.desc_paths.append(f'mod/{path.name}')
+            update_desc_archive_path(path)
+
+    def seed(self, server):
+        # serves the files just fetched to later clients, after telling the origin about it
+        server.listen()
+        logging.info(f'seeding on port {server.port}')
+        with socket.create_connection(self._origin) as sock:
+            open_channel(sock).send_frame(SEED, {'port': server.port})
+        server.start()
@@ -0,0 +1,131 @@
+import hashlib
+import json
+import logging
+import pathlib
+from zipfile import ZipInfo, BadZipFile
+
+from pdxModTool import config, descriptor
+from pdxModTool.mapped import open_source
+from pdxModTool.newzipfile import ZipFile, raw_info
+
+SAME = 'same'
+FILE = 'file'
+DELTA = 'delta'
+
+LOCAL = 'local'
+REMOTE = 'remote'
+
+
+def file_hash(path: pathlib.Path):
+    digest = hashlib.sha256()
+    with open_source(path, path.stat().st_size) as file:
+        while chunk := file.read(config.CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_key(path: pathlib.Path):
+    # size and hash a copy is compared by. every client points a descriptor's archive at its own
+    # copy of the mod, so descriptors are compared without that line
+    if path.suffix == '.mod':
+        try:
+            desc = descriptor.load(path).copy()
+        except descriptor.DescriptorError as e:
+            logging.debug(f'{path} is not a valid descriptor, describing it by hash: {e}')
+        else:
+            desc.remove('archive')
+            data = desc.dump().encode(descriptor.ENCODING, descriptor.ERRORS)
+            return len(data), hashlib.sha256(data).hexdigest()
+    return path.stat().st_size, file_hash(path)
+
+
+def entry_key(zip_info):
+    return zip_info.CRC, zip_info.file_size
+
+
+def archive_entries(path):
+    with ZipFile(path, 'r') as zip_file:
+        return [[info.filename, *entry_key(info)] for info in zip_file.infolist()]
+
+
+def describe(path: pathlib.Path):
+    if path.suffix == '.zip':
+        try:
+            return {'size': path.stat().st_size, 'entries': archive_entries(path)}
+        except BadZipFile:
+            logging.debug(f'{path} is not a valid zip, describing it by hash')
+    size, digest = content_key(path)
+    return {'size': size, 'sha256': digest}
+
+
+def local_manifest(mod_dir: pathlib.Path):
+    manifest = {}
+    for path in mod_dir.iterdir():
+        if path.is_file() and path.suffix not in (config.TEMP_SUFFIX, config.PARTIAL_SUFFIX, config.RESUME_SUFFIX):
+            manifest[path.name] = describe(path)
+    return manifest
+
+
+def encode(manifest):
+    return json.dumps(manifest).encode()
+
+
+def decode(data):
+    return json.loads(data.decode())
+
+
+def plan_file(path: pathlib.Path, remote):
+    # what to send for path, given the client's description of its copy
+    if not remote:
+        return FILE, None
+
+    if 'entries' in remote:
+        if path.suffix != '.zip':
+            return FILE, None
+        with ZipFile(path, 'r') as zip_file:
+            infos = zip_file.infolist()
+            if [[info.filename, *entry_key(info)] for info in infos] == remote['entries']:
+                return SAME, None
+            keys = {tuple(entry[1:]) for entry in remote['entries']}
+            return DELTA, [plan_entry(info, LOCAL if entry_key(info) in keys else REMOTE) for info in infos]
+
+    if (remote.get('size'), remote.get('sha256')) == content_key(path):
+        return SAME, None
+    return FILE, None
+
+
+def is_same(local, remote):
+    # compares two describe() results the way plan_file compares a file with its remote copy
+    if not remote:
+        return False
+    if 'entries' in local:
+        return remote.get('entries') == local['entries']
+    return remote.get('size') == local['size'] and remote.get('sha256') == local['sha256']
+
+
+def plan_entry(zip_info, source):
+    return [zip_info.filename, list(zip_info.date_time), zip_info.compress_type, zip_info.flag_bits,
+            zip_info.external_attr, zip_info.CRC, zip_info.compress_size, zip_info.file_size, source]
+
+
+def planned_info(entry):
+    filename, date_time, compress_type, flag_bits, external_attr, crc, compress_size, file_size, source = entry
+    info = ZipInfo(filename, tuple(date_time))
+    info.compress_type = compress_type
+    info.flag_bits = flag_bits
+    info.external_attr = external_attr
+    info.CRC = crc
+    info.compress_size = compress_size
+    info.file_size = file_size
+    return info, source
+
+
+def local_info(zip_info, filename):
+    info = raw_info(zip_info)
+    info.filename = filename
+    return info
+
+
+def remote_size(plan):
+    return sum(entry[6] for entry in plan if entry[-1] == REMOTE)
+
@@ -1,16 +1,51 @@
 import json
+import os
 import pathlib
-import re
+import shutil
+import threading
 import zipfile
 
-from pdxModTool import config, game_options
+from pdxModTool import config, descriptor, game_options
 from pdxModTool.exceptions import ModFolderNotFound
 
 
+_write_lock = threading.Lock()
+
+
 def make_backup(path):
     pass
 
 
+def write_at(file, data, offset):
+    # positioned write; threads may write different parts of one file at once
+    if hasattr(os, 'pwrite'):
+        view = memoryview(data)
+        while view:
+            n = os.pwrite(file.fileno(), view, offset)
+            view = view[n:]
+            offset += n
+        return
+    with _write_lock:
+        file.seek(offset)
+        file.write(data)
+
+
+def unshare(path: pathlib.Path, keep=False):
+    # a file hard linked elsewhere (a cached artifact) is made private before it is written to, so the
+    # other links keep their bytes. keep copies the contents over for updating them in place
+    try:
+        if path.stat().st_nlink == 1:
+            return
+    except FileNotFoundError:
+        return
+    if not keep:
+        path.unlink()
+        return
+    temp_path = path.with_name(f'{path.name}{config.TEMP_SUFFIX}')
+    shutil.copy2(path, temp_path)
+    os.replace(temp_path, path)
+
+
 def get_doc_dir():
     doc_dir = pathlib.Path().home() / 'OneDrive/Documents'
     if (doc_dir / 'Paradox Interactive').exists():
@@ -55,38 +90,14 @@ def get_mod_path(game, desc_path: pathlib.Path):
         else:
             return pathlib.Path(match)
 
-    with desc_path.open('r') as desc_file:
-        desc = desc_file.read()
-
-        if archive_match := re.search(r'archive="(.*)"', desc):
-            return resolve_path(archive_match.group(1))
-
-        if path_match := re.search(r'path="(.*)"', desc):
-            return resolve_path(path_match.group(1))
+    desc = descriptor.load(desc_path)
+    for key in ('archive', 'path'):
+        if isinstance(value := desc.get(key), str):
+            return resolve_path(value)
 
     raise FileNotFoundError
 
 
-def get_enabled_mod_paths(game, ordered=False):
-    enabled_mods_desc = get_enabled_mods_desc(game)
-    game_dir = get_game_dir(game)
-    paths = []
-
-    for mod in enabled_mods_desc:
-        desc_path = game_dir / mod
-        try:
-            mod_path = get_mod_path(game, desc_path)
-        except FileNotFoundError:
-            continue
-        if ordered:
-            paths.append((desc_path, mod_path))
-        else:
-            paths.append(desc_path)
-            paths.append(mod_path)
-
-    return paths
-
-
 def make_header(*args):
     msg = f'{config.SEPARATOR}'.join(list(map(str, args)))
     return f'{msg:<{config.HEADER_SIZE}}'.encode()
@@ -101,14 +112,10 @@ def files_from_bin(path):
 
 
 def update_desc_archive_path(desc_path: pathlib.Path):
-    desc = []
-    with desc_path.open('r') as in_desc:
-        desc = in_desc.readlines()
-
-    idx = desc.index(*filter(lambda s: s.startswith("archive"), desc))
-    desc[idx] = '='.join(
-        desc[idx].split('=')[0:1] + [
-            f'"{pathlib.Path("/".join(desc_path.parts[-2:])).with_suffix(".zip").as_posix()}"\n'])
+    desc = descriptor.load(desc_path).copy()
+    archive = pathlib.Path('/'.join(desc_path.parts[-2:])).with_suffix('.zip').as_posix()
+    if desc.get('archive') in (None, archive):
+        return
 
-    with desc_path.open('w') as out_desc:
-        out_desc.writelines(desc)
+    desc.set('archive', archive)
+    descriptor.save(desc, desc_path)
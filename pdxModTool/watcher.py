@@ -0,0 +1,219 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import pathlib
+import select
+import struct
+import sys
+import time
+
+from pdxModTool import config
+from pdxModTool.scanner import RESCAN, ModIgnore, archive_name, scan_tree
+
+# watchers report what changed under a mod root as a set of arcnames. folders end with '/', and
+# RESCAN stands for "anything may have changed"
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+EVENT = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    # rescans the tree every interval seconds and compares sizes and mtimes
+
+    def __init__(self, root: pathlib.Path, ignore: ModIgnore, interval=None):
+        self.root = root
+        self.ignore = ignore
+        self.interval = interval if interval else config.WATCH_INTERVAL
+        self._snapshot = self._scan()
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.root})'
+
+    def _scan(self):
+        snapshot = {src.arcname: (src.stat.st_size, src.stat.st_mtime_ns) for src in scan_tree(self.root, self.ignore)}
+        # the ignore file is not part of the tree, but changes what is
+        try:
+            stat = os.stat(self.root / config.IGNORE_FILE)
+            snapshot[RESCAN] = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            pass
+        return snapshot
+
+    def reload(self, ignore):
+        self.ignore = ignore
+        self._snapshot = self._scan()
+
+    def wait(self, timeout=None):
+        # changes since the last call; blocks until there are some when timeout is None
+        while True:
+            time.sleep(self.interval if timeout is None else timeout)
+            snapshot = self._scan()
+            changed = {arcname for arcname in snapshot.keys() | self._snapshot.keys()
+                       if snapshot.get(arcname) != self._snapshot.get(arcname)}
+            self._snapshot = snapshot
+            if changed or timeout is not None:
+                return changed
+
+    def close(self):
+        self._snapshot = None
+
+
+class InotifyWatcher:
+    # one inotify watch per folder of the tree, ignored folders excluded. linux only
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+        | IN_DELETE_SELF | IN_MOVE_SELF
+
+    def __init__(self, root: pathlib.Path, ignore: ModIgnore):
+        if not sys.platform.startswith('linux'):
+            raise OSError(f'inotify is not available on {sys.platform}')
+        self.root = root
+        self.ignore = ignore
+
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self._prefixes = {}
+        self._add_tree(str(root), '')
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.root})'
+
+    def _add_tree(self, directory, prefix):
+        stack = [(directory, prefix)]
+        while stack:
+            directory, prefix = stack.pop()
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(directory), self.MASK)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                logging.warning(f'{os.strerror(errno)}: not watching {directory}')
+                continue
+            self._prefixes[wd] = prefix
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        arcname = f'{prefix}{entry.name}'
+                        if entry.is_dir(follow_symlinks=False) and not self.ignore.match(entry.name, arcname, True):
+                            stack.append((entry.path, f'{arcname}/'))
+            except OSError as e:
+                logging.debug(f'{e}: not watching inside {directory}')
+
+    def reload(self, ignore):
+        self.ignore = ignore
+        for wd in list(self._prefixes):
+            self._libc.inotify_rm_watch(self._fd, wd)
+        self._prefixes = {}
+        self._add_tree(str(self.root), '')
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not select.select([self._fd], [], [], remaining)[0]:
+                return set()
+            if changed := self._read():
+                return changed
+            if deadline is not None and time.monotonic() >= deadline:
+                return set()
+
+    def _read(self):
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + EVENT.size:pos + EVENT.size + length].rstrip(b'\0'))
+            pos += EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                changed.add(RESCAN)
+                continue
+            if mask & IN_IGNORED:
+                self._prefixes.pop(wd, None)
+                continue
+            if (prefix := self._prefixes.get(wd)) is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.add(prefix if prefix else RESCAN)
+                continue
+
+            is_dir = bool(mask & IN_ISDIR)
+            arcname = f'{prefix}{name}'
+            if name == config.IGNORE_FILE and not prefix:
+                changed.add(RESCAN)
+                continue
+            if self.ignore.match(name, arcname, is_dir):
+                continue
+            # the manifest or temp file of an archive being built in the tree
+            if not is_dir and (archive := archive_name(name)) and \
+                    os.path.exists(os.path.join(self.root, prefix, archive)):
+                continue
+            if is_dir:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._add_tree(os.path.join(self.root, arcname), f'{arcname}/')
+                changed.add(f'{arcname}/')
+            else:
+                changed.add(arcname)
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def get_watcher(root: pathlib.Path, ignore: ModIgnore, poll=False, interval=None):
+    if not poll:
+        try:
+            return InotifyWatcher(root, ignore)
+        except (OSError, AttributeError) as e:
+            logging.info(f'{e}: polling for changes instead')
+    return PollingWatcher(root, ignore, interval)
+
+
+def watch(mod, mod_dir: pathlib.Path, poll=False, interval=None, **build_args):
+    # keeps the installed copy of a source folder mod current: each settled batch of changes
+    # re-stats only what changed and updates the installed archive in place
+    handler = mod.handler
+    watcher = get_watcher(handler.path, handler.ignore, poll, interval)
+    logging.info(f'watching {handler.path} with {type(watcher).__name__}, ctrl+c to stop')
+    try:
+        while True:
+            changed = watcher.wait()
+            # let a burst of saves settle before building
+            while more := watcher.wait(config.WATCH_DEBOUNCE):
+                changed |= more
+            start = time.perf_counter()
+            logging.debug(f'changed: {sorted(changed)}')
+
+            handler.update(changed)
+            if RESCAN in changed:
+                watcher.reload(handler.ignore)
+            if 'descriptor.mod' in changed:
+                mod.reload_descriptor()
+            try:
+                mod.build(mod_dir, desc=True, in_place=True, **build_args)
+            except (FileNotFoundError, PermissionError):
+                # already logged by the handler, the next change gets another try
+                continue
+            logging.info(f'updated {mod.name} ({len(changed)} changes) in {time.perf_counter() - start:.2f}s')
+    finally:
+        watcher.close()
@@ -0,0 +1,80 @@
+import zlib
+from collections import deque
+
+from pdxModTool import config, metrics
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+DECODE_ERRORS = (zlib.error, lzma.LZMAError) if lzma else (zlib.error,)
+
+# files can go over the wire as a series of blocks, each compressed on its own. the codec is
+# negotiated per connection, and whether a file is worth compressing is decided from a few
+# samples of it, so archives of already compressed assets are still sent as they are
+
+
+def available():
+    return ['zlib', 'lzma'] if lzma else ['zlib']
+
+
+def compress(codec, data):
+    if codec == 'lzma':
+        return lzma.compress(data, preset=config.WIRE_LZMA_PRESET)
+    return zlib.compress(data, config.WIRE_ZLIB_LEVEL)
+
+
+def decompress(codec, data):
+    try:
+        if codec == 'lzma' and lzma:
+            return lzma.decompress(data)
+        if codec == 'zlib':
+            return zlib.decompress(data)
+    except DECODE_ERRORS as e:
+        raise ValueError(f'{codec} block does not decode: {e}')
+    raise ValueError(f'unsupported codec {codec}')
+
+
+def sample_ratio(path, size):
+    # compressed over raw size of WIRE_SAMPLES stretches spread over the file, at a fast level
+    count = config.WIRE_SAMPLES if size > config.WIRE_SAMPLE * config.WIRE_SAMPLES else 1
+    raw = packed = 0
+    with path.open('rb') as file:
+        for index in range(count):
+            file.seek(size * index // count)
+            data = file.read(config.WIRE_SAMPLE if count > 1 else size)
+            raw += len(data)
+            packed += len(zlib.compress(data, 1))
+    return packed / raw if raw else 1.0
+
+
+def choose(path, size, codec):
+    # codec when samples of path shrink enough to be worth the cpu, None otherwise
+    if not codec or not size:
+        return None
+    with metrics.timer('send.sample'):
+        ratio = sample_ratio(path, size)
+    return codec if ratio <= config.WIRE_RATIO else None
+
+
+def compressed_blocks(executor, path, offset, size, codec):
+    # (raw size, block) pairs of size bytes of path at offset. executor compresses a few blocks
+    # ahead of the one being sent, so the socket is not kept waiting on the codec
+    pending = deque()
+    remaining = size
+    with path.open('rb') as file:
+        file.seek(offset)
+        while remaining or pending:
+            while remaining and len(pending) < config.WIRE_WORKERS * 2:
+                with metrics.timer('read'):
+                    data = file.read(min(config.WIRE_BLOCK, remaining))
+                if not data:
+                    raise ConnectionError(f'{path.name} ended {remaining} bytes early')
+                remaining -= len(data)
+                pending.append((len(data), executor.submit(compress, codec, data)))
+
+            raw, future = pending.popleft()
+            with metrics.timer('send.compress_wait'):
+                block = future.result()
+            yield raw, block
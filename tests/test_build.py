@@ -0,0 +1,256 @@
+import logging
+import random
+import threading
+import zipfile
+import zlib
+from concurrent.futures.process import ProcessPoolExecutor
+
+import pytest
+
+from pdxModTool import config
+from pdxModTool.compression import AUTO
+from pdxModTool.handler import BinHandler, PathHandler
+from pdxModTool.manifest import Manifest
+from pdxModTool.newzipfile import ZipFile
+from pdxModTool.pipeline import ByteBudget
+
+SCRIPT = b'pdx_test = { modifier = { value = 1 } }\n'
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+@pytest.fixture
+def mod(tmp_path):
+    # a mod source with script that deflates well, noise that does not, and media that never should
+    rng = random.Random(0)
+    path = tmp_path / 'mod'
+    for name, data in [
+        ('descriptor.mod', b'name="test"\n'),
+        ('common/script.txt', SCRIPT * 2000),
+        ('common/other.txt', SCRIPT * 50),
+        ('events/events.txt', SCRIPT * 300),
+        ('gfx/noise.dds', random_bytes(rng, 300 * 1024)),
+        ('gfx/flat.dds', bytes(200 * 1024)),
+        ('gfx/icon.png', SCRIPT * 100),
+        ('music/theme.ogg', SCRIPT * 100),
+    ]:
+        (path / name).parent.mkdir(parents=True, exist_ok=True)
+        (path / name).write_bytes(data)
+    return path
+
+
+def build(path, archive, **kwargs):
+    handler = PathHandler(path)
+    try:
+        handler.build(archive, **kwargs)
+    finally:
+        handler.close()
+    return handler
+
+
+def check(archive, path):
+    # compress_type by arcname, after checking every entry against its source
+    with zipfile.ZipFile(archive) as zip_file:
+        assert zip_file.testzip() is None
+        for info in zip_file.infolist():
+            data = (path / info.filename).read_bytes()
+            assert zip_file.read(info) == data
+            assert info.CRC == zlib.crc32(data)
+        return {info.filename: info.compress_type for info in zip_file.infolist()}
+
+
+def test_auto(mod, tmp_path):
+    archive = tmp_path / 'mod.zip'
+    build(mod, archive, compression=AUTO, level=9)
+    compress_types = check(archive, mod)
+    # media is stored whatever it holds, noise because it does not shrink
+    assert compress_types['gfx/icon.png'] == compress_types['music/theme.ogg'] == zipfile.ZIP_STORED
+    assert compress_types['gfx/noise.dds'] == zipfile.ZIP_STORED
+    assert compress_types['common/script.txt'] == compress_types['gfx/flat.dds'] == zipfile.ZIP_DEFLATED
+
+
+def test_rules(mod, tmp_path):
+    # the last rule matching an entry wins
+    (mod / config.POLICY_FILE).write_text('# rules\n*.txt store\ncommon/ deflate\ncommon/other.txt store\n'
+                                          '*.png lzma\n*.dds auto:5\nbad rule here\n')
+    archive = tmp_path / 'mod.zip'
+    build(mod, archive, compression=AUTO, level=9)
+    compress_types = check(archive, mod)
+    assert config.POLICY_FILE not in compress_types
+    assert compress_types['common/script.txt'] == zipfile.ZIP_DEFLATED
+    assert compress_types['common/other.txt'] == compress_types['events/events.txt'] == zipfile.ZIP_STORED
+    assert compress_types['gfx/icon.png'] == zipfile.ZIP_LZMA
+    assert compress_types['music/theme.ogg'] == zipfile.ZIP_STORED
+
+    # auto:5 keeps choosing per entry, and deflates what shrinks well at its own level
+    handler = PathHandler(mod)
+    handler.decide_compression(archive, 9)
+    assert handler.decisions['gfx/noise.dds'] == (zipfile.ZIP_STORED, None)
+    assert handler.decisions['gfx/flat.dds'] == (zipfile.ZIP_DEFLATED, 5)
+    assert handler.decisions['events/events.txt'] == (zipfile.ZIP_STORED, None)
+
+
+def test_policy_cache(mod, tmp_path, monkeypatch):
+    archive = tmp_path / 'mod.zip'
+    build(mod, archive, compression=AUTO, level=9)
+    assert archive.with_suffix(config.POLICY_SUFFIX).exists()
+
+    # unchanged entries are decided from the cache without being read again
+    handler = PathHandler(mod)
+    monkeypatch.setattr(handler, '_open', lambda zip_info: pytest.fail(f'{zip_info.filename} sampled again'))
+    handler.decide_compression(archive, 9)
+    assert handler.decisions['gfx/noise.dds'] == (zipfile.ZIP_STORED, None)
+    assert handler.decisions['common/script.txt'] == (zipfile.ZIP_DEFLATED, 9)
+
+    # an edited one is sampled again
+    (mod / 'gfx/flat.dds').write_bytes(random_bytes(random.Random(1), 200 * 1024))
+    handler = PathHandler(mod)
+    sampled = []
+    opener = handler._open
+    monkeypatch.setattr(handler, '_open', lambda zip_info: sampled.append(zip_info.filename) or opener(zip_info))
+    handler.decide_compression(archive, 9)
+    assert sampled == ['gfx/flat.dds']
+    assert handler.decisions['gfx/flat.dds'] == (zipfile.ZIP_STORED, None)
+
+
+
+def raw_entries(archive):
+    # as stored in the archive, compressed
+    with ZipFile(archive, 'r') as zip_file:
+        return {info.filename: (info.compress_type, info.CRC, zip_file.read_raw(info)) for info in zip_file.infolist()}
+
+
+def test_incremental(mod, tmp_path, caplog):
+    archive = tmp_path / 'mod.zip'
+    build(mod, archive, incremental=True, compression=zipfile.ZIP_DEFLATED)
+    before = raw_entries(archive)
+    assert archive.with_suffix(config.MANIFEST_SUFFIX).exists()
+
+    (mod / 'common/other.txt').write_bytes(SCRIPT * 60)
+    with caplog.at_level(logging.DEBUG):
+        build(mod, archive, incremental=True, compression=zipfile.ZIP_DEFLATED)
+    assert '7 entries copied raw, 1 entries to read' in caplog.text
+    after = raw_entries(archive)
+    assert set(check(archive, mod).values()) == {zipfile.ZIP_DEFLATED}
+    assert after.pop('common/other.txt') != before.pop('common/other.txt')
+    assert after == before
+
+    # entries built with another compression are not reused
+    caplog.clear()
+    with caplog.at_level(logging.DEBUG):
+        build(mod, archive, incremental=True)
+    assert '0 entries copied raw, 8 entries to read' in caplog.text
+    assert set(check(archive, mod).values()) == {zipfile.ZIP_STORED}
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED])
+def test_memory_budget(mod, tmp_path, monkeypatch, compression):
+    # a budget a fraction of the larger entries, shared by more readers than fit in it
+    budget = 64 * 1024
+    used = []
+    acquire = ByteBudget.acquire
+
+    def record(self, size, index):
+        acquire(self, size, index)
+        used.append(self.used)
+
+    monkeypatch.setattr(ByteBudget, 'acquire', record)
+    archive = tmp_path / 'mod.zip'
+    handler = PathHandler(mod, max_workers=8, memory_budget=budget)
+    thread = threading.Thread(target=handler.build, args=(archive,), kwargs=dict(compression=compression),
+                              daemon=True)
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive(), 'build deadlocked'
+
+    assert set(check(archive, mod).values()) == {compression}
+    # the entry being written may go over by the one chunk it always gets
+    assert used and max(used) <= 2 * budget
+
+
+@pytest.mark.parametrize('compression', [zipfile.ZIP_DEFLATED, zipfile.ZIP_LZMA])
+def test_process_pool(mod, tmp_path, monkeypatch, compression):
+    submitted = []
+    submit = ProcessPoolExecutor.submit
+    monkeypatch.setattr(ProcessPoolExecutor, 'submit',
+                        lambda self, fn, source, *args: submitted.append(source) or submit(self, fn, source, *args))
+
+    archive = tmp_path / 'mod.zip'
+    build(mod, archive, compression=compression, level=6 if compression == zipfile.ZIP_DEFLATED else None)
+    assert set(check(archive, mod).values()) == {compression}
+    assert sorted(source[0] for source in submitted) == ['path'] * 8
+
+    # members of a built archive are compressed from the archive again
+    submitted.clear()
+    handler = BinHandler(archive)
+    try:
+        handler.build(tmp_path / 'copy.zip', compression=zipfile.ZIP_DEFLATED)
+    finally:
+        handler.close()
+    assert set(check(tmp_path / 'copy.zip', mod).values()) == {zipfile.ZIP_DEFLATED}
+    assert [source[0] for source in submitted] == ([] if compression == zipfile.ZIP_DEFLATED else ['zip'] * 8)
+
+
+def listing(archive):
+    with zipfile.ZipFile(archive) as zip_file:
+        assert zip_file.testzip() is None
+        return [(info.filename, info.compress_type, info.CRC, zip_file.read(info)) for info in zip_file.infolist()]
+
+
+def test_in_place(mod, tmp_path, caplog):
+    archive = tmp_path / 'mod.zip'
+    build(mod, archive, in_place=True, compression=zipfile.ZIP_DEFLATED)
+    size = archive.stat().st_size
+
+    (mod / 'common/other.txt').write_bytes(SCRIPT * 60)
+    (mod / 'events/events.txt').unlink()
+    (mod / 'events/added.txt').write_bytes(SCRIPT * 10)
+    with caplog.at_level(logging.INFO):
+        handler = build(mod, archive, in_place=True, compression=zipfile.ZIP_DEFLATED)
+    assert 'mod.zip: 2 entries written, 1 removed' in caplog.text
+    # appended to, not rewritten, and too little dead space to compact
+    assert archive.stat().st_size > size
+    assert not handler._compactions
+
+    build(mod, tmp_path / 'fresh.zip', compression=zipfile.ZIP_DEFLATED)
+    assert listing(archive) == listing(tmp_path / 'fresh.zip')
+    check(archive, mod)
+
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        build(mod, archive, in_place=True, compression=zipfile.ZIP_DEFLATED)
+    assert 'mod.zip is up to date' in caplog.text
+
+
+def test_compaction(mod, tmp_path, monkeypatch):
+    archive = tmp_path / 'mod.zip'
+    build(mod, archive, in_place=True)
+    monkeypatch.setattr(config, 'COMPACT_MIN', 256 * 1024)
+    monkeypatch.setattr(config, 'COMPACT_RATIO', 0.25)
+
+    # a small edit leaves less dead space than the threshold
+    (mod / 'common/other.txt').write_bytes(SCRIPT * 60)
+    handler = build(mod, archive, in_place=True)
+    assert not handler._compactions
+
+    # replacing the noise leaves 300 KiB behind, a third of the archive
+    (mod / 'gfx/noise.dds').write_bytes(random_bytes(random.Random(1), 300 * 1024))
+    handler = build(mod, archive, in_place=True)
+    assert len(handler._compactions) == 1
+    handler.wait_compactions()
+
+    fresh = tmp_path / 'fresh.zip'
+    build(mod, fresh)
+    assert listing(archive) == listing(fresh)
+    assert archive.stat().st_size == fresh.stat().st_size
+    assert Manifest.load(archive).size == archive.stat().st_size
+    check(archive, mod)
+
+    # the compacted archive is still updated in place
+    (mod / 'common/other.txt').write_bytes(SCRIPT * 70)
+    handler = build(mod, archive, in_place=True)
+    assert not handler._compactions
+    assert Manifest.load(archive).size == archive.stat().st_size > fresh.stat().st_size
+    check(archive, mod)
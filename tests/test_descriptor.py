@@ -0,0 +1,64 @@
+import pytest
+
+from pdxModTool import descriptor
+
+DESCRIPTOR = '\ufeff# written by the launcher\r\nversion="1.2"\r\ntags={\r\n\t"Gameplay"\r\n\t"Fixes" # kept\r\n}\r\n' \
+             'name = "Test \\"quoted\\" mod"\r\ndependencies = { "Other" }\r\nsupported_version="3.*"\r\n' \
+             'replace_path="common/ships"\r\nreplace_path="events"\r\nremote_file_id="1234"\r\n\r\n# the end\r\n'
+
+
+def test_round_trip():
+    assert descriptor.parse(DESCRIPTOR).dump() == DESCRIPTOR
+
+
+def test_round_trip_file(tmp_path):
+    path = tmp_path / 'test.mod'
+    path.write_bytes(DESCRIPTOR.encode() + b'picture="\xff.png"\n')
+    desc = descriptor.load(path)
+    descriptor.save(desc, tmp_path / 'copy.mod')
+    assert (tmp_path / 'copy.mod').read_bytes() == path.read_bytes()
+
+
+def test_values():
+    desc = descriptor.parse(DESCRIPTOR)
+    assert desc.name == 'Test "quoted" mod'
+    assert desc.get_all('replace_path') == ['common/ships', 'events']
+    assert [descriptor.to_python(value) for value in desc.get('tags').values()] == ['Gameplay', 'Fixes']
+
+
+def test_edit_keeps_layout():
+    desc = descriptor.parse(DESCRIPTOR).copy()
+    desc.set('version', '1.3')
+    desc.set('archive', 'mod/test.zip')
+    desc.remove('remote_file_id')
+    assert desc.dump() == DESCRIPTOR.replace('"1.2"', '"1.3"') \
+        .replace('remote_file_id="1234"', 'archive="mod/test.zip"')
+
+
+def test_unterminated_string_ends_at_line():
+    text = 'name="broken\nversion="1"\n'
+    desc = descriptor.parse(text)
+    assert desc.dump() == text
+    assert desc.name == 'broken'
+    assert desc.get('version') == '1'
+
+
+def test_trailing_backslash():
+    text = 'path="C:\\mods\\"\nname="windows"\n'
+    desc = descriptor.parse(text)
+    assert desc.dump() == text
+    assert desc.get('path') == 'C:\\mods\\'
+    assert desc.name == 'windows'
+
+
+@pytest.mark.parametrize('text, line', [
+    ('name="a"\ntags={\n"b"\n', 3),
+    ('name="a"\n}\n', 2),
+    ('name="a"\n\nversion = !\n', 3),
+    ('name="a"\nversion =\n', 2),
+])
+def test_error_line(text, line):
+    with pytest.raises(descriptor.DescriptorError) as error:
+        descriptor.parse(text)
+    assert error.value.line == line
+    assert str(error.value).startswith(f'line {line}: ')
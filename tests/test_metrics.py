@@ -0,0 +1,24 @@
+import pstats
+import threading
+
+from pdxModTool import metrics
+
+
+def in_thread():
+    return sum(range(1000))
+
+
+def command(args):
+    threads = [threading.Thread(target=in_thread) for _ in range(args)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def test_profile_threads(tmp_path):
+    path = tmp_path / 'build.prof'
+    metrics.run(command, 3, 'build', profile_path=path)
+    calls = {function[2]: stat[1] for function, stat in pstats.Stats(str(path)).stats.items()}
+    assert calls['command'] == 1
+    assert calls['in_thread'] == 3
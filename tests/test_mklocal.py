@@ -0,0 +1,110 @@
+import json
+import logging
+import zipfile
+
+import pytest
+
+from pdxModTool import config, descriptor, game_options
+from pdxModTool.__main__ import mk_local
+from pdxModTool.cache import ArtifactCache
+from pdxModTool.cli import parser
+
+GAME = 'stellaris'
+SCRIPT = b'pdx_test = { modifier = { value = 1 } }\n'
+
+
+@pytest.fixture
+def game_dir(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    monkeypatch.setenv('HOME', str(home))
+    path = home / 'Documents' / 'Paradox Interactive' / game_options.GAME_DIRECTORIES[GAME]
+    (path / 'mod').mkdir(parents=True)
+    return path
+
+
+def workshop_mod(game_dir, mod_id, name, size=100):
+    # a downloaded workshop mod: the launcher's descriptor in the game's mod folder, the archive elsewhere
+    archive = game_dir.parent.parent.parent / 'workshop' / str(mod_id) / f'{mod_id}.zip'
+    archive.parent.mkdir(parents=True, exist_ok=True)
+    with zipfile.ZipFile(archive, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.writestr('descriptor.mod', f'name="{name}"\nversion="1"\n')
+        zip_file.writestr('common/script.txt', SCRIPT * size)
+    (game_dir / 'mod' / f'ugc_{mod_id}.mod').write_text(f'name="{name}"\narchive="{archive.as_posix()}"\n')
+    return f'mod/ugc_{mod_id}.mod'
+
+
+def enable(game_dir, mods):
+    with (game_dir / 'dlc_load.json').open('w') as dlc_load:
+        json.dump({'enabled_mods': mods, 'disabled_dlcs': []}, dlc_load)
+
+
+def enabled(game_dir):
+    with (game_dir / 'dlc_load.json').open('r') as dlc_load:
+        return json.load(dlc_load)['enabled_mods']
+
+
+def test_batch(game_dir, caplog):
+    (game_dir / 'mod' / 'local.mod').write_text('name="Local"\narchive="mod/local.zip"\n')
+    mods = [workshop_mod(game_dir, 1, 'First Mod', 5000), 'mod/local.mod', workshop_mod(game_dir, 2, 'Broken'),
+            workshop_mod(game_dir, 3, 'Third')]
+    # a download that never finished
+    broken = game_dir.parent.parent.parent / 'workshop' / '2' / '2.zip'
+    broken.write_bytes(broken.read_bytes()[:50])
+    enable(game_dir, mods)
+
+    with caplog.at_level(logging.INFO):
+        mk_local(parser.parse_args(['mklocal', GAME, '--dlc_load', '--no-cache', '-j', '3']))
+    assert f'could not build {broken}' in caplog.text
+    assert 'built 2 of 3 mods' in caplog.text
+
+    # the broken mod is skipped and keeps its workshop descriptor, in its place in the load order
+    assert enabled(game_dir) == ['mod/first_mod.mod', 'mod/local.mod', 'mod/ugc_2.mod', 'mod/third.mod']
+    for name in ('first_mod', 'third'):
+        with zipfile.ZipFile(game_dir / 'mod' / f'{name}.zip') as zip_file:
+            assert zip_file.testzip() is None
+        assert descriptor.load(game_dir / 'mod' / f'{name}.mod').get('archive') == f'mod/{name}.zip'
+    assert not (game_dir / 'mod' / 'broken.zip').exists()
+
+
+def test_cache(game_dir, monkeypatch, caplog):
+    mods = [workshop_mod(game_dir, 1, 'First Mod', 5000), workshop_mod(game_dir, 2, 'Second')]
+    enable(game_dir, mods)
+    args = parser.parse_args(['mklocal', GAME, '--dlc_load'])
+    mk_local(args)
+    zip_path = game_dir / 'mod' / 'first_mod.zip'
+    data = zip_path.read_bytes()
+
+    # the deleted zip comes back from the cache, hard linked, without being built
+    zip_path.unlink()
+    (game_dir / 'mod' / 'first_mod.mod').unlink()
+    enable(game_dir, mods)
+    monkeypatch.setattr('pdxModTool.batch.PDXMod', lambda *args, **kwargs: pytest.fail('built again'))
+    with caplog.at_level(logging.INFO):
+        mk_local(args)
+    assert 'restoring first_mod from cache' in caplog.text
+    assert 'second is up to date' in caplog.text
+    assert zip_path.read_bytes() == data
+    cache = ArtifactCache.load(game_dir / config.CACHE_DIR)
+    artifact = next(cache.artifact_path(key) for key, entry in cache.entries.items() if entry['name'] == 'first_mod')
+    assert zip_path.stat().st_ino == artifact.stat().st_ino
+    assert descriptor.load(game_dir / 'mod' / 'first_mod.mod').get('archive') == 'mod/first_mod.zip'
+    assert enabled(game_dir) == ['mod/first_mod.mod', 'mod/second.mod']
+
+
+def test_cache_eviction(tmp_path):
+    mod_dir = tmp_path / 'mod'
+    mod_dir.mkdir()
+    cache = ArtifactCache(tmp_path / 'cache', limit=2500)
+    for name in ('a', 'b', 'c'):
+        (mod_dir / f'{name}.zip').write_bytes(bytes(1000))
+        cache.store(name, name, mod_dir)
+    # a was used last, so b is the least recently used
+    assert cache.restore('a', mod_dir) == 'a'
+    cache.save()
+
+    cache = ArtifactCache.load(tmp_path / 'cache', limit=2500)
+    assert sorted(cache.entries) == ['a', 'c']
+    assert not cache.artifact_path('b').exists()
+    assert cache.restore('b', mod_dir) is None
+    # evicting an artifact leaves the mod it was linked to alone
+    assert (mod_dir / 'b.zip').read_bytes() == bytes(1000)
@@ -0,0 +1,116 @@
+import os
+import random
+import zipfile
+import zlib
+
+import pytest
+
+from pdxModTool import config
+from pdxModTool.newzipfile import ZipFile
+
+DATE_TIME = (2020, 1, 2, 3, 4, 6)
+
+
+def random_bytes(rng, size):
+    return rng.getrandbits(size * 8).to_bytes(size, 'little')
+
+
+def members():
+    rng = random.Random(0)
+    script = b'pdx_test = { modifier = { value = 1 } }\n'
+    return [
+        ('common/script.txt', script * 2000, zipfile.ZIP_DEFLATED),
+        ('gfx/texture.dds', random_bytes(rng, 600 * 1024), zipfile.ZIP_STORED),
+        ('gfx/small.dds', random_bytes(rng, 100), zipfile.ZIP_DEFLATED),
+        ('empty.txt', b'', zipfile.ZIP_DEFLATED),
+        ('events/événement.txt', script * 3, zipfile.ZIP_DEFLATED),
+    ]
+
+
+def write_source(path):
+    with zipfile.ZipFile(path, 'w') as zip_file:
+        for name, data, compress_type in members():
+            info = zipfile.ZipInfo(name, DATE_TIME)
+            info.compress_type = compress_type
+            zip_file.writestr(info, data)
+
+
+def raw_copy(source, dest, chunked):
+    with ZipFile(source, 'r') as src, ZipFile(dest, 'w') as dst:
+        for info in src.infolist():
+            with src.open_raw(info) as raw:
+                if chunked:
+                    dst.write_raw(info, iter(lambda: raw.read(4096), b''))
+                else:
+                    dst.write_raw(info, raw.read())
+
+
+@pytest.fixture(params=['writev', 'write'])
+def writes(request, monkeypatch):
+    # small batches, so vectors get flushed and split mid payload
+    monkeypatch.setattr(config, 'WRITEV_SIZE', 64 * 1024)
+    monkeypatch.setattr(config, 'WRITEV_PARTS', 3)
+    if request.param == 'write':
+        monkeypatch.delattr(os, 'writev', raising=False)
+    elif not hasattr(os, 'writev'):
+        pytest.skip('os.writev is not available')
+    return request.param
+
+
+@pytest.mark.parametrize('chunked', [False, True])
+def test_raw_copy(tmp_path, writes, chunked):
+    source, dest = tmp_path / 'source.zip', tmp_path / 'dest.zip'
+    write_source(source)
+    raw_copy(source, dest, chunked)
+
+    assert dest.read_bytes() == source.read_bytes()
+    with zipfile.ZipFile(dest) as zip_file:
+        assert zip_file.testzip() is None
+        assert [(name, zip_file.read(name)) for name in zip_file.namelist()] == \
+               [(name, data) for name, data, _ in members()]
+
+
+@pytest.mark.parametrize('mmap', [False, True])
+def test_read_raw(tmp_path, monkeypatch, mmap):
+    monkeypatch.setattr(config, 'MMAP_READS', mmap)
+    source = tmp_path / 'source.zip'
+    write_source(source)
+    with ZipFile(source, 'r') as ours, zipfile.ZipFile(source) as theirs:
+        for info in ours.infolist():
+            raw = ours.read_raw(info)
+            assert len(raw) == info.compress_size
+            if info.compress_type == zipfile.ZIP_DEFLATED:
+                raw = zlib.decompress(raw, -zlib.MAX_WBITS)
+            assert raw == theirs.read(info.filename)
+
+
+@pytest.mark.parametrize('durable', [False, True])
+def test_append(tmp_path, writes, durable):
+    path = tmp_path / 'mod.zip'
+    write_source(path)
+    size = path.stat().st_size
+    with ZipFile(path, 'a', durable=durable) as zip_file:
+        zip_file.discard(['gfx/texture.dds'])
+        zip_file.writestr(zipfile.ZipInfo('added.txt', DATE_TIME), b'added')
+
+    with zipfile.ZipFile(path) as zip_file:
+        assert zip_file.testzip() is None
+        assert 'gfx/texture.dds' not in zip_file.namelist()
+        assert zip_file.read('added.txt') == b'added'
+    if durable:
+        # the old archive is left as it was, so truncating undoes the update
+        with open(path, 'r+b') as file:
+            file.truncate(size)
+        with zipfile.ZipFile(path) as zip_file:
+            assert zip_file.testzip() is None
+            assert 'gfx/texture.dds' in zip_file.namelist()
+
+
+def test_live_size(tmp_path):
+    path = tmp_path / 'mod.zip'
+    write_source(path)
+    with ZipFile(path, 'a') as zip_file:
+        live = zip_file.live_size()
+        texture = zip_file.getinfo('gfx/texture.dds')
+        zip_file.discard(['gfx/texture.dds', 'missing.txt'])
+        assert live - zip_file.live_size() > texture.compress_size
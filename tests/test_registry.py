@@ -0,0 +1,89 @@
+import json
+import os
+
+import pytest
+
+from pdxModTool import __main__, config, game_options
+from pdxModTool.cli import parser
+from pdxModTool.registry import ModRegistry
+
+GAME = 'stellaris'
+
+
+@pytest.fixture
+def game_dir(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    monkeypatch.setenv('HOME', str(home))
+    path = home / 'Documents' / 'Paradox Interactive' / game_options.GAME_DIRECTORIES[GAME]
+    (path / 'mod').mkdir(parents=True)
+    with (path / 'dlc_load.json').open('w') as dlc_load:
+        json.dump({'enabled_mods': ['mod/test.mod', 'mod/folder.mod']}, dlc_load)
+    (path / 'mod' / 'test.mod').write_text('name="Test"\narchive="mod/test.zip"\n')
+    (path / 'mod' / 'test.zip').write_bytes(bytes(1000))
+    source = tmp_path / 'source'
+    (source / 'common').mkdir(parents=True)
+    (source / 'descriptor.mod').write_text('name="Folder"\n')
+    (source / 'common' / 'script.txt').write_bytes(bytes(3 * 1024 ** 2))
+    (path / 'mod' / 'folder.mod').write_text(f'name="Folder"\npath="{source.as_posix()}"\n')
+    return path
+
+
+@pytest.fixture
+def described(monkeypatch):
+    paths = []
+    describe = ModRegistry.describe
+    monkeypatch.setattr(ModRegistry, 'describe',
+                        lambda self, desc_path, key: paths.append(desc_path.name) or describe(self, desc_path, key))
+    return paths
+
+
+def resolve(desc):
+    registry = ModRegistry.load(GAME)
+    record = registry.resolve(desc)
+    registry.save()
+    return record
+
+
+def test_record_reused(game_dir, described):
+    record = resolve('mod/test.mod')
+    assert (record['name'], record['mod'][0]) == ('Test', 1000)
+    assert (game_dir / config.REGISTRY_FILE).exists()
+
+    # nothing is parsed while the descriptor's size and mtime hold, or its contents
+    assert resolve('mod/test.mod') == record
+    stat = (game_dir / 'mod' / 'test.mod').stat()
+    os.utime(game_dir / 'mod' / 'test.mod', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert resolve('mod/test.mod')['name'] == 'Test'
+    assert described == ['test.mod']
+
+    # the archive is stat'ed again every time
+    (game_dir / 'mod' / 'test.zip').write_bytes(bytes(2000))
+    assert resolve('mod/test.mod')['mod'][0] == 2000
+    assert described == ['test.mod']
+
+    (game_dir / 'mod' / 'test.mod').write_text('name="Renamed"\narchive="mod/test.zip"\n')
+    assert resolve('mod/test.mod')['name'] == 'Renamed'
+    assert described == ['test.mod', 'test.mod']
+
+
+def test_list_content_size(game_dir, described, monkeypatch, capsys):
+    scanned = []
+    scan_tree = __main__.scan_tree
+    monkeypatch.setattr(__main__, 'scan_tree',
+                        lambda path, ignore: scanned.append(path.name) or scan_tree(path, ignore))
+    args = parser.parse_args(['list', GAME])
+
+    __main__.list_mods(args)
+    assert 'folder' in capsys.readouterr().out.lower()
+    __main__.list_mods(args)
+    output = capsys.readouterr().out
+    assert [line.split()[1:3] for line in output.splitlines()] == [['0.0', 'MiB'], ['3.0', 'MiB']]
+    # folders are scanned once, and again only once they change
+    assert scanned == ['source']
+    assert sorted(described) == ['folder.mod', 'test.mod']
+
+    source = game_dir.parent.parent.parent.parent / 'source'
+    (source / 'more.txt').write_bytes(bytes(1024 ** 2))
+    __main__.list_mods(args)
+    assert capsys.readouterr().out.splitlines()[1].split()[1] == '4.0'
+    assert scanned == ['source', 'source']
@@ -0,0 +1,21 @@
+from pdxModTool.handler import PathHandler
+from pdxModTool.scanner import ModIgnore, scan_tree
+
+
+def scan(root):
+    return [src.arcname for src in scan_tree(root, ModIgnore.load(root, PathHandler.IGNORE))]
+
+
+def test_own_files_ignored(tmp_path):
+    # an archive built into the mod folder, with everything the tool keeps beside it
+    for name in ('descriptor.mod', 'test.zip', 'test.zip.tmp', 'test.manifest', 'test.policy', 'test.policy.tmp'):
+        (tmp_path / name).write_text(name)
+    assert scan(tmp_path) == ['descriptor.mod']
+
+
+def test_source_files_kept(tmp_path):
+    names = ['common/ships.tmp', 'interface/game.manifest', 'map/terrain.policy', 'other.manifest']
+    for name in names + ['test.zip']:
+        (tmp_path / name).parent.mkdir(exist_ok=True)
+        (tmp_path / name).write_text(name)
+    assert sorted(scan(tmp_path)) == sorted(names)
@@ -0,0 +1,68 @@
+import logging
+import socket
+import threading
+import time
+
+import pytest
+
+from pdxModTool import config, game_options
+from pdxModTool.client import Client
+from pdxModTool.protocol import connect_channel
+from pdxModTool.server import Server
+
+GAME = 'stellaris'
+BIG_SIZE = 16 * 1024 * 1024
+
+
+@pytest.fixture
+def mod_dir(tmp_path, monkeypatch):
+    home = tmp_path / 'home'
+    monkeypatch.setenv('HOME', str(home))
+    path = home / 'Documents' / 'Paradox Interactive' / game_options.GAME_DIRECTORIES[GAME] / 'mod'
+    path.mkdir(parents=True)
+    return path
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    # big.bin is more chunks than the backlog and socket buffers of a client that stopped reading take
+    monkeypatch.setattr(config, 'CHUNK_SIZE', 64 * 1024)
+    monkeypatch.setattr(config, 'SESSION_STALL', 2.0)
+    path = tmp_path / 'server'
+    path.mkdir()
+    (path / 'test.mod').write_text('name="test"\narchive="mod/test.zip"\n')
+    (path / 'test.zip').write_bytes(bytes(range(256)) * 4096)
+    (path / 'big.bin').write_bytes(bytes(BIG_SIZE))
+    return [path / 'test.mod', path / 'test.zip', path / 'big.bin']
+
+
+def test_stalled_client(sources, mod_dir, caplog):
+    server = Server(GAME, '127.0.0.1', 0, session=2)
+    server.files = sources
+    server.listen()
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+
+    # joins the session, then never reads
+    stalled = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    stalled.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024)
+    stalled.connect(('127.0.0.1', server.port))
+    try:
+        channel = connect_channel(stalled)
+        if channel.resume:
+            channel.send_partials({})
+        start = time.monotonic()
+        with caplog.at_level(logging.INFO):
+            Client().connect('127.0.0.1', server.port)
+            thread.join(30)
+        assert not thread.is_alive()
+    finally:
+        stalled.close()
+
+    assert 'dropping it from the session' in caplog.text
+    assert 'finished broadcasting to 1 of 2 clients' in caplog.text
+    # held back for SESSION_STALL at most, not for as long as the stalled client
+    assert time.monotonic() - start < 10
+    for path in sources[1:]:
+        assert (mod_dir / path.name).read_bytes() == path.read_bytes()
+    assert (mod_dir / 'test.mod').exists()
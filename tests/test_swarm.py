@@ -0,0 +1,131 @@
+import os
+import pathlib
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+from pdxModTool import game_options
+from pdxModTool.server import Server
+from pdxModTool.swarm import Swarm, build_map
+
+GAME = 'stellaris'
+CHUNK = 256 * 1024
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+
+
+def make_home(path: pathlib.Path):
+    mod_dir = path / 'Documents' / 'Paradox Interactive' / game_options.GAME_DIRECTORIES[GAME] / 'mod'
+    mod_dir.mkdir(parents=True)
+    return mod_dir
+
+
+@pytest.fixture
+def origin(tmp_path):
+    # the server every client gets the chunk map from, in this process
+    rng = random.Random(0)
+    path = tmp_path / 'origin'
+    path.mkdir()
+    (path / 'test.mod').write_text('name="test"\narchive="mod/test.zip"\n')
+    (path / 'test.zip').write_bytes(rng.getrandbits(8 * 1_000_000).to_bytes(1_000_000, 'little'))
+    (path / 'big.bin').write_bytes(rng.getrandbits(8 * 3_000_000).to_bytes(3_000_000, 'little'))
+    files = [path / 'test.mod', path / 'test.zip', path / 'big.bin']
+
+    server = Server(GAME, '127.0.0.1', 0, persist=True)
+    server.files = files
+    server.swarm = Swarm(GAME, files, build_map(files, CHUNK))
+    server.listen()
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    yield server
+    # done once the last connection is
+    server.swarm, server._persist = None, False
+    thread.join(10)
+
+
+def recv(home: pathlib.Path, origin: Server, *args):
+    # recv --swarm in a process of its own, with a home of its own
+    env = {**os.environ, 'HOME': str(home), 'PYTHONPATH': str(ROOT)}
+    return [sys.executable, '-m', 'pdxModTool', '-debug', 'recv', '127.0.0.1', '-p', str(origin.port), '--swarm',
+            *args], env
+
+
+class Seeder:
+    # recv --swarm --seed, serving what it fetched until stopped
+
+    def __init__(self, home: pathlib.Path, origin: Server):
+        self.mod_dir = make_home(home)
+        self.log = (home / 'seed.log').open('w')
+        command, env = recv(home, origin, '--seed')
+        self.process = subprocess.Popen(command, env=env, stdout=self.log, stderr=subprocess.STDOUT)
+        # joined once the origin lists one more peer
+        peers = len(origin.swarm.peers)
+        deadline = time.monotonic() + 30
+        while len(origin.swarm.peers) == peers:
+            assert self.process.poll() is None and time.monotonic() < deadline, 'seeder never joined'
+            time.sleep(0.05)
+        self.address = origin.swarm.peers[-1]
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(10)
+        self.log.close()
+
+
+def fetch(home: pathlib.Path, origin: Server):
+    command, env = recv(home, origin)
+    return subprocess.run(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, timeout=60)
+
+
+def peer_chunks(output, peer):
+    # progress bars share the stream, so a log line may come after one on the same line
+    return sum(int(count) for count in re.findall(rf'(\d+) chunks from {re.escape(peer[0])}:{peer[1]}$', output,
+                                                   re.MULTILINE))
+
+
+def test_swarm(tmp_path, origin):
+    seeder = Seeder(tmp_path / 'seeder', origin)
+    try:
+        # the origin no longer serves big.bin itself, only the peer can
+        big = origin.swarm.paths.pop('big.bin')
+        mod_dir = make_home(tmp_path / 'client')
+        result = fetch(tmp_path / 'client', origin)
+
+        assert result.returncode == 0, result.stdout
+        assert peer_chunks(result.stdout, seeder.address) >= -(-big.stat().st_size // CHUNK)
+        for path in origin.files:
+            if path.suffix != '.mod':
+                assert (mod_dir / path.name).read_bytes() == path.read_bytes()
+        assert (mod_dir / 'test.mod').exists()
+    finally:
+        seeder.stop()
+
+
+def test_corrupt_peer(tmp_path, origin):
+    seeder = Seeder(tmp_path / 'seeder', origin)
+    try:
+        # the seeder's copy goes bad after it joined
+        with (seeder.mod_dir / 'big.bin').open('r+b') as file:
+            file.seek(CHUNK + 10)
+            file.write(b'corrupt')
+        big = origin.swarm.paths.pop('big.bin')
+        mod_dir = make_home(tmp_path / 'client')
+        result = fetch(tmp_path / 'client', origin)
+
+        assert result.returncode == 1
+        assert 'does not match the chunk map' in result.stdout
+        # the client told the origin, which stops handing the peer out
+        deadline = time.monotonic() + 10
+        while origin.swarm.peers and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert origin.swarm.peers == []
+        # the good chunks it did send are kept, the rest comes from the origin
+        origin.swarm.paths['big.bin'] = big
+        assert fetch(tmp_path / 'client', origin).returncode == 0
+        assert (mod_dir / 'big.bin').read_bytes() == big.read_bytes()
+    finally:
+        seeder.stop()
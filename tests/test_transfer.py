@@ -0,0 +1,180 @@
+import logging
+import random
+import threading
+import zipfile
+import zlib
+
+import pytest
+
+from pdxModTool import config, descriptor, game_options
+from pdxModTool.client import Client
+from pdxModTool.protocol import LegacyChannel, ProtocolError
+from pdxModTool.resume import PartialFile, checksum, file_id
+from pdxModTool.server import Server
+from pdxModTool.wire import compressed_blocks
+
+GAME = 'stellaris'
+BIG_SIZE = 3 * 1024 * 1024 + 12345
+
+
+@pytest.fixture
+def mod_dir(tmp_path, monkeypatch):
+    # the client's game folder, in a home of its own
+    home = tmp_path / 'home'
+    monkeypatch.setenv('HOME', str(home))
+    path = home / 'Documents' / 'Paradox Interactive' / game_options.GAME_DIRECTORIES[GAME] / 'mod'
+    path.mkdir(parents=True)
+    return path
+
+
+@pytest.fixture
+def sources(tmp_path, monkeypatch):
+    # ranges small enough that several streams share each file
+    monkeypatch.setattr(config, 'STREAM_RANGE', 512 * 1024)
+    monkeypatch.setattr(config, 'RESUME_CHECKPOINT', 1024 * 1024)
+    rng = random.Random(0)
+    path = tmp_path / 'server'
+    path.mkdir()
+    (path / 'test.mod').write_text('name="test"\narchive="C:/Users/server/Documents/mod/test.zip"\n')
+    with zipfile.ZipFile(path / 'test.zip', 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for index in range(20):
+            zip_file.writestr(f'common/{index}.txt', f'pdx_test_{index} = {{ value = {index} }}\n' * 500)
+        zip_file.writestr('gfx/texture.dds', rng.getrandbits(8 * 300_000).to_bytes(300_000, 'little'))
+    (path / 'big.bin').write_bytes(rng.getrandbits(8 * BIG_SIZE).to_bytes(BIG_SIZE, 'little'))
+    return [path / 'test.mod', path / 'test.zip', path / 'big.bin']
+
+
+def transfer(files, streams=1, **kwargs):
+    # one client, asking for as many streams as the server allows
+    server = Server(GAME, '127.0.0.1', 0, streams=streams, **kwargs)
+    server.files = files
+    server.listen()
+    thread = threading.Thread(target=server.start, daemon=True)
+    thread.start()
+    client = Client(streams)
+    client.connect('127.0.0.1', server.port)
+    thread.join(10)
+    assert not thread.is_alive()
+    return client
+
+
+def check(files, mod_dir):
+    for path in files:
+        received = mod_dir / path.name
+        if path.suffix == '.mod':
+            assert descriptor.load(received).get('archive') == f'mod/{path.stem}.zip'
+        else:
+            assert received.read_bytes() == path.read_bytes()
+    assert not list(mod_dir.glob(f'*{config.PARTIAL_SUFFIX}'))
+    assert not list(mod_dir.glob(f'*{config.RESUME_SUFFIX}'))
+
+
+@pytest.mark.parametrize('streams', [1, 4])
+@pytest.mark.parametrize('compress', [None, 'zlib'])
+def test_transfer(sources, mod_dir, streams, compress):
+    client = transfer(sources, streams, compress=compress)
+    assert client.game == GAME
+    assert client.desc_paths == ['mod/test.mod']
+    check(sources, mod_dir)
+
+
+def test_legacy_server(sources, mod_dir, monkeypatch):
+    # a server that only speaks the old text headers and never reads what the client sends
+    monkeypatch.setattr('pdxModTool.server.accept_channel', LegacyChannel)
+    transfer(sources)
+    check(sources, mod_dir)
+
+
+@pytest.mark.parametrize('sync', [False, True])
+def test_legacy_client(sources, mod_dir, monkeypatch, sync):
+    # a client that waits for the header without sending a hello. it reads exactly count and game
+    # from it, so a sync server has to send it the whole playset the old way
+    def connect_channel(sock, *args):
+        channel = LegacyChannel(sock)
+        # as the original client unpacks it
+        count, channel.game = channel.get_header().split(config.SEPARATOR)
+        channel.count = int(count)
+        return channel
+
+    monkeypatch.setattr('pdxModTool.client.connect_channel', connect_channel)
+    transfer(sources, sync=sync)
+    check(sources, mod_dir)
+
+
+@pytest.mark.parametrize('streams', [1, 4])
+def test_sync(sources, mod_dir, caplog, streams):
+    transfer(sources, streams, sync=True)
+    caplog.clear()
+    with caplog.at_level(logging.INFO):
+        transfer(sources, streams, sync=True)
+    check(sources, mod_dir)
+    for path in sources:
+        assert f'{path.name} is up to date' in caplog.text
+
+
+@pytest.mark.parametrize('streams', [1, 4])
+@pytest.mark.parametrize('good', [True, False])
+def test_resume(sources, mod_dir, caplog, streams, good):
+    # half of big.bin arrived before the connection was lost. a partial that does not match the
+    # server's copy is sent again from the start
+    source = sources[-1]
+    offset = BIG_SIZE // 2
+    partial = PartialFile(mod_dir / source.name)
+    partial.part_path.write_bytes(source.read_bytes()[:offset] if good else bytes(offset))
+    partial.start(file_id(source), BIG_SIZE)
+    partial.checkpoint(offset, checksum(partial.part_path))
+
+    with caplog.at_level(logging.INFO):
+        transfer(sources, streams)
+    check(sources, mod_dir)
+    assert (f'resuming {source.name} at {offset}' in caplog.text) == good
+
+
+@pytest.mark.parametrize('streams', [1, 4])
+@pytest.mark.parametrize('good', [True, False])
+def test_complete_partial(sources, mod_dir, caplog, streams, good):
+    # all of big.bin arrived and was checkpointed, but the connection was lost before it was renamed
+    source = sources[-1]
+    partial = PartialFile(mod_dir / source.name)
+    partial.part_path.write_bytes(source.read_bytes())
+    partial.start(file_id(source), BIG_SIZE)
+    partial.checkpoint(BIG_SIZE, checksum(partial.part_path))
+    if not good:
+        # bytes that went bad on disk after the checkpoint
+        with partial.part_path.open('r+b') as part:
+            part.write(b'corrupt')
+
+    with caplog.at_level(logging.INFO):
+        if good:
+            transfer(sources, streams)
+        else:
+            with pytest.raises(ConnectionError):
+                transfer(sources, streams)
+    assert (f'{source.name} was complete' in caplog.text) == good
+    if good:
+        check(sources, mod_dir)
+    else:
+        assert f'{source.name} failed verification' in caplog.text
+        assert not partial.part_path.exists() and not partial.state_path.exists()
+
+
+def test_bad_block(sources, mod_dir, monkeypatch):
+    # a compressed block that decodes to less than its frame says is never written
+    monkeypatch.setattr(config, 'WIRE_BLOCK', 256 * 1024)
+    script = sources[0].parent / 'script.txt'
+    script.write_bytes(b'pdx_test = { value = 1 }\n' * 40000)
+
+    def lying_blocks(*args):
+        for index, (raw, block) in enumerate(compressed_blocks(*args)):
+            if index == 2:
+                block = zlib.compress(zlib.decompress(block)[:-1])
+            yield raw, block
+
+    monkeypatch.setattr('pdxModTool.server.compressed_blocks', lying_blocks)
+    with pytest.raises(ProtocolError, match='expected 262144'):
+        transfer([script], compress='zlib')
+    # what came before it is kept for resuming
+    partial = PartialFile(mod_dir / script.name)
+    assert partial.load()['offset'] == 2 * config.WIRE_BLOCK
+    assert partial.part_path.read_bytes() == script.read_bytes()[:2 * config.WIRE_BLOCK]
+    assert not (mod_dir / script.name).exists()
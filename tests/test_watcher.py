@@ -0,0 +1,46 @@
+import zipfile
+
+import pytest
+
+from pdxModTool import config
+from pdxModTool.handler import PathHandler
+from pdxModTool.scanner import RESCAN
+from pdxModTool.watcher import PollingWatcher
+
+
+@pytest.fixture
+def mod(tmp_path):
+    path = tmp_path / 'mod'
+    (path / 'common').mkdir(parents=True)
+    (path / 'descriptor.mod').write_text('name="test"\n')
+    (path / 'common' / 'script.txt').write_text('value = 1\n')
+    (path / 'common' / 'other.txt').write_text('value = 2\n')
+    return path
+
+
+def test_polling(mod, tmp_path):
+    handler = PathHandler(mod)
+    archive = tmp_path / 'test.zip'
+    handler.build(archive, in_place=True)
+    watcher = PollingWatcher(mod, handler.ignore, interval=0.01)
+    assert watcher.wait(0) == set()
+
+    # the size stays the same, only the mtime tells
+    (mod / 'common' / 'script.txt').write_text('value = 3\n')
+    (mod / 'common' / 'other.txt').unlink()
+    (mod / 'common' / 'added.txt').write_text('value = 4\n')
+    (mod / 'notes.zip').write_bytes(b'ignored')
+    changed = watcher.wait()
+    assert changed == {'common/script.txt', 'common/other.txt', 'common/added.txt'}
+    assert watcher.wait(0) == set()
+
+    handler.update(changed)
+    handler.build(archive, in_place=True)
+    with zipfile.ZipFile(archive) as zip_file:
+        assert sorted(zip_file.namelist()) == ['common/added.txt', 'common/script.txt', 'descriptor.mod']
+        assert zip_file.read('common/script.txt') == b'value = 3\n'
+
+    # the ignore file changes what the tree is
+    (mod / config.IGNORE_FILE).write_text('common/\n')
+    assert watcher.wait() == {RESCAN}
+    watcher.close()